@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""mastodon_modelsのmemory benchmark.
+
+    $ python benchmarks/bench_models.py
+
+timeline 250ページ分(10000 status)を、parseしたJSONのdictのまま持った時と、normalizeしてmodelにした時の
+memoryを比べる. statusとaccountのidはページ毎に変えて、全部のentityが残るようにする.
+"""
+import timeit
+import tracemalloc
+
+from bench_normalizr import NUMBER, REPEAT, make_timeline
+
+from naumanni import jsoncodec
+from naumanni.mastodon_api import get_schema
+from naumanni.mastodon_models import Status
+from naumanni.normalizr import normalize
+
+
+TIMELINE_API = '/timelines/home'
+PAGES = 250
+
+
+def make_pages(pages=PAGES):
+    rv = []
+    for page in range(pages):
+        timeline = make_timeline()
+        for status in timeline:
+            for data in (status, status['reblog']):
+                if data is not None:
+                    data['id'] += page * 100000
+                    data['account']['id'] += page * 100
+        rv.append(jsoncodec.dumps(timeline))
+    return rv
+
+
+def retained(func):
+    """funcが返したものが掴んでいるmemory(KB)"""
+    tracemalloc.start()
+    try:
+        rv = func()
+        size = tracemalloc.get_traced_memory()[0]
+        del rv
+        return size / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    schema = get_schema(TIMELINE_API)
+    pages = make_pages()
+
+    def keep_dicts():
+        return [jsoncodec.loads(raw) for raw in pages]
+
+    def keep_entities():
+        entities = {}
+        for raw in pages:
+            for key, table in normalize(jsoncodec.loads(raw), schema)[0].items():
+                entities.setdefault(key, {}).update(table)
+        return entities
+
+    entities = keep_entities()
+    statuses = len(entities['statuses'])
+    print('{} statuses, {} accounts'.format(statuses, len(entities['accounts'])))
+    for label, func in [('parsed dicts', keep_dicts), ('models', keep_entities)]:
+        size = retained(func)
+        print('{:<32} {:>10.1f} KB {:>10.1f} bytes/status'.format(label, size, size * 1024 / statuses))
+
+    data = jsoncodec.loads(pages[0])[0]
+    del data['reblog']
+    status = Status.from_dict(dict(data))
+    for label, func in [
+        ('dict + Status.from_dict', lambda: Status.from_dict(dict(data))),
+        ('Status.to_dict', status.to_dict),
+    ]:
+        elapsed = min(timeit.repeat(func, number=NUMBER * 100, repeat=REPEAT))
+        print('{:<32} {:>10.2f} usec'.format(label, elapsed / NUMBER / 100 * 1000 * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""normalize/denormalizeのbenchmark.
+
+    $ python benchmarks/bench_normalizr.py
+
+home timeline 1ページ(40 status)を、schemaを1nodeずつ辿る実装とcompileした実装で比べる.
+normalizeは渡したdictを書き換えるので、proxyと同じく毎回JSONをparseしてからnormalizeする.
+1人が30件postしたtimelineで、denormalizeのshared modeとallocationも比べる.
+最後に、自分自身を含むschemaで1000 statusのreply treeを、再帰する実装と再帰しない実装で比べる.
+"""
+import sys
+import timeit
+import tracemalloc
+
+from naumanni import jsoncodec
+from naumanni.mastodon_api import account, get_schema
+from naumanni.mastodon_models import Status
+from naumanni.normalizr import Entity, denormalize, denormalize_generic, normalize, normalize_generic
+
+
+TIMELINE_API = '/timelines/home'
+TIMELINE_SIZE = 40
+THREAD_SIZE = 1000
+NUMBER = 100
+REPEAT = 20
+
+
+def make_account(account_id):
+    return {
+        'id': account_id,
+        'username': 'user{}'.format(account_id),
+        'acct': 'user{}@example.com'.format(account_id),
+        'display_name': 'User {}'.format(account_id),
+        'locked': False,
+        'created_at': '2017-04-01T00:00:00.000Z',
+        'followers_count': 100,
+        'following_count': 100,
+        'statuses_count': 1000,
+        'note': '<p>hello</p>',
+        'url': 'https://example.com/@user{}'.format(account_id),
+        'avatar': 'https://example.com/avatars/{}.png'.format(account_id),
+        'avatar_static': 'https://example.com/avatars/{}.png'.format(account_id),
+        'header': 'https://example.com/headers/{}.png'.format(account_id),
+        'header_static': 'https://example.com/headers/{}.png'.format(account_id),
+    }
+
+
+def make_status(status_id, account_id, reblog=None):
+    return {
+        'id': status_id,
+        'uri': 'tag:example.com,2017-04-01:objectId={}:objectType=Status'.format(status_id),
+        'url': 'https://example.com/@user{}/{}'.format(account_id, status_id),
+        'account': make_account(account_id),
+        'in_reply_to_id': None,
+        'in_reply_to_account_id': None,
+        'reblog': reblog,
+        'content': '<p>status {} <a href="https://example.com/">https://example.com/</a></p>'.format(status_id),
+        'created_at': '2017-04-01T00:00:00.000Z',
+        'reblogs_count': 0,
+        'favourites_count': 0,
+        'reblogged': False,
+        'favourited': False,
+        'sensitive': False,
+        'spoiler_text': '',
+        'visibility': 'public',
+        'media_attachments': [],
+        'mentions': [],
+        'tags': [],
+        'application': {'name': 'Web', 'website': None},
+    }
+
+
+def make_timeline(size=TIMELINE_SIZE, heavy_posts=0):
+    """4件に1件はreblog. accountは10人で使いまわす. 最初のheavy_posts件はaccount 1のpost"""
+    timeline = []
+    for idx in range(size):
+        status_id = 10000 - idx
+        reblog = None
+        if idx % 4 == 0:
+            reblog = make_status(5000 - idx, idx % 10 + 100)
+        account_id = 1 if idx < heavy_posts else idx % 10
+        timeline.append(make_status(status_id, account_id, reblog))
+    return timeline
+
+
+def make_thread(size=THREAD_SIZE, children=1):
+    """statusのreply tree. children=1ならsize段の一本道. 深すぎてJSONにできないので直接作る"""
+    nodes = []
+    for idx in range(size):
+        node = make_status(idx + 1, idx % 10)
+        node['replies'] = []
+        if idx:
+            nodes[(idx - 1) // children]['replies'].append(node)
+        nodes.append(node)
+    return nodes[0]
+
+
+def bench(label, func, number=NUMBER):
+    elapsed = min(timeit.repeat(func, number=number, repeat=REPEAT))
+    usec = elapsed / number * 1000 * 1000
+    print('{:<32} {:>10.1f} usec/page'.format(label, usec))
+    return usec
+
+
+def allocated(func):
+    """funcが確保したmemoryのpeak(KB)"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    schema = get_schema(TIMELINE_API)
+    timeline = make_timeline()
+    raw = jsoncodec.dumps(timeline)
+    entities, result = normalize(jsoncodec.loads(raw), schema)
+    assert normalize_generic(jsoncodec.loads(raw), schema)[1] == result
+    assert denormalize(result, schema, entities) == denormalize_generic(result, schema, entities) == timeline
+
+    print('{} statuses ({} api, {} codec)'.format(len(timeline), TIMELINE_API, jsoncodec.name))
+    parse = bench('loads', lambda: jsoncodec.loads(raw))
+    generic = bench(
+        'loads + normalize (generic)', lambda: normalize_generic(jsoncodec.loads(raw), get_schema(TIMELINE_API)))
+    compiled = bench(
+        'loads + normalize (compiled)', lambda: normalize(jsoncodec.loads(raw), get_schema(TIMELINE_API)))
+    print('{:<32} {:>10.2f}x'.format('', (generic - parse) / (compiled - parse)))
+
+    generic = bench('denormalize (generic)', lambda: denormalize_generic(result, get_schema(TIMELINE_API), entities))
+    compiled = bench('denormalize (compiled)', lambda: denormalize(result, get_schema(TIMELINE_API), entities))
+    print('{:<32} {:>10.2f}x'.format('', generic / compiled))
+
+    timeline = make_timeline(heavy_posts=30)
+    entities, result = normalize(jsoncodec.loads(jsoncodec.dumps(timeline)), schema)
+    print()
+    print('{} statuses, 30 by one account'.format(len(timeline)))
+    funcs = [
+        ('denormalize (generic)', lambda: denormalize_generic(result, schema, entities)),
+        ('denormalize (compiled)', lambda: denormalize(result, schema, entities)),
+        ('denormalize (compiled, shared)', lambda: denormalize(result, schema, entities, shared=True)),
+    ]
+    for label, func in funcs:
+        bench(label, func)
+    for label, func in funcs:
+        print('{:<32} {:>10.1f} KB peak'.format(label, allocated(func)))
+
+    # 再帰する実装は一本道のthreadを辿れないので、比べる間だけ上限を上げる
+    reply = Entity('statuses', Status, {'account': account})
+    reply.schema['replies'] = [reply]
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(THREAD_SIZE * 10)
+    try:
+        for label, children in [('chain', 1), ('tree', 3)]:
+            entities, result = normalize(make_thread(children=children), reply)
+            print()
+            print('{} statuses in a reply {}'.format(THREAD_SIZE, label))
+            build = bench('make_thread', lambda: make_thread(children=children), number=NUMBER // 10)
+            generic = bench('make + normalize (recursive)', lambda: normalize_generic(
+                make_thread(children=children), reply), number=NUMBER // 10)
+            iterative = bench('make + normalize (iterative)', lambda: normalize(
+                make_thread(children=children), reply), number=NUMBER // 10)
+            print('{:<32} {:>10.2f}x'.format('', (generic - build) / (iterative - build)))
+            generic = bench('denormalize (recursive)', lambda: denormalize_generic(
+                result, reply, entities), number=NUMBER // 10)
+            iterative = bench('denormalize (iterative)', lambda: denormalize(
+                result, reply, entities), number=NUMBER // 10)
+            print('{:<32} {:>10.2f}x'.format('', generic / iterative))
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,10 @@ import aioredis
 from tornado import concurrent, gen, httpclient
 
 import naumanni
+from .. import jsoncodec, mastodon_models, wsdeflate
+from ..normalizr import get_entity_keys
 from ..plugin import Plugin
+from . import circuitbreaker, prefetch, ratelimit, response_cache, singleflight, streamhub, upload, upstream
 
 try:
     import config
@@ -20,6 +23,12 @@ except:
 
 logger = logging.getLogger(__name__)
 USER_AGENT = 'Naumanni/{}'.format(naumanni.VERSION)
+FILTER_HANDLER_PREFIX = 'on_filter_'
+# collect_statusでstats()を集めるcomponent
+STATUS_COMPONENTS = (
+    'upstream_pool', 'rate_limiter', 'circuit_breakers', 'response_cache', 'single_flight', 'prefetcher',
+    'upload_budget', 'status_content_cache', 'stream_hub', 'websocket_deflate',
+)
 
 
 class NaumanniApp(object):
@@ -35,8 +44,10 @@ class NaumanniApp(object):
     def __init__(self, debug=False):
         self.debug = debug
         self.config = config
+        logger.info('JSON codec: %s', jsoncodec.name)
         self.root_path = os.path.abspath(os.path.join(naumanni.__file__, os.path.pardir, os.path.pardir))
         self.plugins = self.load_plugins()
+        self.filter_keys = self._collect_filter_keys()
 
     def load_plugins(self):
         assert not hasattr(self, 'plugins')
@@ -47,6 +58,16 @@ class NaumanniApp(object):
             logger.info('Load plugin: %s', plugin.id)
         return plugins
 
+    def _collect_filter_keys(self):
+        """on_filter_*を持っているpluginがいるentityのkeyを返す"""
+        keys = set()
+        for plugin in self.plugins.values():
+            for name in dir(plugin):
+                if name.startswith(FILTER_HANDLER_PREFIX) and callable(getattr(plugin, name)):
+                    keys.add(name[len(FILTER_HANDLER_PREFIX):])
+        logger.info('Filtered entities: %s', ', '.join(sorted(keys)) or '(none)')
+        return frozenset(keys)
+
     async def setup(self, task_id):
         """runloop前の最後のセットアップ"""
         self.task_id = task_id
@@ -59,6 +80,73 @@ class NaumanniApp(object):
             (host, port), db=db, loop=asyncio.get_event_loop()
         )
 
+        self.rate_limiter = ratelimit.RateLimitTracker(
+            self,
+            reserve_ratio=getattr(self.config, 'ratelimit_reserve_ratio', ratelimit.DEFAULT_RESERVE_RATIO),
+            max_queue_wait=getattr(self.config, 'ratelimit_max_queue_wait', ratelimit.DEFAULT_MAX_QUEUE_WAIT),
+        )
+        self.circuit_breakers = circuitbreaker.CircuitBreakerRegistry(
+            failure_threshold=getattr(
+                self.config, 'circuit_failure_threshold', circuitbreaker.DEFAULT_FAILURE_THRESHOLD),
+            recovery_timeout=getattr(
+                self.config, 'circuit_recovery_timeout', circuitbreaker.DEFAULT_RECOVERY_TIMEOUT),
+            max_in_flight=getattr(self.config, 'circuit_max_in_flight', circuitbreaker.DEFAULT_MAX_IN_FLIGHT),
+            max_hosts=getattr(self.config, 'circuit_max_hosts', circuitbreaker.DEFAULT_MAX_HOSTS),
+        )
+
+        # forkした後のioloopでpoolを作る
+        self.upstream_pool = upstream.UpstreamClientPool(
+            max_clients=getattr(self.config, 'upstream_max_clients', upstream.DEFAULT_MAX_CLIENTS),
+            max_clients_per_host=getattr(
+                self.config, 'upstream_max_clients_per_host', upstream.DEFAULT_MAX_CLIENTS_PER_HOST),
+            idle_timeout=getattr(self.config, 'upstream_idle_timeout', upstream.DEFAULT_IDLE_TIMEOUT),
+            max_hosts=getattr(self.config, 'upstream_max_hosts', upstream.DEFAULT_MAX_HOSTS),
+            rate_limiter=self.rate_limiter,
+            circuit_breakers=self.circuit_breakers,
+            connect_timeout=getattr(self.config, 'upstream_connect_timeout', upstream.DEFAULT_CONNECT_TIMEOUT),
+            request_timeout=getattr(self.config, 'upstream_request_timeout', upstream.DEFAULT_REQUEST_TIMEOUT),
+        )
+        self.response_cache = response_cache.TokenResponseCache(
+            self,
+            maxsize=getattr(self.config, 'response_cache_size', response_cache.DEFAULT_LOCAL_CACHE_SIZE),
+        )
+        self.single_flight = singleflight.SingleFlight(
+            self,
+            use_redis=getattr(self.config, 'singleflight_use_redis', False),
+            lock_timeout=getattr(self.config, 'singleflight_lock_timeout', singleflight.DEFAULT_LOCK_TIMEOUT),
+        )
+        self.stream_hub = streamhub.StreamHub(
+            self,
+            idle_timeout=getattr(self.config, 'stream_idle_timeout', streamhub.DEFAULT_IDLE_TIMEOUT),
+            share=getattr(self.config, 'stream_share_enabled', False),
+            cluster=getattr(self.config, 'stream_cluster_enabled', False),
+            lock_timeout=getattr(self.config, 'stream_owner_lock_timeout', streamhub.DEFAULT_OWNER_LOCK_TIMEOUT),
+            batch_window=getattr(self.config, 'websocket_batch_window', streamhub.DEFAULT_BATCH_WINDOW),
+            batch_max_events=getattr(self.config, 'websocket_batch_max_events', streamhub.DEFAULT_BATCH_MAX_EVENTS),
+            service_tokens=getattr(self.config, 'stream_service_tokens', None),
+        )
+        self.websocket_deflate = wsdeflate.WebsocketDeflate(
+            client_options=wsdeflate.get_compression_options(self.config, 'websocket_compression'),
+            upstream_options=wsdeflate.get_compression_options(self.config, 'websocket_upstream_compression'),
+        )
+        self.upload_budget = upload.UploadBudget(
+            max_bytes=getattr(self.config, 'upload_max_in_flight_bytes', upload.DEFAULT_MAX_IN_FLIGHT_BYTES),
+        )
+        # plainContent, urlsのcacheはmodelから使うのでprocessで1つ
+        self.status_content_cache = mastodon_models.content_cache
+        self.status_content_cache.maxsize = getattr(
+            self.config, 'status_content_cache_size', mastodon_models.DEFAULT_CONTENT_CACHE_SIZE)
+        self.prefetcher = None
+        if getattr(self.config, 'prefetch_enabled', False):
+            self.prefetcher = prefetch.Prefetcher(
+                self,
+                ttl=getattr(self.config, 'prefetch_ttl', prefetch.DEFAULT_TTL),
+                maxsize=getattr(self.config, 'prefetch_cache_size', prefetch.DEFAULT_CACHE_SIZE),
+                max_in_flight=getattr(self.config, 'prefetch_max_in_flight', prefetch.DEFAULT_MAX_IN_FLIGHT),
+                budget_ratio=getattr(self.config, 'prefetch_budget_ratio', prefetch.DEFAULT_BUDGET_RATIO),
+                max_wait=getattr(self.config, 'prefetch_max_wait', prefetch.DEFAULT_MAX_WAIT),
+            )
+
     def emit(self, event, **kwargs):
         rv = {}
         _result_hook = kwargs.pop('_result_hook', None)
@@ -88,16 +176,51 @@ class NaumanniApp(object):
 
         return rv
 
+    # entity filter
+    def get_filtered_keys(self, schema):
+        """schemaのentityのうち、filterするpluginがいるもののkeyを返す"""
+        return get_entity_keys(schema) & self.filter_keys
+
+    async def filter_entities(self, entities):
+        """normalizeされたentitiesにpluginのfilterをかける"""
+        for key in list(entities.keys()):
+            if key not in self.filter_keys:
+                continue
+
+            def _result_hook(result, kwargs):
+                kwargs['objects'] = entities[key] = result
+                return kwargs
+
+            await self.emit_async(
+                'filter-{}'.format(key),
+                objects=entities[key], entities=entities,
+                _result_hook=_result_hook)
+
     # redis
     def get_async_redis(self):
         return self._async_redis_pool.get()
 
+    async def create_async_redis(self):
+        """poolに返せない、pub/sub用の接続を作る. 使い終わったらcloseすること"""
+        host, port, db = self.config.redis
+        return await aioredis.create_redis((host, port), db=db, loop=asyncio.get_event_loop())
+
+    # status
+    def collect_status(self):
+        """このプロセスのapp側の状態を返す"""
+        status = {}
+        for name in STATUS_COMPONENTS:
+            component = getattr(self, name, None)
+            if component is not None:
+                status.update(component.stats())
+        return status
+
     # utility functions
     async def crawl_url(self, url_or_request):
         """指定されたURLを撮ってきて返す"""
-        # TODO: crawler pool的な感じにする
-        response = await httpclient.AsyncHTTPClient().fetch(
-            url_or_request, follow_redirects=False, raise_error=False, user_agent=USER_AGENT)
+        response = await self.upstream_pool.fetch(
+            url_or_request, follow_redirects=False, raise_error=False, user_agent=USER_AGENT,
+            priority=ratelimit.PRIORITY_LOW)
         return response
 
 
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""遅い/死んでいるMastodonインスタンスのためのhost毎のcircuit breaker."""
+import collections
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RECOVERY_TIMEOUT = 30.0
+DEFAULT_MAX_IN_FLIGHT = 50
+DEFAULT_MAX_HOSTS = 1024
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """1ホスト分のcircuit breaker
+
+    failure_threshold回続けて失敗したらopenになり、recovery_timeout秒の間はすぐCircuitOpenを投げる.
+    その後はhalf-openになって1つだけrequestを通し、成功すればclosedに戻る.
+    同時にmax_in_flight以上のrequestが出ていてもCircuitOpenを投げる.
+    """
+    __slots__ = (
+        'host', 'failure_threshold', 'recovery_timeout', 'max_in_flight',
+        'state', 'failures', 'opened_at', 'in_flight', '_trial_in_flight',
+    )
+
+    def __init__(self, host, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 recovery_timeout=DEFAULT_RECOVERY_TIMEOUT, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.max_in_flight = max_in_flight
+
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.in_flight = 0
+        self._trial_in_flight = False
+
+    def is_available(self):
+        """今requestを出せるか. acquireと違って状態は変えない"""
+        if self.state == STATE_OPEN:
+            return time.time() - self.opened_at >= self.recovery_timeout
+        if self.state == STATE_HALF_OPEN:
+            return not self._trial_in_flight
+        return self.in_flight < self.max_in_flight
+
+    def acquire(self):
+        """requestを出す前に呼ぶ. 出せなければCircuitOpen"""
+        if self.state == STATE_OPEN:
+            if time.time() - self.opened_at < self.recovery_timeout:
+                raise CircuitOpen('circuit for {} is open'.format(self.host))
+            self.state = STATE_HALF_OPEN
+            self._trial_in_flight = False
+
+        if self.state == STATE_HALF_OPEN:
+            if self._trial_in_flight:
+                raise CircuitOpen('circuit for {} is half-open'.format(self.host))
+            self._trial_in_flight = True
+        elif self.in_flight >= self.max_in_flight:
+            raise CircuitOpen('too many requests in flight to {}'.format(self.host))
+
+        self.in_flight += 1
+
+    def release(self, success):
+        """requestが終わったら呼ぶ
+
+        :param success: Noneなら、こちらの都合で中断したrequestなので成功にも失敗にも数えない
+        """
+        self.in_flight -= 1
+
+        if success is None:
+            # half-openのtrialだったなら、次のrequestにtrialさせる
+            self._trial_in_flight = False
+            return
+        if success:
+            if self.state != STATE_CLOSED:
+                logger.info('circuit closed: %s', self.host)
+            self.state = STATE_CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+            return
+
+        self.failures += 1
+        if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != STATE_OPEN:
+                logger.warning('circuit opened: %s (%d failures)', self.host, self.failures)
+            self.state = STATE_OPEN
+            self.opened_at = time.time()
+            self._trial_in_flight = False
+
+    def is_idle(self):
+        """捨てて作り直しても同じ状態か"""
+        return self.state == STATE_CLOSED and not self.failures and not self.in_flight
+
+
+class CircuitBreakerRegistry(object):
+    """hostごとのCircuitBreakerを持つ
+
+    :param int max_hosts: 持っておくCircuitBreakerの数. 超えたら使われていないものから捨てる
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, recovery_timeout=DEFAULT_RECOVERY_TIMEOUT,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_hosts=DEFAULT_MAX_HOSTS):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.max_in_flight = max_in_flight
+        self.max_hosts = max_hosts
+        self._breakers = collections.OrderedDict()
+        self.rejected = 0
+        self.evictions = 0
+
+    def get(self, host):
+        breaker = self._breakers.get(host)
+        if breaker is not None:
+            self._breakers.move_to_end(host)
+            return breaker
+
+        if len(self._breakers) >= self.max_hosts:
+            self._evict_least_used()
+        breaker = self._breakers[host] = CircuitBreaker(
+            host, self.failure_threshold, self.recovery_timeout, self.max_in_flight)
+        return breaker
+
+    def _evict_least_used(self):
+        """一番使われていないCircuitBreakerを捨てる
+
+        状態を持っていないものを優先する. request中のものはreleaseされるので捨てない
+        """
+        candidates = [breaker for breaker in self._breakers.values() if not breaker.in_flight]
+        if not candidates:
+            return
+        breaker = next((breaker for breaker in candidates if breaker.is_idle()), candidates[0])
+        del self._breakers[breaker.host]
+        self.evictions += 1
+
+    def acquire(self, host):
+        breaker = self.get(host)
+        try:
+            breaker.acquire()
+        except CircuitOpen:
+            self.rejected += 1
+            raise
+        return breaker
+
+    def stats(self):
+        return {
+            'circuit.open': sum(1 for breaker in self._breakers.values() if breaker.state != STATE_CLOSED),
+            'circuit.rejected': self.rejected,
+            'circuit.tracked': len(self._breakers),
+            'circuit.evictions': self.evictions,
+            'circuit.hosts': {
+                host: {'state': breaker.state, 'failures': breaker.failures, 'in_flight': breaker.in_flight}
+                for host, breaker in self._breakers.items()
+                if breaker.state != STATE_CLOSED or breaker.in_flight
+            },
+        }
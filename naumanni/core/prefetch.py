@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""timelineの次のpageを先読みしておく.
+
+clientはLinkヘッダのrel="next"を辿ってscrollするので、1ページ返したら次のページをbackgroundで取って
+filterまで済ませ、token毎に短い間だけ置いておく.
+"""
+import logging
+from urllib.parse import urlsplit
+
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+from ..lru import LRUCache
+from ..utils import normalize_url
+from .ratelimit import PRIORITY_LOW, get_token_id
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_TTL = 30.0
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_MAX_IN_FLIGHT = 10
+DEFAULT_BUDGET_RATIO = 0.5
+# 先読み中のresponseを待つ最大秒数. 先読みはrate limitで後回しにされうる
+DEFAULT_MAX_WAIT = 1.0
+
+
+class Prefetcher(object):
+    """次のpageの先読み
+
+    :param NaumanniApp app:
+    :param float ttl: 先読みしたresponseを置いておく秒数
+    :param int maxsize: 置いておく最大件数
+    :param int max_in_flight: 同時に先読みする最大数
+    :param float budget_ratio: rate limitの残りがこの割合を切っていたら先読みしない
+    :param float max_wait: getが先読み中のresponseを待つ最大秒数
+    """
+
+    def __init__(self, app, ttl=DEFAULT_TTL, maxsize=DEFAULT_CACHE_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 budget_ratio=DEFAULT_BUDGET_RATIO, max_wait=DEFAULT_MAX_WAIT):
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.budget_ratio = budget_ratio
+        self.max_wait = max_wait
+        self._cache = LRUCache(maxsize, ttl=ttl)
+        self._in_flight = {}
+
+        self.scheduled = 0
+        self.skipped = 0
+        self.used = 0
+        self.wait_timeouts = 0
+
+    async def get(self, authorization, url, variant=None):
+        """先読みしたresponse(code, reason, headers, body)を返す. なければNone
+
+        先読み中ならmax_wait秒まで終わるのを待つ. 先読みは優先度が低いので、待ちきれなければNoneを返して
+        clientのrequestは自分で取りに行かせる. 1回使ったら捨てる. variantはscheduleした時と同じものを渡す
+        """
+        key = _get_key(authorization, url, variant)
+        future = self._in_flight.get(key)
+        if future is not None:
+            try:
+                await gen.with_timeout(ioloop.IOLoop.current().time() + self.max_wait, future)
+            except gen.TimeoutError:
+                self.wait_timeouts += 1
+                return None
+
+        result = self._cache.get(key)
+        if result is None:
+            return None
+        self._cache.pop(key)
+        self.used += 1
+        return result
+
+    def schedule(self, authorization, url, headers, finalize, *args, variant=None):
+        """urlをbackgroundで取りに行く
+
+        200が返ってきたら `finalize(response, *args)` でclientに返す(code, reason, headers, body)を作る.
+        budgetが足りなければ何もせずFalseを返す
+
+        :param str variant: 同じurlでもbodyの形が違うresponseを分けて覚えるためのkey
+        """
+        key = _get_key(authorization, url, variant)
+        if key in self._in_flight or key in self._cache:
+            return False
+
+        if len(self._in_flight) >= self.max_in_flight or not self._has_budget(url, authorization):
+            self.skipped += 1
+            return False
+
+        self.scheduled += 1
+        future = self._in_flight[key] = Future()
+        ioloop.IOLoop.current().spawn_callback(self._prefetch, key, future, url, headers, finalize, args)
+        return True
+
+    async def _prefetch(self, key, future, url, headers, finalize, args):
+        try:
+            response = await self.app.upstream_pool.fetch(
+                url, headers=headers, raise_error=False, follow_redirects=False, priority=PRIORITY_LOW)
+            if response.code == 200:
+                result = await finalize(response, *args)
+                if result is not None:
+                    self._cache.set(key, result)
+        except Exception:
+            logger.exception('prefetch failed: %s', url)
+        finally:
+            del self._in_flight[key]
+            future.set_result(None)
+
+    def _has_budget(self, url, authorization):
+        rate_limiter = getattr(self.app, 'rate_limiter', None)
+        if rate_limiter is None:
+            return True
+        ratio = rate_limiter.get_remaining_ratio(urlsplit(url).netloc.lower(), authorization)
+        return ratio is None or ratio > self.budget_ratio
+
+    def stats(self):
+        status = self._cache.stats('prefetch.cache')
+        status.update({
+            'prefetch.in_flight': len(self._in_flight),
+            'prefetch.scheduled': self.scheduled,
+            'prefetch.skipped': self.skipped,
+            'prefetch.used': self.used,
+            'prefetch.wait_timeouts': self.wait_timeouts,
+        })
+        return status
+
+
+def _get_key(authorization, url, variant=None):
+    return get_token_id(authorization), normalize_url(url), variant
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""MastodonのX-Ratelimit-*を見て、優先度の低いrequestを後回しにする."""
+import hashlib
+import logging
+import time
+
+import dateutil.parser
+from tornado import gen, ioloop
+
+from .. import jsoncodec
+from ..lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+REDIS_RATELIMIT_KEY = 'naumanni:ratelimit:{}:{}'
+
+PRIORITY_HIGH = 0  # clientからのrequest
+PRIORITY_LOW = 1  # prefetchやpluginのcrawl_url
+
+DEFAULT_RESERVE_RATIO = 0.2
+DEFAULT_MAX_QUEUE_WAIT = 10.0
+MAX_TRACKED_BUDGETS = 10000
+REDIS_REFRESH_INTERVAL = 1.0
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimitBudget(object):
+    __slots__ = ('limit', 'remaining', 'reset', 'updated')
+
+    def __init__(self, limit, remaining, reset, updated=None):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.updated = updated or time.time()
+
+    @classmethod
+    def from_headers(cls, headers):
+        try:
+            limit = int(headers['X-Ratelimit-Limit'])
+            remaining = int(headers['X-Ratelimit-Remaining'])
+            reset = dateutil.parser.parse(headers['X-Ratelimit-Reset']).timestamp()
+        except (KeyError, ValueError, OverflowError):
+            return None
+        return cls(limit, remaining, reset)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**jsoncodec.loads(data))
+
+    def to_json(self):
+        return jsoncodec.dumps({
+            'limit': self.limit, 'remaining': self.remaining, 'reset': self.reset, 'updated': self.updated
+        })
+
+
+class RateLimitTracker(object):
+    """host, token毎のrate limitの残りを覚えておく
+
+    残りがreserve_ratioを切ったら、PRIORITY_LOWのrequestはresetまで待たせる.
+    待ち時間がmax_queue_waitより長ければ、RateLimitExceededで捨てる.
+    残りはredisに保存して、forkした他のworkerと共有する. 他のworkerはREDIS_REFRESH_INTERVAL毎にしか読まないので、
+    保存するのはresetが変わった時とreserveに入った(出た)時の他は、keyごとにREDIS_REFRESH_INTERVALに1回にする.
+
+    :param NaumanniApp app:
+    :param float reserve_ratio: clientからのrequestのために残しておく割合
+    :param float max_queue_wait: PRIORITY_LOWのrequestを待たせる最大秒数
+    """
+
+    def __init__(self, app, reserve_ratio=DEFAULT_RESERVE_RATIO, max_queue_wait=DEFAULT_MAX_QUEUE_WAIT):
+        self.app = app
+        self.reserve_ratio = reserve_ratio
+        self.max_queue_wait = max_queue_wait
+        self._budgets = LRUCache(MAX_TRACKED_BUDGETS)
+        # 最後にredisに保存した(time, budget)
+        self._saved = LRUCache(MAX_TRACKED_BUDGETS)
+
+        self.queued = 0
+        self.shed = 0
+        self.saves = 0
+
+    async def acquire(self, host, authorization, priority=PRIORITY_HIGH):
+        """requestを1つ出してよいか. PRIORITY_LOWは待たされるか、RateLimitExceededになる"""
+        key = (host, get_token_id(authorization))
+        budget = self._budgets.get(key)
+        if priority != PRIORITY_HIGH:
+            if budget is None or budget.updated + REDIS_REFRESH_INTERVAL < time.time():
+                budget = await self._load(key) or budget
+
+            if budget is not None and self._is_reserved(budget):
+                wait = budget.reset - time.time()
+                if wait > self.max_queue_wait:
+                    self.shed += 1
+                    raise RateLimitExceeded('{} reaches rate limit until {}'.format(host, budget.reset))
+                if wait > 0:
+                    self.queued += 1
+                    await gen.sleep(wait)
+                budget = None
+
+        if budget is not None and budget.remaining > 0:
+            # 次のresponseが来るまでの見積もり
+            budget.remaining -= 1
+
+    def get_remaining_ratio(self, host, authorization):
+        """rate limitの残りの割合. 分からなければNone"""
+        budget = self._budgets.get((host, get_token_id(authorization)), count=False)
+        if budget is None or not budget.limit:
+            return None
+        return budget.remaining / budget.limit
+
+    def update(self, host, authorization, headers):
+        """responseのheaderで残りを更新する"""
+        budget = RateLimitBudget.from_headers(headers)
+        if budget is None:
+            return
+
+        key = (host, get_token_id(authorization))
+        ttl = budget.reset - time.time()
+        if ttl <= 0:
+            return
+        self._budgets.set(key, budget, ttl=ttl)
+        if self._should_save(key, budget):
+            self._saved.set(key, (time.time(), budget), ttl=ttl)
+            self.saves += 1
+            ioloop.IOLoop.current().spawn_callback(self._save, key, budget, ttl)
+
+    def _should_save(self, key, budget):
+        saved = self._saved.get(key, count=False)
+        if saved is None:
+            return True
+        saved_at, saved_budget = saved
+        if saved_budget.reset != budget.reset:
+            # 次のwindowになった
+            return True
+        if self._is_reserved(saved_budget) != self._is_reserved(budget):
+            # 他のworkerのPRIORITY_LOWをすぐ止める(再開させる)
+            return True
+        return saved_at + REDIS_REFRESH_INTERVAL <= time.time()
+
+    def _is_reserved(self, budget):
+        return budget.remaining <= budget.limit * self.reserve_ratio
+
+    async def _load(self, key):
+        try:
+            async with self.app.get_async_redis() as redis:
+                data = await redis.get(REDIS_RATELIMIT_KEY.format(*key))
+        except Exception as exc:
+            logger.warning('ratelimit load failed: %r', exc)
+            return None
+        if not data:
+            return None
+
+        budget = RateLimitBudget.from_json(data)
+        ttl = budget.reset - time.time()
+        if ttl <= 0:
+            return None
+        budget.updated = time.time()
+        self._budgets.set(key, budget, ttl=ttl)
+        return budget
+
+    async def _save(self, key, budget, ttl):
+        try:
+            async with self.app.get_async_redis() as redis:
+                await redis.set(REDIS_RATELIMIT_KEY.format(*key), budget.to_json(), pexpire=int(ttl * 1000))
+        except Exception as exc:
+            logger.warning('ratelimit save failed: %r', exc)
+
+    def stats(self):
+        # hostごとに、一番残りが少ないtokenを出す
+        hosts = {}
+        for (host, token), budget in self._budgets.items():
+            lowest = hosts.get(host)
+            if lowest is None or budget.remaining < lowest['remaining']:
+                hosts[host] = {
+                    'limit': budget.limit, 'remaining': budget.remaining, 'reset': budget.reset, 'token': token,
+                }
+
+        return {
+            'ratelimit.tracked': len(self._budgets),
+            'ratelimit.queued': self.queued,
+            'ratelimit.shed': self.shed,
+            'ratelimit.saves': self.saves,
+            'ratelimit.hosts': hosts,
+        }
+
+
+def get_token_id(authorization):
+    """tokenそのものは保存したくないのでhashにする"""
+    if not authorization:
+        return ''
+    return hashlib.sha1(authorization.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""token毎のAPI responseのcache.
+
+プロセス内のLRUと、redisの2段になっていて、redisの方はworkerをまたいで共有する. filter済みのbodyを
+保存するので、hitすればupstreamへのrequestもpluginのfilterも省ける.
+public timelineでもblockやmuteで中身がユーザー毎に変わるので、別のtokenとは共有しない.
+"""
+import logging
+import time
+
+from .. import jsoncodec
+from ..lru import LRUCache
+from ..utils import normalize_url
+
+
+logger = logging.getLogger(__name__)
+REDIS_RESPONSE_CACHE_KEY = 'naumanni:response_cache:{}'
+DEFAULT_LOCAL_CACHE_SIZE = 256
+
+
+class TokenResponseCache(object):
+    """filter済みresponseを、scope(tokenのhash)毎に覚えるcache
+
+    :param NaumanniApp app:
+    :param int maxsize: プロセス内LRUの最大件数
+    """
+
+    def __init__(self, app, maxsize=DEFAULT_LOCAL_CACHE_SIZE):
+        self.app = app
+        self.local = LRUCache(maxsize)
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    async def get(self, scope, url, variant=None):
+        """cacheされた(headers, body)を返す. なければNone
+
+        :param str scope: tokenのhash
+        :param str variant: 同じurlでもbodyの形が違うresponseを分けて覚えるためのkey
+        """
+        key = _get_key(scope, url, variant)
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+
+        try:
+            async with self.app.get_async_redis() as redis:
+                data = await redis.get(REDIS_RESPONSE_CACHE_KEY.format(key))
+        except Exception as exc:
+            logger.warning('response cache get failed: %r', exc)
+            return None
+
+        if not data:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+
+        expires, headers, body = _decode_entry(data)
+        entry = (headers, body)
+        ttl = expires - time.time()
+        if ttl > 0:
+            self.local.set(key, entry, ttl=ttl)
+        return entry
+
+    async def set(self, scope, url, headers, body, ttl, variant=None):
+        """filter済みのresponseをttl秒cacheする"""
+        key = _get_key(scope, url, variant)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.local.set(key, (headers, body), ttl=ttl)
+
+        try:
+            async with self.app.get_async_redis() as redis:
+                await redis.set(
+                    REDIS_RESPONSE_CACHE_KEY.format(key),
+                    _encode_entry(time.time() + ttl, headers, body),
+                    pexpire=int(ttl * 1000)
+                )
+        except Exception as exc:
+            logger.warning('response cache set failed: %r', exc)
+
+    def stats(self):
+        status = self.local.stats('response_cache.local')
+        status.update({
+            'response_cache.redis.hits': self.redis_hits,
+            'response_cache.redis.misses': self.redis_misses,
+        })
+        return status
+
+
+def _get_key(scope, url, variant):
+    key = '{}:{}'.format(scope, normalize_url(url))
+    if variant is not None:
+        key = '{}#{}'.format(key, variant)
+    return key
+
+
+def _encode_entry(expires, headers, body):
+    return jsoncodec.dumps({'expires': expires, 'headers': headers}) + b'\n' + body
+
+
+def _decode_entry(data):
+    meta, body = data.split(b'\n', 1)
+    meta = jsoncodec.loads(meta)
+    return meta['expires'], meta['headers'], body
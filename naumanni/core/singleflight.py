@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""同じupstream requestが同時に来たら、1回の呼び出しで済ませる(single-flight)."""
+import asyncio
+import logging
+import os
+import time
+
+from tornado import gen
+
+from .. import jsoncodec
+
+
+logger = logging.getLogger(__name__)
+REDIS_SINGLEFLIGHT_LOCK_KEY = 'naumanni:singleflight:lock:{}'
+REDIS_SINGLEFLIGHT_RESULT_KEY = 'naumanni:singleflight:result:{}'
+DEFAULT_LOCK_TIMEOUT = 10.0
+RESULT_TTL = 2.0
+POLL_INTERVAL = 0.05
+
+# tokenが一致するときだけlockを消す
+RELEASE_LOCK_SCRIPT = """\
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight(object):
+    """keyが同じ呼び出しが実行中なら、その結果を待って共有する
+
+    funcは(code, reason, headers, body)か、共有できない場合はNoneを返すこと.
+    leaderが失敗するかNoneを返したら、followerはNoneを受け取るので自分で処理する.
+    funcはleaderとは別のtaskで走らせるので、leaderがcancelされてもfollowerは結果を受け取れる.
+    redisが使えなければ、workerの中だけでまとめる.
+
+    :param NaumanniApp app:
+    :param bool use_redis: redisのlockで、forkした他のworkerとも共有する
+    :param float lock_timeout: redis lockの有効期限
+    """
+
+    def __init__(self, app, use_redis=False, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        self.app = app
+        self.use_redis = use_redis
+        self.lock_timeout = lock_timeout
+        self._calls = {}
+
+        self.leaders = 0
+        self.followers = 0
+        self.remote_followers = 0
+
+    async def do(self, key, func, *args):
+        future = self._calls.get(key)
+        if future is not None:
+            self.followers += 1
+            try:
+                return await asyncio.shield(future)
+            except Exception:
+                return None
+
+        self.leaders += 1
+        future = self._calls[key] = asyncio.ensure_future(self._call(key, func, *args))
+        return await asyncio.shield(future)
+
+    async def _call(self, key, func, *args):
+        try:
+            if self.use_redis:
+                return await self._do_with_redis(key, func, *args)
+            return await func(*args)
+        finally:
+            del self._calls[key]
+
+    async def _do_with_redis(self, key, func, *args):
+        lock_key = REDIS_SINGLEFLIGHT_LOCK_KEY.format(key)
+        token = '{}:{}'.format(os.getpid(), time.time())
+
+        try:
+            async with self.app.get_async_redis() as redis:
+                acquired = await redis.set(
+                    lock_key, token, pexpire=int(self.lock_timeout * 1000), exist=redis.SET_IF_NOT_EXIST)
+        except Exception as exc:
+            logger.warning('singleflight lock failed: %r', exc)
+            return await func(*args)
+        if not acquired:
+            # 他のworkerが取りに行っているので、結果を待つ
+            result = await self._wait_remote_result(key)
+            if result is not None:
+                self.remote_followers += 1
+                return result
+            return await func(*args)
+
+        try:
+            result = await func(*args)
+            if result is not None:
+                try:
+                    async with self.app.get_async_redis() as redis:
+                        await redis.set(
+                            REDIS_SINGLEFLIGHT_RESULT_KEY.format(key), _encode_result(result),
+                            pexpire=int(RESULT_TTL * 1000))
+                except Exception as exc:
+                    logger.warning('singleflight result store failed: %r', exc)
+            return result
+        finally:
+            try:
+                async with self.app.get_async_redis() as redis:
+                    await redis.eval(RELEASE_LOCK_SCRIPT, keys=[lock_key], args=[token])
+            except Exception as exc:
+                # lockはlock_timeoutで切れる
+                logger.warning('singleflight unlock failed: %r', exc)
+
+    async def _wait_remote_result(self, key):
+        lock_key = REDIS_SINGLEFLIGHT_LOCK_KEY.format(key)
+        result_key = REDIS_SINGLEFLIGHT_RESULT_KEY.format(key)
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            try:
+                async with self.app.get_async_redis() as redis:
+                    data = await redis.get(result_key)
+                    if data:
+                        return _decode_result(data)
+                    if not await redis.exists(lock_key):
+                        # 結果を置かずにlockが外れた
+                        return None
+            except Exception as exc:
+                logger.warning('singleflight poll failed: %r', exc)
+                return None
+            await gen.sleep(POLL_INTERVAL)
+        return None
+
+    def stats(self):
+        return {
+            'singleflight.in_flight': len(self._calls),
+            'singleflight.leaders': self.leaders,
+            'singleflight.followers': self.followers,
+            'singleflight.remote_followers': self.remote_followers,
+        }
+
+
+def _encode_result(result):
+    code, reason, headers, body = result
+    meta = jsoncodec.dumps({'code': code, 'reason': reason, 'headers': headers})
+    return meta + b'\n' + body
+
+
+def _decode_result(data):
+    meta, body = data.split(b'\n', 1)
+    meta = jsoncodec.loads(meta)
+    return meta['code'], meta['reason'], meta['headers'], body
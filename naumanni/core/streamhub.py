@@ -0,0 +1,623 @@
+# -*- coding: utf-8 -*-
+"""同じMastodonのstreamを見ているclientで、upstreamのwebsocketを共有する."""
+import logging
+import os
+import socket
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from tornado import gen, httpclient, ioloop, queues
+
+from .. import jsoncodec, msgpackcodec, wsdeflate
+from .circuitbreaker import CircuitOpen
+from .singleflight import RELEASE_LOCK_SCRIPT
+
+
+logger = logging.getLogger(__name__)
+# tokenがなければ誰が見ても同じmessageが来るstream. userなどはtoken毎なので共有しない
+SHARED_STREAMS = frozenset(['public', 'public:local', 'hashtag', 'hashtag:local'])
+# subscriberがいなくなってからupstreamを閉じるまでの秒数
+DEFAULT_IDLE_TIMEOUT = 30.0
+# dispatch中に溜めておけるserverからのmessageの数. 一杯になったらserverから読むのを止める
+MAX_PENDING_MESSAGES = 32
+# batchを指定したsubscriberがいる時に、messageを集める秒数と数
+DEFAULT_BATCH_WINDOW = 0.15
+DEFAULT_BATCH_MAX_EVENTS = 50
+
+# cluster mode
+REDIS_STREAM_OWNER_KEY = 'naumanni:stream:owner:{}'
+REDIS_STREAM_CHANNEL = 'naumanni:stream:{}'
+# 各workerのsubscriberが受け取るvariant. memberは[worker_id, mode, format], scoreは有効期限
+REDIS_STREAM_VARIANTS_KEY = 'naumanni:stream:variants:{}'
+DEFAULT_OWNER_LOCK_TIMEOUT = 10.0
+# tokenが一致するときだけlockを延ばす
+REFRESH_LOCK_SCRIPT = """\
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+# channelに流すframeのenvelope. bytesのframeを入れるのでMessagePackがあればそちらを使う
+_envelope_codec = msgpackcodec if msgpackcodec.available else jsoncodec
+
+
+def get_stream_key(request_url):
+    """共有できるstreamなら(host, path, stream, tag)を返す. できなければNone
+
+    access_tokenを付けたclientには、Mastodonがそのuserのblockやmuteでfilterしたmessageを流すので共有しない
+    """
+    t = urlsplit(request_url)
+    params = dict(parse_qsl(t.query))
+    stream = params.get('stream')
+    if stream not in SHARED_STREAMS or params.get('access_token'):
+        return None
+    return t.netloc.lower(), t.path, stream, params.get('tag', '').lower()
+
+
+class SharedStream(object):
+    """upstreamのwebsocket 1本と、それを見ているsubscriber
+
+    serverからのmessageは、encode中に届いた分をまとめて `encode(app, raws, variants)` でframeにして、
+    subscriberの `write_frames(frames, binary, events)` に流す. upstreamが閉じたら `on_stream_closed()` を呼ぶ.
+
+    cluster modeでは、redisのlockを取ったworkerだけがupstreamにつないでencodeし、
+    frameをchannelにpublishする. 他のworkerはchannelから受け取ったframeを流す.
+    各workerは自分のsubscriberのvariantをredisに書いておき、ownerはそのvariantのframeだけを作る.
+
+    共有するstreamは、service tokenがあればそれで、なければtokenなしでupstreamにつなぐ.
+    subscriberのtokenは使わない. 共有しないstreamは、subscriberのrequest_urlのままつなぐ.
+
+    :param key: get_stream_keyの結果. 共有しないstreamならNone
+    """
+
+    def __init__(self, hub, key, request_url, encode):
+        self.hub = hub
+        self.key = key
+        self.request_url = request_url
+        self.encode = encode
+        self.subscribers = set()
+        self.peer = None
+        self.started = False
+        self.closed = False
+        self._starting = None
+        self._idle_timer = None
+        # cluster mode
+        self.owner = False
+        self._channel = None
+        self._lock_token = None
+        # redisに書いた自分のvariantと、ownerが読んだ全workerのvariant. 読めていなければNone
+        self._advertised = frozenset()
+        self.cluster_variants = None
+        # batchのsubscriberに流すまで集めている(events, {variant: (frames, binary)})
+        self._batch_chunks = []
+        self._batch_events = 0
+        self._batch_timer = None
+
+    @property
+    def shared(self):
+        return self.key is not None
+
+    @property
+    def clustered(self):
+        return self.shared and self.hub.cluster
+
+    @property
+    def batching(self):
+        """subscriberが全員batchなので、messageを集めてからencodeする
+
+        batchでないsubscriberを待たせないよう、1人でもいれば集めない. cluster modeでは他のworkerにいるかもしれない.
+        その時はdeliverがbatchのsubscriberの分だけframeを集める
+        """
+        return (self.hub.batch_window > 0 and not self.clustered and bool(self.subscribers) and
+                all(subscriber.stream_batch for subscriber in self.subscribers))
+
+    @property
+    def variants(self):
+        """このworkerのsubscriberが受け取るvariant"""
+        return frozenset(subscriber.stream_variant for subscriber in self.subscribers if not subscriber.closed)
+
+    @property
+    def name(self):
+        return ':'.join(self.key) if self.shared else 'private'
+
+    async def start(self, ping_interval=None):
+        """upstreamか、cluster modeならchannelにつなぐ. つないでいる途中なら、それを待つ"""
+        if self._starting is None:
+            self._starting = gen.convert_yielded(self._start(ping_interval))
+        await self._starting
+
+    async def _start(self, ping_interval):
+        if not self.clustered:
+            await self.connect(ping_interval)
+        else:
+            self._channel = await self.hub._subscribe_channel(REDIS_STREAM_CHANNEL.format(self.name))
+            ioloop.IOLoop.current().spawn_callback(self.relay_channel, self._channel)
+            await self._advertise()
+            await self._elect(ping_interval)
+            ioloop.IOLoop.current().spawn_callback(self.watch_owner, ping_interval)
+        self.started = True
+
+    async def connect(self, ping_interval=None):
+        host = urlsplit(self.request_url).netloc.lower()
+        breaker = self.hub.app.circuit_breakers.get(host)
+        if not breaker.is_available():
+            raise CircuitOpen('circuit for {} is {}'.format(breaker.host, breaker.state))
+        breaker.acquire()
+        try:
+            peer = await self._connect_peer(host, ping_interval)
+        except httpclient.HTTPClientError as e:
+            # 4xxならhostは生きている
+            breaker.release(e.code < 500)
+            raise
+        except Exception:
+            breaker.release(False)
+            raise
+        breaker.release(True)
+        self.hub.connects += 1
+        self.peer = peer
+        ioloop.IOLoop.current().spawn_callback(self.listen_peer)
+
+    async def _connect_peer(self, host, ping_interval):
+        token = self.hub.service_tokens.get(host) if self.shared else None
+        return await self._websocket_connect(self.request_url, token, ping_interval)
+
+    async def _websocket_connect(self, url, token, ping_interval):
+        # request_timeoutはhandshakeにだけかかる
+        config = self.hub.app.config
+        request = httpclient.HTTPRequest(
+            url,
+            headers={'Authorization': 'Bearer ' + token} if token is not None else None,
+            connect_timeout=getattr(config, 'upstream_connect_timeout', None),
+            request_timeout=getattr(config, 'upstream_request_timeout', None),
+        )
+        return await wsdeflate.websocket_connect(
+            request, self.hub.app.websocket_deflate.upstream, ping_interval=ping_interval)
+
+    async def listen_peer(self):
+        """閉じられるまで、server側wsのメッセージをlistenする"""
+        peer = self.peer
+        messages = queues.Queue(maxsize=MAX_PENDING_MESSAGES)
+        processing = gen.convert_yielded(self.process_peer_messages(messages))
+        while not self.closed and self.peer is peer:
+            raw = await peer.read_message()
+            if raw is None:
+                logger.info('server connection closed: %s', self.name)
+                break
+            await messages.put(raw)
+
+        # 溜まっているmessageを流してから閉じる
+        await messages.put(None)
+        await processing
+        if self.peer is peer:
+            self.close()
+
+    async def process_peer_messages(self, messages):
+        """queueのmessageをsubscriberに流す
+
+        encodeを待っている間に届いたmessageは、次にまとめて流す. Noneが来たら終わる
+        batchingなら、最初のmessageからbatch_window秒かbatch_max_events個まで集めてからencodeする
+        """
+        while True:
+            raw = await messages.get()
+            batch = []
+            deadline = None
+            if raw is not None and self.batching:
+                deadline = ioloop.IOLoop.current().time() + self.hub.batch_window
+            while raw is not None:
+                batch.append(raw)
+                if deadline is not None:
+                    if len(batch) >= self.hub.batch_max_events:
+                        break
+                    try:
+                        raw = await messages.get(timeout=deadline)
+                    except gen.TimeoutError:
+                        break
+                    continue
+                if messages.empty():
+                    break
+                raw = messages.get_nowait()
+
+            if batch and (self.subscribers or self.clustered):
+                try:
+                    await self.dispatch(batch, collected=deadline is not None)
+                except Exception:
+                    logger.exception('failed to pass %d messages', len(batch))
+            if raw is None:
+                return
+
+    async def dispatch(self, raws, collected=False):
+        if not self.clustered:
+            variants = {subscriber.stream_variant for subscriber in self.subscribers}
+            events, frames = await self.encode(self.hub.app, raws, variants)
+            self.deliver(events, frames, collected)
+            return
+
+        # 他のworkerのvariantが読めていなければ、全部のvariantを作る
+        variants = self.cluster_variants | self.variants if self.cluster_variants is not None else None
+        events, frames = await self.encode(self.hub.app, raws, variants)
+        self.deliver(events, frames)
+        envelope = {
+            'origin': self.hub.worker_id,
+            'events': events,
+            'frames': [[mode, response_format, binary, variant_frames]
+                       for (mode, response_format), (variant_frames, binary) in frames.items()],
+        }
+        async with self.hub.app.get_async_redis() as redis:
+            await redis.publish(REDIS_STREAM_CHANNEL.format(self.name), _envelope_codec.dumps(envelope))
+        self.hub.published += 1
+
+    def deliver(self, events, frames, collected=False):
+        """{variant: (frames, binary)}をsubscriberに流す. eventsは各frameのevent名
+
+        collectedでなければ、batchのsubscriberの分はbatch_window秒かbatch_max_events個まで集めてから流す
+        """
+        buffering = False
+        for subscriber in list(self.subscribers):
+            if subscriber.closed or subscriber.stream_variant not in frames:
+                continue
+            if subscriber.stream_batch and not collected and self.hub.batch_window > 0:
+                buffering = True
+                continue
+            variant_frames, binary = frames[subscriber.stream_variant]
+            subscriber.write_frames(variant_frames, binary, events)
+        if not buffering:
+            return
+
+        self._batch_chunks.append((events, frames))
+        self._batch_events += len(events)
+        if self._batch_events >= self.hub.batch_max_events:
+            self.flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = ioloop.IOLoop.current().call_later(self.hub.batch_window, self.flush_batch)
+
+    def flush_batch(self):
+        """deliverが集めたframeを、batchのsubscriberに流す"""
+        if self._batch_timer is not None:
+            ioloop.IOLoop.current().remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        chunks, self._batch_chunks = self._batch_chunks, []
+        self._batch_events = 0
+        if not chunks:
+            return
+
+        for subscriber in list(self.subscribers):
+            if subscriber.closed or not subscriber.stream_batch:
+                continue
+            batch_frames, batch_events, binary = [], [], False
+            for events, frames in chunks:
+                if subscriber.stream_variant in frames:
+                    variant_frames, binary = frames[subscriber.stream_variant]
+                    batch_frames.extend(variant_frames)
+                    batch_events.extend(events)
+            if batch_frames:
+                subscriber.write_frames(batch_frames, binary, batch_events)
+
+    # cluster mode
+    async def relay_channel(self, channel):
+        """ownerがpublishしたframeを流す"""
+        while await channel.wait_message():
+            data = await channel.get()
+            if data is None:
+                break
+            try:
+                envelope = _envelope_codec.loads(data)
+                if envelope['origin'] == self.hub.worker_id:
+                    continue
+                if 'variants' in envelope:
+                    # 他のworkerに新しいvariantのsubscriberが来た
+                    if self.owner:
+                        ioloop.IOLoop.current().spawn_callback(self._load_variants)
+                    continue
+                self.hub.relayed += 1
+                self.deliver(envelope['events'], {
+                    (mode, response_format): (variant_frames, binary)
+                    for mode, response_format, binary, variant_frames in envelope['frames']
+                })
+            except Exception:
+                logger.exception('failed to relay messages: %s', self.name)
+
+        if not self.closed:
+            # redisとの接続が切れた. clientには繋ぎなおしてもらう
+            logger.warning('stream channel closed: %s', self.name)
+            self.close()
+
+    async def _elect(self, ping_interval):
+        """ownerがいなければownerになって、upstreamにつなぐ"""
+        lock_key = REDIS_STREAM_OWNER_KEY.format(self.name)
+        token = '{}:{}'.format(self.hub.worker_id, time.time())
+        async with self.hub.app.get_async_redis() as redis:
+            acquired = await redis.set(
+                lock_key, token, pexpire=int(self.hub.lock_timeout * 1000), exist=redis.SET_IF_NOT_EXIST)
+        if not acquired:
+            return
+
+        self._lock_token = token
+        self.owner = True
+        logger.info('stream owner: %s', self.name)
+        try:
+            await self._load_variants()
+            await self.connect(ping_interval)
+        except Exception:
+            # 他のworkerにownerを譲る
+            await self._resign()
+            raise
+
+    async def _refresh(self):
+        """ownerのlockを延ばす. 延ばせなければ、他のworkerがownerになっている"""
+        async with self.hub.app.get_async_redis() as redis:
+            refreshed = await redis.eval(
+                REFRESH_LOCK_SCRIPT, keys=[REDIS_STREAM_OWNER_KEY.format(self.name)],
+                args=[self._lock_token, int(self.hub.lock_timeout * 1000)])
+        return bool(refreshed)
+
+    async def _resign(self):
+        """ownerをやめる. upstreamは閉じる"""
+        peer, self.peer = self.peer, None
+        if peer is not None:
+            peer.close()
+        if not self.owner:
+            return
+        self.owner = False
+        self.cluster_variants = None
+        token, self._lock_token = self._lock_token, None
+        async with self.hub.app.get_async_redis() as redis:
+            await redis.eval(RELEASE_LOCK_SCRIPT, keys=[REDIS_STREAM_OWNER_KEY.format(self.name)], args=[token])
+
+    async def _advertise(self):
+        """このworkerのvariantをredisに書く. 有効期限はlock_timeout秒なので、watch_ownerが書きなおす
+
+        新しいvariantが増えたら、ownerに読みなおしてもらう
+        """
+        variants = self.variants
+        added = variants - self._advertised
+        removed = self._advertised - variants
+        self._advertised = variants
+        key = REDIS_STREAM_VARIANTS_KEY.format(self.name)
+        expires = time.time() + self.hub.lock_timeout
+        async with self.hub.app.get_async_redis() as redis:
+            if removed:
+                await redis.zrem(key, *[self._variant_member(variant) for variant in removed])
+            if variants:
+                pairs = []
+                for variant in variants:
+                    pairs += [expires, self._variant_member(variant)]
+                await redis.zadd(key, *pairs)
+                await redis.pexpire(key, int(self.hub.lock_timeout * 1000))
+            if added and not self.owner:
+                await redis.publish(REDIS_STREAM_CHANNEL.format(self.name), _envelope_codec.dumps({
+                    'origin': self.hub.worker_id,
+                    'variants': True,
+                }))
+        if self.owner:
+            self.cluster_variants = (self.cluster_variants or frozenset()) | variants
+
+    def _variant_member(self, variant):
+        mode, response_format = variant
+        return jsoncodec.dumps([self.hub.worker_id, mode, response_format])
+
+    async def _load_variants(self):
+        """ownerが、全workerのvariantを読む. 期限の切れたものは死んだworkerの分なので消す"""
+        key = REDIS_STREAM_VARIANTS_KEY.format(self.name)
+        async with self.hub.app.get_async_redis() as redis:
+            await redis.zremrangebyscore(key, max=time.time())
+            members = await redis.zrangebyscore(key)
+        variants = set()
+        for member in members:
+            worker_id, mode, response_format = jsoncodec.loads(member)
+            variants.add((mode, response_format))
+        self.cluster_variants = frozenset(variants)
+
+    async def watch_owner(self, ping_interval):
+        """ownerならlockを延ばし、そうでなければownerが死んでいないか見張る
+
+        ownerのworkerが死ぬとlockが切れるので、次に見たworkerがownerになってupstreamにつなぐ
+        """
+        while not self.closed:
+            await gen.sleep(self.hub.lock_timeout / 3)
+            if self.closed:
+                break
+            try:
+                await self._advertise()
+                if self.owner:
+                    await self._load_variants()
+                    if not await self._refresh():
+                        logger.warning('lost stream owner: %s', self.name)
+                        self.owner = False
+                        await self._resign()
+                else:
+                    await self._elect(ping_interval)
+                    if self.owner:
+                        self.hub.takeovers += 1
+            except Exception:
+                logger.exception('failed to watch stream owner: %s', self.name)
+
+    def add(self, subscriber):
+        self.subscribers.add(subscriber)
+        if self.clustered and self.started and subscriber.stream_variant not in self._advertised:
+            ioloop.IOLoop.current().spawn_callback(self._advertise_safely)
+        if self._idle_timer is not None:
+            ioloop.IOLoop.current().remove_timeout(self._idle_timer)
+            self._idle_timer = None
+
+    def remove(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if self.subscribers or self.closed:
+            return
+        if not self.shared or not self.hub.idle_timeout:
+            self.close()
+        elif self._idle_timer is None:
+            # すぐ次のclientが来ることが多いので、しばらく残しておく
+            self._idle_timer = ioloop.IOLoop.current().call_later(self.hub.idle_timeout, self.close)
+
+    async def _advertise_safely(self):
+        try:
+            await self._advertise()
+        except Exception:
+            logger.exception('failed to advertise stream variants: %s', self.name)
+
+    def close(self):
+        if self.closed:
+            return
+        # 集めていたframeは流してから閉じる
+        self.flush_batch()
+        self.closed = True
+        if self._idle_timer is not None:
+            ioloop.IOLoop.current().remove_timeout(self._idle_timer)
+            self._idle_timer = None
+        self.hub._forget(self)
+        subscribers, self.subscribers = self.subscribers, set()
+
+        if self.clustered:
+            ioloop.IOLoop.current().spawn_callback(self._leave_cluster)
+        elif self.peer is not None:
+            self.peer.close()
+        if not self.started:
+            # つなげなかった. subscriberにはsubscribeの例外で伝わる
+            return
+        for subscriber in subscribers:
+            subscriber.on_stream_closed()
+
+    async def _leave_cluster(self):
+        try:
+            await self._advertise()
+            await self._resign()
+            if self._channel is not None:
+                await self.hub._unsubscribe_channel(self._channel)
+        except Exception:
+            logger.exception('failed to leave stream: %s', self.name)
+
+
+class StreamHub(object):
+    """workerの中で、同じstreamへのupstreamのwebsocketを1本にまとめる
+
+    shareがTrueなら、access_tokenを付けていないclientのpublic, hashtagのstreamは (host, stream, tag) 毎に
+    1本だけつなぎ、subscriberの数を数えて、messageを全員に流す. 最後のsubscriberがいなくなってもidle_timeout秒は残しておく.
+    共有するupstreamは、service_tokensにhostのtokenがあればそれで、なければtokenなしでつなぐ.
+    access_tokenを付けたclientや、userなどのstreamは今まで通りclient毎に、clientのaccess_tokenでつなぐ.
+    Mastodonはtoken毎にblockやmuteでfilterするので、他のclientのtokenでつないだstreamは流さない.
+
+    clusterがTrueなら、共有するstreamはforkした全workerで1本にする. redisのlockを取ったworkerがupstreamにつないで
+    filterし、作ったframeをredisのchannelにpublishする. ownerのworkerが死ぬと、lock_timeout秒以内に
+    そのstreamを見ている他のworkerがownerになる.
+
+    stream_batchなsubscriberには、batch_window秒の間のmessageを1つのframeにまとめて流す.
+    subscriberが全員stream_batchなら、集めてからfilterするのでfilterも1回で済む. cluster modeでは集めずにpublishし、
+    各workerがframeを集める.
+
+    :param float idle_timeout:
+    :param bool share: Falseなら、どのstreamもclient毎につなぐ
+    :param bool cluster:
+    :param float lock_timeout: ownerのlockの有効期限
+    :param float batch_window: 0ならbatchを指定されても集めない
+    :param int batch_max_events:
+    :param dict service_tokens: {host: access_token}. 共有するstreamをつなぐのに使う.
+        そのaccountのblockやmuteは、共有するstreamの全員にかかる
+    """
+
+    def __init__(self, app, idle_timeout=DEFAULT_IDLE_TIMEOUT, cluster=False, lock_timeout=DEFAULT_OWNER_LOCK_TIMEOUT,
+                 batch_window=DEFAULT_BATCH_WINDOW, batch_max_events=DEFAULT_BATCH_MAX_EVENTS, service_tokens=None,
+                 share=False):
+        self.app = app
+        self.idle_timeout = idle_timeout
+        self.share = share
+        self.cluster = cluster
+        self.lock_timeout = lock_timeout
+        self.batch_window = batch_window
+        self.batch_max_events = batch_max_events
+        self.service_tokens = {host.lower(): token for host, token in (service_tokens or {}).items()}
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._streams = {}
+        self._private_streams = set()
+        self._pubsub = None
+
+        self.connects = 0
+        self.reused = 0
+        self.published = 0
+        self.relayed = 0
+        self.takeovers = 0
+        # subscriberのSendQueueが数える
+        self.dropped_frames = 0
+        self.slow_disconnects = 0
+
+    async def subscribe(self, request_url, subscriber, encode, ping_interval=None):
+        """request_urlのstreamにsubscriberを足す
+
+        つなげなければ例外になる. 不調なhostならCircuitOpen
+        subscriberは `stream_variant`, `stream_batch`, `closed`, `buffered_bytes`,
+        `write_frames(frames, binary, events)`, `on_stream_closed()` を持つこと
+
+        :param encode: `encode(app, raws, variants)` で (各messageのevent名, {variant: (frames, binary)}) を返す
+            coroutine function. variantsがNoneなら全部のvariantを作る
+        :rtype: SharedStream
+        """
+        key = get_stream_key(request_url) if self.share else None
+        stream = self._streams.get(key) if key is not None else None
+        if stream is None:
+            stream = SharedStream(self, key, request_url, encode)
+            if key is None:
+                self._private_streams.add(stream)
+            else:
+                self._streams[key] = stream
+        else:
+            self.reused += 1
+
+        stream.add(subscriber)
+        try:
+            await stream.start(ping_interval)
+        except Exception:
+            stream.subscribers.discard(subscriber)
+            stream.close()
+            raise
+        return stream
+
+    def unsubscribe(self, stream, subscriber):
+        stream.remove(subscriber)
+
+    def _forget(self, stream):
+        if stream.key is None:
+            self._private_streams.discard(stream)
+        elif self._streams.get(stream.key) is stream:
+            del self._streams[stream.key]
+
+    # cluster mode
+    async def _subscribe_channel(self, name):
+        # pub/subの接続はpoolに返せないので、workerで1本持つ
+        if self._pubsub is None:
+            self._pubsub = gen.convert_yielded(self.app.create_async_redis())
+        try:
+            pubsub = await self._pubsub
+            if pubsub.closed:
+                raise ConnectionError('pubsub connection closed')
+        except Exception:
+            self._pubsub = None
+            raise
+        channel, = await pubsub.subscribe(name)
+        return channel
+
+    async def _unsubscribe_channel(self, channel):
+        if self._pubsub is None:
+            return
+        pubsub = await self._pubsub
+        if not pubsub.closed:
+            await pubsub.unsubscribe(channel.name)
+
+    def stats(self):
+        shared = list(self._streams.values())
+        streams = shared + list(self._private_streams)
+        buffered = [subscriber.buffered_bytes for stream in streams for subscriber in stream.subscribers]
+        return {
+            'stream_hub.upstreams': sum(1 for stream in streams if stream.peer is not None),
+            'stream_hub.shared_upstreams': sum(1 for stream in shared if stream.peer is not None),
+            'stream_hub.streams': len(streams),
+            'stream_hub.owned': sum(1 for stream in shared if stream.owner),
+            'stream_hub.subscribers': sum(len(stream.subscribers) for stream in streams),
+            'stream_hub.connects': self.connects,
+            'stream_hub.reused': self.reused,
+            'stream_hub.published': self.published,
+            'stream_hub.relayed': self.relayed,
+            'stream_hub.takeovers': self.takeovers,
+            'stream_hub.buffered_bytes': sum(buffered),
+            'stream_hub.buffered_bytes.max': max(buffered, default=0),
+            'stream_hub.dropped_frames': self.dropped_frames,
+            'stream_hub.slow_disconnects': self.slow_disconnects,
+        }
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""workerが同時に受け付けるuploadの量を制限する."""
+import logging
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+
+
+class UploadBudget(object):
+    """upload中のbodyの合計byte数を、worker毎にmax_bytesまでに抑える
+
+    :param int max_bytes: 同時にupload中にできるContent-Lengthの合計
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.rejected = 0
+
+    def acquire(self, nbytes):
+        """nbytesのuploadを受け付けてよければTrue. 受け付けたら、終わった時にreleaseすること"""
+        if self.in_flight_bytes + nbytes > self.max_bytes:
+            self.rejected += 1
+            logger.warning('reject upload: %d bytes (%d bytes in flight)', nbytes, self.in_flight_bytes)
+            return False
+        self.in_flight += 1
+        self.in_flight_bytes += nbytes
+        return True
+
+    def release(self, nbytes):
+        self.in_flight -= 1
+        self.in_flight_bytes -= nbytes
+
+    def stats(self):
+        return {
+            'upload.in_flight': self.in_flight,
+            'upload.in_flight_bytes': self.in_flight_bytes,
+            'upload.rejected': self.rejected,
+        }
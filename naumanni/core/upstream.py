@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Mastodonへのupstream HTTPクライアントpool."""
+import logging
+import time
+from urllib.parse import urlsplit
+
+from tornado import httpclient, ioloop, iostream, locks
+from tornado.curl_httpclient import CurlAsyncHTTPClient
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+from .circuitbreaker import CircuitOpen
+from .ratelimit import PRIORITY_HIGH, RateLimitExceeded
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAX_CLIENTS = 100
+DEFAULT_MAX_CLIENTS_PER_HOST = 10
+# crawlなどで色々なhostに行くので、clientを持っておくhostの数を絞る
+DEFAULT_MAX_HOSTS = 256
+DEFAULT_IDLE_TIMEOUT = 60.0
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_REQUEST_TIMEOUT = 20.0
+# このcodeが返ってきたら、hostが不調とみなす
+CIRCUIT_FAILURE_CODES = frozenset([599, 502, 503, 504])
+
+
+class _HostClients(object):
+    """1ホスト分のクライアント
+
+    curlはconnectionをkeep-aliveして使いまわしてくれる. body_producerを使うuploadだけは
+    CurlAsyncHTTPClientが対応していないので、SimpleAsyncHTTPClientを使う
+    """
+    __slots__ = ('host', 'max_clients', 'defaults', 'semaphore', '_curl', '_simple', 'in_flight', 'last_used')
+
+    def __init__(self, host, max_clients, defaults=None):
+        self.host = host
+        self.max_clients = max_clients
+        self.defaults = defaults
+        # clientの中で待たせないよう、max_clientsを超える分はここで待たせる
+        self.semaphore = locks.Semaphore(max_clients)
+        self._curl = None
+        self._simple = None
+        self.in_flight = 0
+        self.last_used = time.time()
+
+    def client_for(self, request):
+        if request.body_producer is not None:
+            if self._simple is None:
+                self._simple = SimpleAsyncHTTPClient(
+                    force_instance=True, max_clients=self.max_clients, defaults=self.defaults)
+            return self._simple
+
+        if self._curl is None:
+            self._curl = CurlAsyncHTTPClient(
+                force_instance=True, max_clients=self.max_clients, defaults=self.defaults)
+        return self._curl
+
+    def close(self):
+        for client in (self._curl, self._simple):
+            if client is not None:
+                client.close()
+        self._curl = self._simple = None
+
+
+class UpstreamClientPool(object):
+    """Mastodonホスト毎にkeep-aliveなHTTPクライアントを保持するpool
+
+    :param int max_clients: pool全体での同時リクエスト数
+    :param int max_clients_per_host: ホスト毎の同時リクエスト数
+    :param float idle_timeout: この秒数使われなかったホストのクライアントを閉じる
+    :param int max_hosts: クライアントを持っておくホストの数. 超えたら使われていないホストから閉じる
+    :param RateLimitTracker rate_limiter: 指定されていれば、responseのrate limitを覚えて優先度の低いrequestを絞る
+    :param CircuitBreakerRegistry circuit_breakers: 指定されていれば、不調なhostへのrequestをすぐ503にする
+    :param float connect_timeout: requestで指定されていない時の接続timeout
+    :param float request_timeout: requestで指定されていない時の全体のtimeout
+    """
+
+    def __init__(self, max_clients=DEFAULT_MAX_CLIENTS, max_clients_per_host=DEFAULT_MAX_CLIENTS_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, rate_limiter=None, circuit_breakers=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                 max_hosts=DEFAULT_MAX_HOSTS):
+        self.rate_limiter = rate_limiter
+        self.circuit_breakers = circuit_breakers
+        self.defaults = {'connect_timeout': connect_timeout, 'request_timeout': request_timeout}
+        self.max_clients = max_clients
+        self.max_clients_per_host = max_clients_per_host
+        self.idle_timeout = idle_timeout
+        self.max_hosts = max_hosts
+
+        self._semaphore = locks.Semaphore(max_clients)
+        self._hosts = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.aborted = 0
+
+        self._evict_callback = ioloop.PeriodicCallback(self.evict_idle, idle_timeout * 1000 / 2)
+        self._evict_callback.start()
+
+    async def fetch(self, request, raise_error=True, priority=PRIORITY_HIGH, aborted=None, **kwargs):
+        """hostに対応するクライアントでrequestを実行する
+
+        :param aborted: 終わった時にTrueを返せば、clientの切断などでこちらから中断したrequestとして、
+            circuit breakerにはhostの失敗として数えない
+        """
+        if not isinstance(request, httpclient.HTTPRequest):
+            request = httpclient.HTTPRequest(url=request, **kwargs)
+        elif kwargs:
+            raise ValueError('kwargs can\'t be used if request is an HTTPRequest object')
+
+        host = urlsplit(request.url).netloc.lower()
+        authorization = request.headers.get('Authorization')
+        if self.rate_limiter is not None:
+            try:
+                await self.rate_limiter.acquire(host, authorization, priority)
+            except RateLimitExceeded as exc:
+                logger.info('shed upstream request: %s %s', request.url, exc)
+                response = httpclient.HTTPResponse(request, 429, reason='Too Many Requests')
+                if raise_error:
+                    raise response.error
+                return response
+
+        breaker = None
+        if self.circuit_breakers is not None:
+            try:
+                breaker = self.circuit_breakers.acquire(host)
+            except CircuitOpen as exc:
+                logger.info('reject upstream request: %s %s', request.url, exc)
+                response = httpclient.HTTPResponse(request, 503, reason='Service Unavailable')
+                if raise_error:
+                    raise response.error
+                return response
+
+        entry = self._get_host_clients(host)
+        entry.in_flight += 1
+        response = None
+        try:
+            # hostの空きを待ってから全体の枠を取る. 遅いhostで待っているrequestが全体の枠を埋めないように
+            async with entry.semaphore:
+                async with self._semaphore:
+                    response = await entry.client_for(request).fetch(request, raise_error=raise_error)
+            return response
+        except httpclient.HTTPError as exc:
+            response = exc.response or httpclient.HTTPResponse(request, exc.code, error=exc)
+            if raise_error:
+                raise
+            # tornado>=5は接続エラー(599)だとraise_error=Falseでもraiseする
+            return response
+        except (OSError, iostream.StreamClosedError) as exc:
+            # SimpleAsyncHTTPClient(upload)は接続エラーをそのままraiseする. curlと同じ599にする
+            response = httpclient.HTTPResponse(request, 599, error=exc)
+            if raise_error:
+                raise httpclient.HTTPClientError(599, str(exc), response) from exc
+            return response
+        finally:
+            entry.in_flight -= 1
+            entry.last_used = time.time()
+            if breaker is not None:
+                if aborted is not None and aborted():
+                    self.aborted += 1
+                    breaker.release(None)
+                else:
+                    breaker.release(response is not None and response.code not in CIRCUIT_FAILURE_CODES)
+            if self.rate_limiter is not None and response is not None:
+                self.rate_limiter.update(host, authorization, response.headers)
+
+    def _get_host_clients(self, host):
+        entry = self._hosts.get(host)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        if len(self._hosts) >= self.max_hosts:
+            self._evict_least_used()
+        entry = self._hosts[host] = _HostClients(host, self.max_clients_per_host, self.defaults)
+        return entry
+
+    def _evict_least_used(self):
+        """request中でないホストのうち、一番使われていないもののクライアントを閉じる"""
+        idle = [entry for entry in self._hosts.values() if not entry.in_flight]
+        if not idle:
+            return
+        entry = min(idle, key=lambda entry: entry.last_used)
+        logger.debug('evict upstream clients: %s', entry.host)
+        del self._hosts[entry.host]
+        entry.close()
+        self.evictions += 1
+
+    def evict_idle(self):
+        """idle_timeout以上使われていないホストのクライアントを閉じる"""
+        deadline = time.time() - self.idle_timeout
+        for host, entry in list(self._hosts.items()):
+            if entry.in_flight or entry.last_used > deadline:
+                continue
+            logger.debug('evict upstream clients: %s', host)
+            del self._hosts[host]
+            entry.close()
+            self.evictions += 1
+
+    def close(self):
+        self._evict_callback.stop()
+        for entry in self._hosts.values():
+            entry.close()
+        self._hosts.clear()
+
+    def stats(self):
+        return {
+            'upstream.hosts': len(self._hosts),
+            'upstream.in_flight': sum(entry.in_flight for entry in self._hosts.values()),
+            'upstream.hits': self.hits,
+            'upstream.misses': self.misses,
+            'upstream.evictions': self.evictions,
+            'upstream.aborted': self.aborted,
+        }
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""JSONのencode/decode.
+
+orjson, ujsonがinstallされていればそちらを使い、なければ標準のjsonを使う.
+dumpsはbytesを返し、loadsはbytesもstrも受け付けるので、utf-8との変換を何度もしなくて済む.
+"""
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+import json
+
+
+CONTENT_TYPE = 'application/json; charset=utf-8'
+
+
+if orjson is not None:
+    name = 'orjson'
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        # 標準のjsonと同じく、intのkeyも許す
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps_canonical(obj):
+        # keyを並べ替えるので、同じ内容なら元のkeyの順番によらず同じbytesになる
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS)
+
+elif ujson is not None:  # pragma: no cover
+    name = 'ujson'
+
+    def loads(data):
+        return ujson.loads(data)
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+    def dumps_canonical(obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, sort_keys=True).encode('utf-8')
+
+else:  # pragma: no cover
+    name = 'json'
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def dumps_canonical(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def dumps_str(obj):
+    """JSONの中にJSONを文字列で入れる時などのため、strで返す"""
+    return dumps(obj).decode('utf-8')
+
+
+def dumps_array_str(items):
+    """dumps_strしたもののlistを、encodeしなおさずにarrayにする"""
+    return '[' + ','.join(items) + ']'
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""プロセス内のLRU cache."""
+import collections
+import time
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """有効期限付きのLRU cache
+
+    :param int maxsize: 保持する最大件数
+    :param float ttl: defaultの有効期限(秒). Noneなら期限なし
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            if count:
+                self.misses += 1
+            return default
+
+        if expires is not None and expires <= time.time():
+            del self._data[key]
+            if count:
+                self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        if count:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.time() + ttl if ttl is not None else None, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def items(self):
+        """期限切れでない(key, value)を返す. LRUの順番は変えない"""
+        now = time.time()
+        return [
+            (key, value) for key, (expires, value) in self._data.items()
+            if expires is None or expires > now
+        ]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self, prefix):
+        return {
+            '{}.size'.format(prefix): len(self._data),
+            '{}.hits'.format(prefix): self.hits,
+            '{}.misses'.format(prefix): self.misses,
+        }
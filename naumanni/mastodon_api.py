@@ -1,14 +1,15 @@
 # -*- coding:utf-8 -*-
 from werkzeug import routing
 
-from naumanni.normalizr import Entity, denormalize, normalize
+from naumanni.normalizr import Entity, denormalize, denormalize_batch, normalize, normalize_batch, pick_entities
 from naumanni.mastodon_models import Status, Account, Notification
 
 
 account = Entity('accounts', Account)
 status = Entity('statuses', Status, {
     'account': account,
-    'reblog': Entity('statuses', Status)
+    # reblogの中にreblogはないが、accountは同じtableに入れる
+    'reblog': Entity('statuses', Status, {'account': account}),
 })
 notification = Entity('notifications', Notification, {
     'account': account,
@@ -20,6 +21,8 @@ notification = Entity('notifications', Notification, {
 apiSchemaMap = routing.Map()
 apiSchemaMapAdapter = None
 schemaFuncs = {}
+responseCacheTTLs = {}
+prefetchRules = set()
 
 
 def get_adapter():
@@ -36,18 +39,73 @@ def get_schema(api):
     return schema
 
 
+def get_response_cache_ttl(api):
+    """responseをcacheしてよいapiなら、TTLを返す. そうでなければNone
+
+    blockやmuteで中身がユーザー毎に変わるので、cacheはtoken毎になる
+    """
+    adapter = get_adapter()
+    rule, args = adapter.match(api, return_rule=True)
+    return responseCacheTTLs.get(rule.rule)
+
+
+def is_prefetchable(api):
+    """Linkヘッダのnextを先読みしてよいapiか"""
+    adapter = get_adapter()
+    rule, args = adapter.match(api, return_rule=True)
+    return rule.rule in prefetchRules
+
+
 def normalize_mastodon_response(api, inputData):
+    """apiのresponseをnormalizeする. inputDataはその場で書き換えられるので、decodeしたてのものを渡すこと"""
     return normalize(inputData, get_schema(api))
 
 
-def denormalize_mastodon_response(api, inputData, entities):
-    return denormalize(inputData, get_schema(api), entities)
+def denormalize_mastodon_response(api, inputData, entities, shared=False):
+    return denormalize(inputData, get_schema(api), entities, shared)
+
+
+def normalize_mastodon_responses(responses):
+    """(api, inputData)のlistを、1つのentitiesにまとめてnormalizeする. 各inputDataは書き換えられる
+
+    :return: (entities, 各responseのresultのlist)
+    """
+    return normalize_batch([(inputData, get_schema(api)) for api, inputData in responses])
+
+
+def denormalize_mastodon_responses(results, entities, shared=False):
+    """normalize_mastodon_responsesの結果を、(api, result)毎に元に戻す"""
+    return denormalize_batch([(result, get_schema(api)) for api, result in results], entities, shared)
+
+
+def pick_mastodon_entities(api, inputData, entities):
+    """normalizeされたinputDataが参照しているentityだけを返す. filterで消されたentityを参照していればKeyError"""
+    return pick_entities(inputData, get_schema(api), entities)
+
+
+def to_normalized_response(entities, result):
+    """normalizeしたままclientに返すJSON. normalizr.jsのnormalizeと同じ{entities, result}の形にする
+
+    MessagePackでもJSONと同じになるように、entityのidはstrにする
+    """
+    return {
+        'entities': {
+            key: {str(entity_id): entity.to_dict() for entity_id, entity in table.items()}
+            for key, table in entities.items()
+        },
+        'result': result,
+    }
 
 
 def register_schema(rule, **options):
     def decorator(f):
         global apiSchemaMapAdapter
         endpoint = options.pop('endpoint', f.__name__)
+        response_cache_ttl = options.pop('response_cache_ttl', None)
+        if response_cache_ttl is not None:
+            responseCacheTTLs[rule] = response_cache_ttl
+        if options.pop('prefetch', False):
+            prefetchRules.add(rule)
 
         apiSchemaMap.add(
             routing.Rule(rule, endpoint=endpoint, **options)
@@ -63,10 +121,10 @@ def accounts_verify_credentials():
     return account
 
 
-@register_schema('/timelines/home', endpoint='timeline')
-@register_schema('/timelines/public', endpoint='timeline')
-@register_schema('/timelines/tag/<hashtag>', endpoint='timeline')
-@register_schema('/accounts/<user_id>/statuses', endpoint='timeline')
+@register_schema('/timelines/home', endpoint='timeline', prefetch=True)
+@register_schema('/timelines/public', endpoint='timeline', response_cache_ttl=5)
+@register_schema('/timelines/tag/<hashtag>', endpoint='timeline', response_cache_ttl=10)
+@register_schema('/accounts/<user_id>/statuses', endpoint='timeline', prefetch=True)
 def timeline(hashtag=None, user_id=None):
     return [status]
 
@@ -4,57 +4,92 @@ import re
 from werkzeug import cached_property, unescape
 from ttp import ttp
 
+from .lru import LRUCache
+
 tag_rex = re.compile('<(/?.*?)(\s+[^>]*)?/?>')
 
 
+DEFAULT_CONTENT_CACHE_SIZE = 10000
+
+
 class JSONBasedModel(object):
+    """APIのJSONのdictをwrapするmodel
+
+    attributeはwrapしているdictから都度引くので、dictはコピーしない. attributeへの代入もdictに入る.
+    数万個がplugin cacheやtimelineで生きているので、wrapper自身は__slots__で小さくする.
+    cached_propertyの値は、使った時だけ作られる `__dict__` に入るので、to_dictには出てこない.
+    """
+    __slots__ = ('_data', '__dict__')
     _defaults = {}
 
     def __init__(self, **kwargs):
+        self._wrap(kwargs)
+
+    @classmethod
+    def from_dict(cls, data):
+        """dataをコピーせずにwrapする. dataはmodelのものになる"""
+        self = cls.__new__(cls)
+        self._wrap(data)
+        return self
+
+    def _wrap(self, data):
         for key, val in self._defaults.items():
-            setattr(self, key, val)
-        for key, val in kwargs.items():
-            setattr(self, key, val)
+            data.setdefault(key, val)
+        # __setattr__を通ると遅いので、slotに直接入れる
+        _set_data(self, data)
+
+    def __getattr__(self, key):
+        # slotとclassになければ、dictから引く
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self._data[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        if key.startswith('_'):
+            object.__setattr__(self, key, value)
+        else:
+            self._data[key] = value
+
+    def __reduce__(self):
+        return (self.from_dict, (self.to_dict(), ))
 
     def to_dict(self):
-        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+        """wrapしているdictをそのまま返す"""
+        return self._data
+
+
+_set_data = JSONBasedModel._data.__set__
 
 
 class Account(JSONBasedModel):
+    __slots__ = ()
     _defaults = {}
 
 
 class Status(JSONBasedModel):
+    __slots__ = ()
     _defaults = {
         'reblog': None
     }
 
     @cached_property
     def plainContent(self):
-        # 雑なRemoveTag
-        def handle_tag(m):
-            tagname = m.group(1).lower()
-            if tagname == '\p':
-                return '\n\n'
-            elif tagname == 'br':
-                return '\n'
-        return tag_rex.sub(handle_tag, self.content).rstrip()
+        return content_cache.get_plain_content(self)
 
     @cached_property
     def urls(self):
-        parsed = ttp.Parser().parse(self.plainContent)
-        return parsed.urls
+        return content_cache.get_urls(self)
 
     @property
     def urls_without_media(self):
-        rv = []
-        for url in self.urls:
-            for media in self.media_attachments:
-                if media.get('text_url', None) == url:
-                    break
-            else:
-                rv.append(url)
-        return rv
+        if not self.media_attachments:
+            return list(self.urls)
+
+        text_urls = {media.get('text_url', None) for media in self.media_attachments}
+        return [url for url in self.urls if url not in text_urls]
 
     def add_extended_attributes(self, key, data):
         if not hasattr(self, 'extended'):
@@ -65,5 +100,74 @@ class Status(JSONBasedModel):
         return getattr(self, 'extended', {}).get(key, default)
 
 
+class _ParsedContent(object):
+    __slots__ = ('plain_content', 'urls')
+
+    def __init__(self, plain_content):
+        self.plain_content = plain_content
+        self.urls = None
+
+
+class StatusContentCache(object):
+    """Status.plainContentとStatus.urlsの、process全体でのcache
+
+    同じstatusがhome, public, tag, streamingで何度も来るので、uri(なければid)とcontentのhashをkeyにして
+    tagを取り除いたtextとurlを覚えておく. contentが変わればkeyも変わる.
+
+    :param int maxsize: 覚えておくstatusの最大数
+    """
+
+    def __init__(self, maxsize=DEFAULT_CONTENT_CACHE_SIZE):
+        self._cache = LRUCache(maxsize)
+        self._parser = ttp.Parser()
+
+    @property
+    def maxsize(self):
+        return self._cache.maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        self._cache.maxsize = maxsize
+
+    def get_plain_content(self, status):
+        return self._get(status).plain_content
+
+    def get_urls(self, status):
+        """urlのlistを返す. listはcacheと共有しないので、書き換えてもよい"""
+        parsed = self._get(status)
+        if parsed.urls is None:
+            parsed.urls = tuple(self._parser.parse(parsed.plain_content, html=False).urls)
+        return list(parsed.urls)
+
+    def _get(self, status):
+        content = status.content
+        key = (getattr(status, 'uri', None) or getattr(status, 'id', None), hash(content))
+        parsed = self._cache.get(key)
+        if parsed is None:
+            parsed = _ParsedContent(_strip_tags(content))
+            self._cache.set(key, parsed)
+        return parsed
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats('status_content.cache')
+
+
+def _strip_tags(content):
+    # 雑なRemoveTag
+    def handle_tag(m):
+        tagname = m.group(1).lower()
+        if tagname == '\p':
+            return '\n\n'
+        elif tagname == 'br':
+            return '\n'
+    return tag_rex.sub(handle_tag, content).rstrip()
+
+
+content_cache = StatusContentCache()
+
+
 class Notification(JSONBasedModel):
-    pass
+    __slots__ = ()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""MessagePackのencode/decode.
+
+msgpackはoptionalなので、installされていなければavailableがFalseになり、clientにはJSONで返す.
+JSONと違って、intのkeyはintのまま、bytesはbinのままになる.
+"""
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+available = msgpack is not None
+CONTENT_TYPE = 'application/msgpack'
+# Acceptにこれがあれば、MessagePackを受け取れるclient
+ACCEPT_TYPES = frozenset(['application/msgpack', 'application/x-msgpack'])
+
+
+def loads(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def dumps_array(items):
+    """dumpsしたもののlistを、packしなおさずにarrayにする"""
+    return msgpack.Packer().pack_array_header(len(items)) + b''.join(items)
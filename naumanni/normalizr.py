@@ -52,14 +52,13 @@ class Entity(Schema):
         if inputData is None:
             return None
 
-        inputData = inputData.copy()
-
+        # inputDataはコピーせずに、sub entityをidに書き換えてからmodelにする
         for subkey, subschema in self.schema.items():
             if subkey in inputData:
                 inputData[subkey] = visit(inputData[subkey], inputData, subkey, subschema, addEntity)
 
         valueId = self.getId(inputData)
-        addEntity(schema, self.getId(inputData), self.klass(**inputData))
+        addEntity(schema, valueId, _get_model_factory(self.klass)(inputData))
         return valueId
 
     def denormalize(self, inputData, unvisit):
@@ -74,8 +73,63 @@ class Entity(Schema):
         return inputData
 
 
-def normalize(inputData, schema):
+def normalize(inputData, schema, entities=None):
+    """inputDataをentityのtableとidに分ける
+
+    inputDataはコピーされず、そのままentityのmodelになる. sub entityとarrayの要素はその場でidに書き換えられるので、
+    呼び出した後のinputDataは元の形ではない. 後で使うなら、先にcopy.deepcopyしておくこと.
+
+    :param dict entities: 指定されていれば、新しいtableを作らずにここに足す
+    """
+    plan = compile_schema(schema)
+    if plan is None:
+        return normalize_generic(inputData, schema, entities)
+    return plan.normalize(inputData, entities)
+
+
+def denormalize(inputData, schema, entities, shared=False):
+    """normalizeされたinputDataを元に戻す
+
+    :param bool shared: Trueなら、同じentityへの参照は全部同じdictになる. すぐserializeする時だけ使うこと
+    """
+    plan = compile_schema(schema)
+    if plan is None:
+        return denormalize_generic(inputData, schema, entities)
+    return plan.denormalize(inputData, entities, shared)
+
+
+def normalize_batch(inputs):
+    """(inputData, schema)のlistを、1つのentityのtableにまとめてnormalizeする
+
+    同じidのentityは1つになるので、filterは1回かければよい. 各inputDataはnormalizeと同じく書き換えられる.
+
+    :return: (entities, 各inputDataのresultのlist)
+    """
     entities = {}
+    return entities, [normalize(inputData, schema, entities)[1] for inputData, schema in inputs]
+
+
+def denormalize_batch(inputs, entities, shared=False):
+    """normalize_batchの結果を、(result, schema)毎に元に戻す
+
+    :param bool shared: Trueなら、batch全体で同じentityは同じdictになる
+    """
+    # batchの中で同じentityを何度もdenormalizeしないように、memoを共有する
+    memo = {}
+    rv = []
+    for inputData, schema in inputs:
+        plan = compile_schema(schema)
+        if plan is None:
+            rv.append(denormalize_generic(inputData, schema, entities))
+        else:
+            rv.append(plan.denormalize(inputData, entities, shared, memo))
+    return rv
+
+
+def normalize_generic(inputData, schema, entities=None):
+    """schemaを1nodeずつ辿ってnormalizeする. compileできないschema用"""
+    if entities is None:
+        entities = {}
 
     def addEntity(schema, valueId, value):
         entities.setdefault(schema.key, {})[valueId] = value
@@ -83,14 +137,15 @@ def normalize(inputData, schema):
     return entities, visit(inputData, None, None, schema, addEntity)
 
 
-def denormalize(inputData, schema, entities):
+def denormalize_generic(inputData, schema, entities):
+    """schemaを1nodeずつ辿ってdenormalizeする. compileできないschema用"""
     def _unvisit(inputData, schema):
         schema = schemaize(schema)
 
         if isinstance(schema, Entity):
             if inputData is None:
                 return None
-            entity = entities[schema.key][inputData].to_dict()
+            entity = dict(entities[schema.key][inputData].to_dict())
             return schema.denormalize(entity, _unvisit)
         else:
             return schema.denormalize(inputData, _unvisit)
@@ -103,9 +158,387 @@ def visit(value, parent, key, schema, addEntity):
     return schema.normalize(value, parent, key, schema, addEntity, visit)
 
 
+def get_entity_keys(schema):
+    """schemaに含まれるEntityのkeyを返す"""
+    keys = set()
+    visited = set()
+
+    def _walk(schema):
+        if isinstance(schema, (list, tuple)):
+            for subschema in schema:
+                _walk(subschema)
+        elif isinstance(schema, ArraySchema):
+            _walk(schema.entity)
+        elif isinstance(schema, Entity) and id(schema) not in visited:
+            visited.add(id(schema))
+            keys.add(schema.key)
+            for subschema in schema.schema.values():
+                _walk(subschema)
+
+    _walk(schema)
+    return keys
+
+
+def pick_entities(inputData, schema, entities):
+    """normalizeされたinputDataが参照しているentityだけを、entitiesから抜き出す
+
+    filterで消されたentityを参照していればKeyError. 深いschemaでも再帰しない
+
+    :return: {key: {id: model}}
+    """
+    picked = {}
+    stack = [(inputData, schema)]
+    while stack:
+        value, schema = stack.pop()
+        if value is None:
+            continue
+        schema = schemaize(schema)
+        if isinstance(schema, ArraySchema):
+            stack.extend((item, schema.entity) for item in value)
+            continue
+
+        table = picked.setdefault(schema.key, {})
+        if value in table:
+            continue
+        model = table[value] = entities[schema.key][value]
+        if schema.schema:
+            data = model.to_dict()
+            stack.extend((data[subkey], subschema) for subkey, subschema in schema.schema.items() if subkey in data)
+    return picked
+
+
 def schemaize(schema):
     if not hasattr(schema, 'normalize'):
         if isinstance(schema, list):
             assert len(schema) == 1
             schema = ArraySchema(schema[0])
     return schema
+
+
+# schema compiler
+_plans = {}
+
+
+class CompiledSchema(object):
+    """schemaの木をnode毎の関数に展開したもの. compile_schemaで作る
+
+    自分自身を含むschemaは、node毎の関数の代わりに、stackを使ってloopで辿る.
+    """
+    __slots__ = ('schema', '_normalize', '_denormalize')
+
+    def __init__(self, schema, normalize, denormalize):
+        self.schema = schema
+        self._normalize = normalize
+        self._denormalize = denormalize
+
+    def normalize(self, inputData, entities=None):
+        """normalizeと同じ. inputDataは書き換えられる"""
+        if entities is None:
+            entities = {}
+        return entities, self._normalize(inputData, entities)
+
+    def denormalize(self, inputData, entities, shared=False, memo=None):
+        return self._denormalize(inputData, entities, {} if memo is None else memo, shared)
+
+
+def compile_schema(schema):
+    """Entity, [Entity], ArraySchemaからなるschemaをCompiledSchemaにする
+
+    結果はcacheされる. それ以外のSchemaを含んでいたり、normalize/denormalizeをoverrideしたEntityがあれば
+    Noneを返すので、normalize_generic/denormalize_genericを使うこと.
+    """
+    key = _get_plan_key(schema)
+    if key is None:
+        return None
+
+    try:
+        return _plans[key]
+    except KeyError:
+        pass
+
+    try:
+        if _is_recursive(schema):
+            # 自分自身を含むschemaはいくらでも深くなるので、再帰しない実装を使う
+            node = _build_node(schema, {})
+            plan = CompiledSchema(
+                schema, lambda value, entities: _normalize_iterative(value, node, entities),
+                lambda value, entities, memo, shared: _denormalize_iterative(value, node, entities, memo, shared))
+        else:
+            plan = CompiledSchema(schema, _compile_normalizer(schema), _compile_denormalizer(schema)[0])
+    except TypeError:
+        plan = None
+    _plans[key] = plan
+    return plan
+
+
+def _get_model_factory(klass):
+    """dictからmodelを作る関数. from_dictがあれば**kwargsを経由しない"""
+    from_dict = getattr(klass, 'from_dict', None)
+    if from_dict is not None:
+        return from_dict
+    return lambda data: klass(**data)
+
+
+def _get_plan_key(schema):
+    # list schemaは呼ばれる度に作られるので、中身のEntityで覚える
+    if isinstance(schema, (list, tuple)):
+        if len(schema) != 1:
+            return None
+        key = _get_plan_key(schema[0])
+        return ('array', key) if key is not None else None
+    elif isinstance(schema, ArraySchema):
+        key = _get_plan_key(schema.entity)
+        return ('array', key) if key is not None else None
+    elif isinstance(schema, Entity):
+        return schema
+    return None
+
+
+def _is_plain_entity(schema):
+    return (isinstance(schema, Entity) and type(schema).normalize is Entity.normalize and
+            type(schema).denormalize is Entity.denormalize)
+
+
+def _get_item_schema(schema):
+    return schema.entity if isinstance(schema, ArraySchema) else schema[0]
+
+
+def _is_recursive(schema, path=()):
+    """schemaが自分自身を含んでいればTrue"""
+    if isinstance(schema, (list, tuple, ArraySchema)):
+        return _is_recursive(_get_item_schema(schema), path)
+    if not _is_plain_entity(schema):
+        raise TypeError('can not compile {!r}'.format(schema))
+    if id(schema) in path:
+        return True
+    path += (id(schema), )
+    return any(_is_recursive(subschema, path) for subschema in schema.schema.values())
+
+
+def _compile_normalizer(schema):
+    if isinstance(schema, (list, tuple, ArraySchema)):
+        item = _compile_normalizer(_get_item_schema(schema))
+
+        def normalize_array(value, entities):
+            return [item(v, entities) for v in value]
+        return normalize_array
+
+    if not _is_plain_entity(schema):
+        raise TypeError('can not compile {!r}'.format(schema))
+
+    entity_key = schema.key
+    make_model = _get_model_factory(schema.klass)
+    get_id = schema.getId if type(schema).getId is not Entity.getId else None
+    subschemas = tuple((subkey, _compile_normalizer(subschema)) for subkey, subschema in schema.schema.items())
+
+    if subschemas:
+        def normalize_entity(value, entities):
+            if value is None:
+                return None
+            for subkey, sub in subschemas:
+                if subkey in value:
+                    value[subkey] = sub(value[subkey], entities)
+            value_id = get_id(value) if get_id else value['id']
+            try:
+                table = entities[entity_key]
+            except KeyError:
+                table = entities[entity_key] = {}
+            table[value_id] = make_model(value)
+            return value_id
+    else:
+        def normalize_entity(value, entities):
+            if value is None:
+                return None
+            value_id = get_id(value) if get_id else value['id']
+            try:
+                table = entities[entity_key]
+            except KeyError:
+                table = entities[entity_key] = {}
+            table[value_id] = make_model(value)
+            return value_id
+
+    return normalize_entity
+
+
+def _compile_denormalizer(schema):
+    """(denormalize, copy)を返す
+
+    denormalizeは1回の呼び出しの中で(schemaのnode, id)毎にentityを1回だけdictにし、2回目からはそれを使う.
+    同じkeyのentityでもnodeによってsub entityが違うので、keyではなくnodeで覚える.
+    sharedでなければ、copyでentity毎のdictだけ作り直して返す.
+    """
+    if isinstance(schema, (list, tuple, ArraySchema)):
+        item, item_copy = _compile_denormalizer(_get_item_schema(schema))
+
+        def denormalize_array(value, entities, memo, shared):
+            return [item(v, entities, memo, shared) for v in value]
+
+        def copy_array(value):
+            return [item_copy(v) for v in value]
+        return denormalize_array, copy_array
+
+    if not _is_plain_entity(schema):
+        raise TypeError('can not compile {!r}'.format(schema))
+
+    entity_key = schema.key
+    subschemas = tuple((subkey, ) + _compile_denormalizer(subschema) for subkey, subschema in schema.schema.items())
+
+    def copy_entity(data):
+        if data is None:
+            return None
+        data = dict(data)
+        for subkey, sub, sub_copy in subschemas:
+            value = data[subkey]
+            if value is not None:
+                data[subkey] = sub_copy(value)
+        return data
+
+    def denormalize_entity(value, entities, memo, shared):
+        if value is None:
+            return None
+
+        memo_key = (schema, value)
+        try:
+            data = memo[memo_key]
+        except KeyError:
+            pass
+        else:
+            return data if shared else copy_entity(data)
+
+        # sub entityがなければmodelのdictをそのまま使う. あればidを書き換えるのでコピーする
+        data = entities[entity_key][value].to_dict()
+        if subschemas:
+            data = dict(data)
+            for subkey, sub, sub_copy in subschemas:
+                if subkey not in data:
+                    data[subkey] = None
+                else:
+                    data[subkey] = sub(data[subkey], entities, memo, shared)
+        memo[memo_key] = data
+        return data
+
+    return denormalize_entity, copy_entity
+
+
+class _Node(object):
+    """_normalize_iterative/_denormalize_iterative用のschemaのnode
+
+    Entityならentity_keyとsubschemas, arrayならitemを持つ. 自分自身を含むschemaは、nodeも自分自身を指す
+    """
+    __slots__ = ('entity_key', 'make_model', 'get_id', 'subschemas', 'item')
+
+
+def _build_node(schema, nodes):
+    node = _Node()
+    if isinstance(schema, (list, tuple, ArraySchema)):
+        node.entity_key = None
+        node.item = _build_node(_get_item_schema(schema), nodes)
+        return node
+
+    if id(schema) in nodes:
+        return nodes[id(schema)]
+    nodes[id(schema)] = node
+    node.entity_key = schema.key
+    node.make_model = _get_model_factory(schema.klass)
+    node.get_id = schema.getId if type(schema).getId is not Entity.getId else None
+    node.subschemas = tuple((subkey, _build_node(subschema, nodes)) for subkey, subschema in schema.schema.items())
+    node.item = None
+    return node
+
+
+def _normalize_iterative(value, node, entities):
+    """_compile_normalizerと同じ結果を、再帰せずに作る
+
+    stackには(value, node, 書き込む先のcontainer, key, sub entityを処理し終わったか)を積む.
+    同じ順番でentityを登録するように、子は逆順に積む.
+    """
+    root = [value]
+    stack = [(value, node, root, 0, False)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        value, node, parent, key, done = pop()
+        if value is None:
+            continue
+
+        if node.entity_key is None:
+            # arrayはその場でidに書き換える
+            if not isinstance(value, list):
+                value = parent[key] = list(value)
+            item = node.item
+            for index in range(len(value) - 1, -1, -1):
+                push((value[index], item, value, index, False))
+        elif not done:
+            push((value, node, parent, key, True))
+            for subkey, sub in reversed(node.subschemas):
+                if subkey in value:
+                    push((value[subkey], sub, value, subkey, False))
+        else:
+            value_id = node.get_id(value) if node.get_id else value['id']
+            try:
+                table = entities[node.entity_key]
+            except KeyError:
+                table = entities[node.entity_key] = {}
+            table[value_id] = node.make_model(value)
+            parent[key] = value_id
+    return root[0]
+
+
+def _denormalize_iterative(value, node, entities, memo, shared):
+    """_compile_denormalizerと同じ結果を、再帰せずに作る
+
+    entityはdictにしたらすぐmemoに入れ、sub entityはstackから取り出した時にそのdictに書き込む.
+    """
+    root = [value]
+    stack = [(value, node, root, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        value, node, parent, key = pop()
+        if value is None:
+            parent[key] = None
+            continue
+
+        if node.entity_key is None:
+            items = parent[key] = list(value)
+            item = node.item
+            for index in range(len(items) - 1, -1, -1):
+                push((items[index], item, items, index))
+            continue
+
+        memo_key = (node, value)
+        try:
+            data = memo[memo_key]
+        except KeyError:
+            pass
+        else:
+            parent[key] = data if shared else _copy_iterative(data, node)
+            continue
+
+        data = entities[node.entity_key][value].to_dict()
+        if node.subschemas:
+            data = dict(data)
+        parent[key] = memo[memo_key] = data
+        for subkey, sub in node.subschemas:
+            if subkey not in data:
+                data[subkey] = None
+        for subkey, sub in reversed(node.subschemas):
+            push((data[subkey], sub, data, subkey))
+    return root[0]
+
+
+def _copy_iterative(value, node):
+    """denormalizeしたdictを、entity毎に作り直す"""
+    root = [value]
+    stack = [(value, node, root, 0)]
+    while stack:
+        value, node, parent, key = stack.pop()
+        if value is None:
+            continue
+        if node.entity_key is None:
+            items = parent[key] = list(value)
+            stack.extend((item, node.item, items, index) for index, item in enumerate(items))
+        else:
+            data = parent[key] = dict(value)
+            stack.extend((data[subkey], sub, data, subkey) for subkey, sub in node.subschemas)
+    return root[0]
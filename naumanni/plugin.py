@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
-import json
 import os
 import pkg_resources
 from weakref import ref as weakref
 
+from . import jsoncodec
+
 
 class Plugin(object):
     def __init__(self, app, module_name, plugin_id):
@@ -38,7 +39,7 @@ class Plugin(object):
         package_json = pkg_resources.resource_string(self._module_name, 'package.json')
         if not package_json:
             return None
-        package_json = json.loads(package_json)
+        package_json = jsoncodec.loads(package_json)
         return package_json.get('name')
 
     @property
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""utility functions."""
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+def normalize_url(url):
+    """cacheなどのkeyにするため、hostを小文字にしてqueryを並べ替える"""
+    t = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(t.query, keep_blank_values=False)))
+    return urlunsplit((t.scheme.lower(), t.netloc.lower(), t.path, query, ''))
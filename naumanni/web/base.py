@@ -1,7 +1,96 @@
 # -*- coding: utf-8 -*-
+from .. import jsoncodec, msgpackcodec
+
+# clientがnormalizeしたまま({entities, result})のresponseを受け取る時の指定.
+# websocketはheaderを付けられないので、queryでも指定できる. queryはupstreamには渡さない
+RESPONSE_MODE_HEADER = 'X-Naumanni-Response'
+RESPONSE_MODE_QUERY = 'naumanni_response'
+RESPONSE_MODE_NORMALIZED = 'normalized'
+RESPONSE_MODES = frozenset([RESPONSE_MODE_NORMALIZED])
+
+# responseをMessagePackで受け取る時の指定. proxyはAccept, websocketはsubprotocolでも指定できる
+RESPONSE_FORMAT_QUERY = 'naumanni_format'
+RESPONSE_FORMAT_MSGPACK = 'msgpack'
+MSGPACK_SUBPROTOCOL = 'naumanni.msgpack'
+# JSONを受け取れるAccept. MessagePackとqを比べる
+JSON_ACCEPT_TYPES = frozenset(['application/json', 'application/*', '*/*'])
+
+# websocketで、eventをまとめて1つのframeで受け取る時の指定. naumanni_batch=1
+BATCH_QUERY = 'naumanni_batch'
 
 
 class NaumanniRequestHandlerMixIn(object):
     @property
     def naumanni_app(self):
         return self.application.settings['naumanni_app']
+
+    def get_response_options(self):
+        """(response mode, response format, それらの指定を除いたquery)を返す
+
+        指定がなかったり、使えないものが指定されていればNone
+        """
+        mode = self.request.headers.get(RESPONSE_MODE_HEADER)
+        response_format = _negotiate_format(self.request.headers.get('Accept', ''))
+
+        query = self.request.query
+        value, query = pop_query_param(query, RESPONSE_MODE_QUERY)
+        if value is not None:
+            mode = value
+        value, query = pop_query_param(query, RESPONSE_FORMAT_QUERY)
+        if value is not None:
+            response_format = value
+
+        if mode not in RESPONSE_MODES:
+            mode = None
+        if response_format != RESPONSE_FORMAT_MSGPACK or not msgpackcodec.available:
+            response_format = None
+        return mode, response_format, query
+
+
+def pop_query_param(query, name):
+    """queryからnameのparameterを取り除き、(値, 残りのquery)を返す. 値はdecodeしない
+
+    他のparameterのencodingは変えない. なければ値はNone
+    """
+    if not query:
+        return None, query
+    prefix = name + '='
+    value = None
+    params = []
+    for param in query.split('&'):
+        if param.startswith(prefix):
+            value = param[len(prefix):]
+        else:
+            params.append(param)
+    return value, '&'.join(params)
+
+
+def _negotiate_format(accept):
+    """Acceptから、MessagePackで返すならRESPONSE_FORMAT_MSGPACK. JSONならNone
+
+    qの一番高いものを選ぶ. 同じならMessagePack. q=0は受け取れないという意味
+    """
+    qualities = {}
+    for value in accept.split(','):
+        media_type, *params = value.split(';')
+        quality = 1.0
+        for param in params:
+            name, _, param_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        media_type = media_type.strip().lower()
+        qualities[media_type] = max(quality, qualities.get(media_type, 0.0))
+
+    msgpack_quality = max(qualities.get(media_type, 0.0) for media_type in msgpackcodec.ACCEPT_TYPES)
+    json_quality = max(qualities.get(media_type, 0.0) for media_type in JSON_ACCEPT_TYPES)
+    if msgpack_quality > 0 and msgpack_quality >= json_quality:
+        return RESPONSE_FORMAT_MSGPACK
+    return None
+
+
+def get_codec(response_format):
+    """response formatのcodec. loads, dumps, CONTENT_TYPEを持つ"""
+    return msgpackcodec if response_format == RESPONSE_FORMAT_MSGPACK else jsoncodec
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""normalizeしたresponseから、clientが既に持っているentityを省く.
+
+clientは持っているentityを `X-Naumanni-Known-Entities: statuses=1@1a2b3c4d,2@5e6f7a8b;accounts=3@...` のように
+key毎の `id@version` で送ってくる. versionはentityをkeyの順に並べたJSONのcrc32で、responseの `versions` で教える.
+clientがJSONとMessagePackのどちらで受け取っていても、同じentityは同じversionになる.
+versionが同じentityは `entities` から省き、`unchanged` にidだけを入れる.
+
+headerは大きくできないので、送ってよいのはMAX_KNOWN_ENTITIES個まで. clientは最近使ったものから送ること.
+"""
+import zlib
+
+from .. import jsoncodec
+
+
+KNOWN_ENTITIES_HEADER = 'X-Naumanni-Known-Entities'
+# deltaにしたresponseのX-Naumanni-Response
+RESPONSE_MODE_DELTA = 'delta'
+# headerに書けるentityの数. これより後ろは読まない
+# snowflakeのidだと1つ28byte位なので、proxyやserverのheader 1行の上限(多くは8KB)に収まるようにする
+MAX_KNOWN_ENTITIES = 200
+
+
+def parse_known_entities(value):
+    """headerの値を{key: {id: version}}にする. 読めないところは飛ばす"""
+    known = {}
+    count = 0
+    for group in value.split(';'):
+        key, sep, digests = group.strip().partition('=')
+        if not sep:
+            continue
+        table = known.setdefault(key, {})
+        for digest in digests.split(','):
+            entity_id, sep, version = digest.strip().partition('@')
+            if not sep:
+                continue
+            table[entity_id] = version
+            count += 1
+            if count >= MAX_KNOWN_ENTITIES:
+                return known
+    return known
+
+
+def get_entity_version(data):
+    return '{:08x}'.format(zlib.crc32(jsoncodec.dumps_canonical(data)))
+
+
+def make_delta(normalized, known):
+    """{entities, result}からknownと同じversionのentityを省き、versionsとunchangedを足す
+
+    :param dict normalized: JSONからloadsしたもの. idはstrになっている
+    :param dict known: parse_known_entitiesの結果
+    """
+    entities = {}
+    versions = {}
+    unchanged = {}
+    for key, table in normalized['entities'].items():
+        known_table = known.get(key, {})
+        sent = entities[key] = {}
+        sent_versions = versions[key] = {}
+        for entity_id, data in table.items():
+            version = get_entity_version(data)
+            if known_table.get(entity_id) == version:
+                unchanged.setdefault(key, []).append(entity_id)
+            else:
+                sent[entity_id] = data
+                sent_versions[entity_id] = version
+
+    return {
+        'entities': entities,
+        'result': normalized['result'],
+        'versions': versions,
+        'unchanged': unchanged,
+    }
@@ -1,32 +1,53 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
-import json
 import re
 from urllib.parse import quote, urlsplit, urlunsplit
 
-from tornado import gen, httpclient, queues, web
+import pycurl
+from tornado import gen, httpclient, httputil, ioloop, locks, web
 import tornado.web
-from tornado.curl_httpclient import CurlAsyncHTTPClient
-from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from werkzeug.exceptions import NotFound
 
-from .base import NaumanniRequestHandlerMixIn
-from ..mastodon_api import normalize_mastodon_response, denormalize_mastodon_response
+from .base import (
+    NaumanniRequestHandlerMixIn, RESPONSE_FORMAT_MSGPACK, RESPONSE_MODE_HEADER, RESPONSE_MODE_NORMALIZED, get_codec
+)
+from .delta import KNOWN_ENTITIES_HEADER, RESPONSE_MODE_DELTA, make_delta, parse_known_entities
+from .upload import DEFAULT_QUEUE_SIZE, DEFAULT_SPOOL_THRESHOLD, UploadAborted, UploadBuffer
+from .. import jsoncodec
+from ..mastodon_api import (
+    get_response_cache_ttl, get_schema, is_prefetchable, normalize_mastodon_response, denormalize_mastodon_response,
+    pick_mastodon_entities, to_normalized_response
+)
+from ..utils import normalize_url
 
 
 logger = logging.getLogger(__name__)
 https_prefix_rex = re.compile('^https?://?')
 mastodon_api_rex = re.compile(r'^https?://(?P<host>[^/]+)/api/v1(?P<api>/.*?)(?:\?.*)?$')
-FINISH_MARKER = object()
+link_next_rex = re.compile(r'<([^>]+)>\s*;\s*rel="next"')
 
 PASS_REQUEST_HEADERS = [
     'Accept', 'Accept-Language', 'Authorization', 'Content-Type', 'Referer', 'User-Agent'
 ]
 PASS_RESPONSE_HEADERS = [
-    'Content-Type', 'Date',
+    'Content-Type', 'Date', 'Link',
     'X-Frame-Options', 'X-Content-Type-Options', 'X-Xss-Protection', 'X-Ratelimit-Limit', 'X-Ratelimit-Remaining',
     'X-Ratelimit-Reset',
 ]
+# cacheするresponseで落とすheader. rate limitはhitした時にはもう古い
+CACHED_RESPONSE_EXCLUDE_HEADERS = {
+    'X-Ratelimit-Limit', 'X-Ratelimit-Remaining', 'X-Ratelimit-Reset',
+}
+# streamingでpassするときに落とすheader
+HOP_BY_HOP_RESPONSE_HEADERS = {
+    'Connection', 'Content-Encoding', 'Content-Length', 'Keep-Alive', 'Transfer-Encoding',
+}
+# clientへの書き出しがこれ以上溜まったら、upstreamからの受信をpauseする
+STREAM_HIGH_WATER_MARK = 256 * 1024
+STREAM_LOW_WATER_MARK = 64 * 1024
+# uploadは大きいので、全体のtimeoutを長くとる
+DEFAULT_UPLOAD_REQUEST_TIMEOUT = 300.0
 
 
 @tornado.web.stream_request_body
@@ -34,10 +55,11 @@ class APIProxyHandler(tornado.web.RequestHandler, NaumanniRequestHandlerMixIn):
     SUPPORTED_METHODS = ['GET', 'DELETE', 'PATCH', 'POST', 'PUT']
 
     def prepare(self):
-        self.data_queue = queues.Queue()
-        self.total_bytes = 0
-
         self.content_length = None
+        self.upload = None
+        self.run_future = None
+        # post()などがrun_futureを返して、tornadoがawaitしている
+        self._run_future_taken = False
         if self.request.method in ('PATCH', 'POST', 'PUT'):
             content_length = self.request.headers.get('Content-Length')
             if not content_length:
@@ -46,6 +68,49 @@ class APIProxyHandler(tornado.web.RequestHandler, NaumanniRequestHandlerMixIn):
 
             self.content_length = int(content_length, 10)
 
+        self.response_cache_ttl = None
+        self.response_mode, self.response_format, self.upstream_query = self.get_response_options()
+        self.codec = get_codec(self.response_format)
+        # 同じurlでもmodeとformatでbodyが違うので、cacheや先読みを分ける
+        self.response_variant = ':'.join(v for v in (self.response_mode, self.response_format) if v) or None
+        # clientが持っているentity. headerがあれば、normalizeしたresponseをdeltaにする
+        self.known_entities = None
+        if KNOWN_ENTITIES_HEADER in self.request.headers:
+            self.known_entities = parse_known_entities(self.request.headers[KNOWN_ENTITIES_HEADER])
+
+        # upstreamのresponse
+        self.upstream_start_line = None
+        self.upstream_headers = None
+        self.upstream_chunks = []
+        self.streaming = False
+        # clientに流している途中でupstreamが切れた
+        self.stream_broken = False
+        self.stream_pending_bytes = 0
+        self._stream_flushing = False
+        self._stream_flushed = locks.Event()
+        self._stream_flushed.set()
+        self.client_closed = False
+        # single-flightのleaderとして取っている. followerが待っているので、clientが切れても中断しない
+        self.coalescing = False
+        self._curl = None
+        self._curl_queued_bytes = 0
+        self._curl_paused = False
+
+        if self.content_length:
+            self._start_upload()
+
+    def on_connection_close(self):
+        # stream_request_bodyでbodyを待っている_executeを終わらせる
+        super().on_connection_close()
+        self.client_closed = True
+        # pause中なら再開させて、write functionで転送を止めさせる
+        self._resume_upstream()
+        if self.upload is not None:
+            self.upload.abort()
+        if self.run_future is not None and not self._run_future_taken:
+            # bodyを受け取りきる前に切れたので、post()は呼ばれない. 誰もawaitしないので止める
+            self.run_future.cancel()
+
     def get(self, *args, **kwargs):
         return self.run(*args, **kwargs)
 
@@ -53,22 +118,56 @@ class APIProxyHandler(tornado.web.RequestHandler, NaumanniRequestHandlerMixIn):
         return self.run(*args, **kwargs)
 
     def patch(self, *args, **kwargs):
-        return self.run(*args, **kwargs)
+        return self._take_run_future() or self.run(*args, **kwargs)
 
     def post(self, *args, **kwargs):
-        return self.run(*args, **kwargs)
+        return self._take_run_future() or self.run(*args, **kwargs)
 
     def put(self, *args, **kwargs):
-        return self.run(*args, **kwargs)
+        return self._take_run_future() or self.run(*args, **kwargs)
+
+    async def data_received(self, chunk):
+        if self.upload is not None:
+            await self.upload.write(chunk)
+
+    # upload
+    def _start_upload(self):
+        """bodyを受け取りながらupstreamに流すので、body全部を待たずにrequestを始める"""
+        # 503にする時は、まだrequestを始めていない
+        if not self.naumanni_app.upload_budget.acquire(self.content_length):
+            raise tornado.web.HTTPError(503)
+
+        config = self.naumanni_app.config
+        self.upload = UploadBuffer(
+            self.content_length,
+            queue_size=getattr(config, 'upload_queue_size', DEFAULT_QUEUE_SIZE),
+            spool_threshold=getattr(config, 'upload_spool_threshold', DEFAULT_SPOOL_THRESHOLD),
+        )
+        self.run_future = gen.convert_yielded(self._run_upload(**self.path_kwargs))
+        self.run_future.add_done_callback(self._on_upload_done)
 
-    def data_received(self, chunk):
-        if self.content_length is None:
+    def _take_run_future(self):
+        self._run_future_taken = True
+        return self.run_future
+
+    def _on_upload_done(self, future):
+        """post()がawaitしないまま終わったuploadの例外を受け取る. 受け取らないとasyncioがlogする"""
+        if self._run_future_taken or future.cancelled():
             return
-        self.data_queue.put(chunk)
+        exc = future.exception()
+        if exc is not None:
+            logger.debug('upload failed before the body was received: %r', exc)
 
-        self.total_bytes += len(chunk)
-        if self.total_bytes >= self.content_length:
-            self.data_queue.put(FINISH_MARKER)
+    async def _run_upload(self, request_url):
+        upload = self.upload
+        try:
+            await self.run(request_url)
+        except UploadAborted:
+            logger.info('upload aborted: %s', request_url)
+        finally:
+            upload.close()
+            self.upload = None
+            self.naumanni_app.upload_budget.release(self.content_length)
 
     async def run(self, request_url):
         request_url = self._fix_request_url(request_url)
@@ -82,20 +181,87 @@ class APIProxyHandler(tornado.web.RequestHandler, NaumanniRequestHandlerMixIn):
             raise tornado.web.HTTPError(401)
         # TODO: ホスト名チェック
 
-        # pass request to mastodon
+        # public timelineなどのapiなら、cacheを見る. blockやmuteはtoken毎に違うので、token毎に分ける
+        self.response_cache_ttl = self._get_response_cache_ttl()
+        if self.response_cache_ttl:
+            cached = await self.naumanni_app.response_cache.get(
+                self._get_token_scope(), request_url, variant=self.response_variant)
+            if cached is not None:
+                response_headers, response_body = cached
+                await self._write_response(200, None, response_headers, response_body)
+                return
+
+        # 先読みしてあれば、それを返す
+        result = None
+        if self._is_prefetchable():
+            result = await self.naumanni_app.prefetcher.get(
+                self.request.headers['Authorization'], request_url, variant=self.response_variant)
+
+        # 同じGETが同時に来ていたら、1回のupstream requestとfilterで済ませる
+        if result is None and self._is_coalescable():
+            result = await self.naumanni_app.single_flight.do(
+                self._get_single_flight_key(request_url), self._fetch_coalesced, request_url)
+        if result is None and not self.streaming:
+            result = await self._fetch_response(request_url)
+
+        if self.streaming:
+            # headerもbodyもclientに流し終わっている. 書き出し中のflushを待ってからfinishする
+            await self._stream_flushed.wait()
+            if self.stream_broken and not self.client_closed:
+                # 途中で終わったbodyを、正常なresponseに見せない
+                self.request.connection.close()
+            elif not self.client_closed:
+                self.finish()
+            return
+
+        if self.client_closed:
+            # followerのためにresponseは受け取ったが、このclientはもういない
+            return
+        if self._is_prefetchable():
+            self._schedule_prefetch(*result)
+        await self._write_response(*result)
+
+    async def _fetch_coalesced(self, request_url):
+        self.coalescing = True
+        try:
+            return await self._fetch_response(request_url)
+        finally:
+            self.coalescing = False
+
+    async def _fetch_response(self, request_url):
+        """upstreamから取ってきてfilterした(code, reason, headers, body)を返す. clientに流した場合はNone"""
         response = await self._pass_request(request_url)
+        if self.streaming:
+            return None
+
+        body = b''.join(self.upstream_chunks)
+        normalized = response.code == 200 and self._is_normalized_response(response.headers)
         if response.code == 200:
-            response_body = await self._filter_response(request_url, response)
-            response_headers = _filter_dict(response.headers, PASS_RESPONSE_HEADERS)
-            response_headers['Cache-Control'] = 'max-age=0, private, must-revalidate'
+            response_body = await self._filter_response(request_url, response, body, normalized)
         else:
-            response_body, response_headers = response.body, response.headers
-
-        # response
-        self.set_status(response.code)
-        for k, v in response_headers.items():
+            response_body = body
+        response_headers = self._build_response_headers(
+            response.code, response.headers, normalized, codec=self._get_response_codec(response))
+
+        if self.response_cache_ttl and response.code == 200 and self._is_api_json(response.headers):
+            await self.naumanni_app.response_cache.set(
+                self._get_token_scope(), request_url, response_headers, response_body, self.response_cache_ttl,
+                variant=self.response_variant)
+
+        return response.code, response.reason, response_headers, response_body
+
+    async def _write_response(self, code, reason, headers, body):
+        if code == 200 and self.known_entities is not None and \
+                headers.get(RESPONSE_MODE_HEADER) == RESPONSE_MODE_NORMALIZED:
+            # cacheやsingle flightのresponseは他のclientと共有しているので、書き出す時にclient毎に作る
+            body = self.codec.dumps(make_delta(self.codec.loads(body), self.known_entities))
+            headers = dict(headers)
+            headers[RESPONSE_MODE_HEADER] = RESPONSE_MODE_DELTA
+
+        self.set_status(code, reason)
+        for k, v in headers.items():
             self.set_header(k, v)
-        self.write(response_body)
+        self.write(body)
         await self.flush()
         self.finish()
 
@@ -105,10 +271,65 @@ class APIProxyHandler(tornado.web.RequestHandler, NaumanniRequestHandlerMixIn):
             return False
         return True
 
+    def _is_coalescable(self):
+        """schemaのあるapiへの、bufferして返すGETだけをまとめる. streamingするresponseは共有できない"""
+        if self.request.method != 'GET' or not self.request_api or self._get_schema() is None:
+            return False
+        return self._will_buffer()
+
+    def _is_prefetchable(self):
+        """tokenごとのtimelineのGETだけ、次のpageを先読みする"""
+        if (self.naumanni_app.prefetcher is None or self.request.method != 'GET' or not self.request_api or
+                self.response_cache_ttl or 'Authorization' not in self.request.headers):
+            return False
+        try:
+            return is_prefetchable(self.request_api)
+        except NotFound:
+            return False
+
+    def _schedule_prefetch(self, code, reason, headers, body):
+        """responseのLinkヘッダにnextがあれば、backgroundで取っておく"""
+        if code != 200:
+            return
+        mo = link_next_rex.search(headers.get('Link', ''))
+        if not mo:
+            return
+
+        # tokenを渡すので、同じhostのapiだけ
+        next_url = mo.group(1)
+        mo = mastodon_api_rex.match(next_url)
+        if not mo or mo.group('host') != self.request_host:
+            return
+
+        request_headers = self._get_upstream_headers(PASS_REQUEST_HEADERS)
+        request_headers.pop('Content-Type', None)
+        self.naumanni_app.prefetcher.schedule(
+            request_headers['Authorization'], next_url, request_headers,
+            _finalize_prefetched, self.naumanni_app, mo.group('api'), self.response_mode == RESPONSE_MODE_NORMALIZED,
+            self.codec, variant=self.response_variant)
+
+    def _get_single_flight_key(self, request_url):
+        return '{}:{}:{}'.format(self._get_token_scope(), self.response_variant or '', normalize_url(request_url))
+
+    def _get_token_scope(self):
+        """cacheとsingle-flightでresponseをtoken毎に分けるためのtokenのhash"""
+        authorization = self.request.headers.get('Authorization')
+        if not authorization:
+            return ''
+        return hashlib.sha1(authorization.encode('utf-8')).hexdigest()
+
+    def _get_response_cache_ttl(self):
+        if self.request.method != 'GET' or not self.request_api:
+            return None
+        try:
+            return get_response_cache_ttl(self.request_api)
+        except NotFound:
+            return None
+
     def _fix_request_url(self, request_url):
         request_url = request_url.encode('latin1').decode('utf-8')
-        if self.request.query:
-            request_url = '{}?{}'.format(request_url, self.request.query)
+        if self.upstream_query:
+            request_url = '{}?{}'.format(request_url, self.upstream_query)
 
         # fix url
         mo = https_prefix_rex.match(request_url)
@@ -124,64 +345,295 @@ class APIProxyHandler(tornado.web.RequestHandler, NaumanniRequestHandlerMixIn):
         request_args = {}
         pass_headers = PASS_REQUEST_HEADERS
         if self.content_length:
-            # CurlAsyncHTTPClientがbody_producerを使えないため
-            fetcher = SimpleAsyncHTTPClient
-            pass_headers += ['Content-Length']
-            async def _produce_body(write):
-                async for buf in self.data_queue:
-                    if buf is FINISH_MARKER:
-                        break
-                    write(buf)
-
+            pass_headers = pass_headers + ['Content-Length']
             request_args = {
-                'body_producer': _produce_body
+                'body_producer': self.upload.produce,
+                'request_timeout': getattr(
+                    self.naumanni_app.config, 'upload_request_timeout', DEFAULT_UPLOAD_REQUEST_TIMEOUT),
             }
-        else:
-            fetcher = CurlAsyncHTTPClient
 
         # build request
         request = httpclient.HTTPRequest(
             url=request_url,
             method=self.request.method,
-            headers=_filter_dict(self.request.headers, pass_headers),
+            headers=self._get_upstream_headers(pass_headers),
+            header_callback=self._on_upstream_header_line,
+            streaming_callback=self._on_upstream_chunk,
+            prepare_curl_callback=self._prepare_curl,
             **request_args
         )
-        response = await fetcher().fetch(request)
+        try:
+            # clientが切れて中断したものは、hostの不調ではない
+            response = await self.naumanni_app.upstream_pool.fetch(
+                request, raise_error=False, aborted=lambda: self.client_closed)
+        except Exception:
+            if self.upload is not None and self.upload.aborted:
+                raise UploadAborted()
+            raise
+        finally:
+            self._curl = None
+
+        if response.code == 599 and self.upload is not None and self.upload.aborted:
+            # clientが切れて、body_producerが送るのをやめた. upstreamのエラーではない
+            raise UploadAborted()
+        if response.code == 599 and not self.streaming:
+            # upstreamに繋がらなかった
+            logger.warning('upstream error: %s %r', request_url, response.error)
+            raise tornado.web.HTTPError(502)
+        if response.code == 599:
+            # headerはもうclientに送ってしまったので、502にはできない
+            logger.warning('upstream error while streaming: %s %r', request_url, response.error)
+            self.stream_broken = True
         return response
 
-    async def _filter_response(self, url, response):
-        content_type = response.headers['Content-Type']
-        if ';' in content_type:
-            content_type = content_type.split(';')[0].lower()
+    def _get_upstream_headers(self, pass_headers):
+        headers = _filter_dict(self.request.headers, pass_headers)
+        if self.response_format == RESPONSE_FORMAT_MSGPACK and 'Accept' in headers:
+            # MessagePackにするのはnaumanniなので、upstreamにはJSONを頼む
+            headers['Accept'] = 'application/json'
+        return headers
+
+    # upstream streaming
+    def _prepare_curl(self, curl):
+        """curlのwrite functionを差し替えて、clientへの書き出しが詰まったら受信をpauseさせる"""
+        self._curl = curl
+        io_loop = ioloop.IOLoop.current()
+
+        def _write_function(chunk):
+            if self.client_closed and (self.streaming or not self.coalescing):
+                # 0を返すとcurlは転送を中断する. followerと共有するresponseは最後まで受け取る
+                return 0
+            if self._curl_queued_bytes + self.stream_pending_bytes >= STREAM_HIGH_WATER_MARK:
+                self._curl_paused = True
+                return pycurl.WRITEFUNC_PAUSE
+            self._curl_queued_bytes += len(chunk)
+            io_loop.add_callback(self._on_curl_chunk, chunk)
+
+        curl.setopt(pycurl.WRITEFUNCTION, _write_function)
+
+    def _on_curl_chunk(self, chunk):
+        self._curl_queued_bytes -= len(chunk)
+        self._on_upstream_chunk(chunk)
+        # bufferする時はflushが起きないので、ここで再開させる
+        self._resume_upstream()
+
+    def _resume_upstream(self):
+        if not self._curl_paused or self._curl is None:
+            return
+        if not self.client_closed and \
+                self._curl_queued_bytes + self.stream_pending_bytes >= STREAM_LOW_WATER_MARK:
+            return
+        self._curl_paused = False
+        try:
+            self._curl.pause(pycurl.PAUSE_CONT)
+        except pycurl.error:
+            # client切断でwrite functionが転送を中断した
+            pass
+
+    def _on_upstream_header_line(self, line):
+        if line.startswith('HTTP/'):
+            self.upstream_start_line = httputil.parse_response_start_line(line.strip())
+            self.upstream_headers = httputil.HTTPHeaders()
+        elif line.strip():
+            self.upstream_headers.parse_line(line)
+        else:
+            self._on_upstream_headers()
 
-        # API responseじゃなかったらlogして返す
-        if not (self.request_api and content_type == 'application/json'):
-            logger.warning('unknown request: %s %s', api, content_type)
-            return response.body
+    def _on_upstream_headers(self):
+        """upstreamのheaderが揃った. filterしないresponseなら、ここからclientに流す"""
+        code = self.upstream_start_line.code
+        if code < 200 or (code in (301, 302, 303, 307, 308) and 'Location' in self.upstream_headers):
+            # 100-continueとredirectは次のheaderを待つ
+            return
+        if code == 200 and self._should_buffer(self.upstream_headers):
+            return
+
+        self.streaming = True
+        if self.client_closed:
+            return
+        self.set_status(code, self.upstream_start_line.reason)
+        for k, v in self._build_response_headers(code, self.upstream_headers).items():
+            self.set_header(k, v)
+        self._flush_stream()
+
+    def _on_upstream_chunk(self, chunk):
+        if not self.streaming:
+            self.upstream_chunks.append(chunk)
+            return
+        if self.client_closed:
+            return
 
+        self.write(chunk)
+        self.stream_pending_bytes += len(chunk)
+        self._flush_stream()
+
+    def _flush_stream(self):
+        """clientへflushする. HTTP1Connectionは同時に1つのflushしか待てないので直列にする"""
+        if self._stream_flushing:
+            return
+        self._stream_flushing = True
+        self._stream_flushed.clear()
+        flushing_bytes = self.stream_pending_bytes
+
+        def _on_flushed(f):
+            self._stream_flushing = False
+            self.stream_pending_bytes -= flushing_bytes
+            if f.exception() is not None:
+                self.client_closed = True
+            elif self.stream_pending_bytes:
+                self._flush_stream()
+            if not self._stream_flushing:
+                self._stream_flushed.set()
+            self._resume_upstream()
+        gen.convert_yielded(self.flush()).add_done_callback(_on_flushed)
+
+    def _should_buffer(self, headers):
+        """filterするかcacheに入れるか、MessagePackにするresponseは、全部受け取ってから返す"""
+        return self._is_api_json(headers) and self._will_buffer()
+
+    def _will_buffer(self):
+        """apiのJSONが返ってきたら、全部受け取ってからclientに返すか"""
+        return bool(self.response_cache_ttl or self.codec is not jsoncodec or self._get_filtered_keys() or
+                    self._is_prefetchable() or
+                    (self.response_mode == RESPONSE_MODE_NORMALIZED and self._get_schema() is not None))
+
+    def _is_api_json(self, headers):
+        return bool(self.request_api) and _get_content_type(headers) == 'application/json'
+
+    def _is_normalized_response(self, headers):
+        """clientがnormalizeしたままのresponseを指定していて、schemaのあるapiのJSONならTrue"""
+        return self.response_mode == RESPONSE_MODE_NORMALIZED and self._is_api_json(headers) and \
+            self._get_schema() is not None
+
+    def _get_schema(self):
         try:
-            responseBody = json.loads(response.body)
-            entities, result = normalize_mastodon_response(self.request_api, responseBody)
-            await self._filter_entities(entities)
-            denormalized = denormalize_mastodon_response(self.request_api, result, entities)
-            return json.dumps(denormalized)
+            return get_schema(self.request_api)
         except NotFound:
-            return response.body
+            return None
 
-    def _filter_entities(self, entities):
-        return _filter_entities(self.naumanni_app, entities)
+    def _get_filtered_keys(self):
+        """request_apiのschemaで、pluginがfilterするentityのkey. schemaがなければ空"""
+        schema = self._get_schema()
+        if schema is None:
+            return set()
+        return self.naumanni_app.get_filtered_keys(schema)
 
+    def _get_response_codec(self, response):
+        """bodyのcodec. 変換するのはapiのJSONの200だけ"""
+        if response.code == 200 and self._is_api_json(response.headers):
+            return self.codec
+        return jsoncodec
 
-async def _filter_entities(app, entities):
-    for key in entities.keys():
-        def _result_hook(result, kwargs):
-            kwargs['objects'] = entities[key] = result
-            return kwargs
+    def _build_response_headers(self, code, headers, normalized=False, codec=jsoncodec):
+        return _build_response_headers(
+            code, headers, cached=bool(self.response_cache_ttl), normalized=normalized, codec=codec)
 
-        await app.emit_async(
-            'filter-{}'.format(key),
-            objects=entities[key], entities=entities,
-            _result_hook=_result_hook)
+    async def _filter_response(self, url, response, body, normalized=False):
+        content_type = _get_content_type(response.headers)
+
+        # API responseじゃなかったらlogして返す
+        if not (self.request_api and content_type == 'application/json'):
+            logger.warning('unknown request: %s %s', self.request_api, content_type)
+            return body
+
+        return await _filter_body(self.naumanni_app, self.request_api, body, normalized, self.codec)
+
+
+async def _filter_body(naumanni_app, api, body, normalized=False, codec=jsoncodec):
+    """API responseのbodyをpluginでfilterする
+
+    :param bool normalized: Trueなら、denormalizeせずに{entities, result}のまま返す
+    :param codec: 返すbodyのcodec. jsoncodecかmsgpackcodec
+    """
+    # filterするpluginがいなければ、normalizeせずにそのまま返す
+    try:
+        schema = get_schema(api)
+    except NotFound:
+        schema = None
+    if schema is None or (not normalized and not naumanni_app.get_filtered_keys(schema)):
+        return body if codec is jsoncodec else codec.dumps(jsoncodec.loads(body))
+
+    # normalizeはresponseBodyをその場で書き換える. responseBodyは後で使わない
+    responseBody = jsoncodec.loads(body)
+    entities, result = normalize_mastodon_response(api, responseBody)
+    await naumanni_app.filter_entities(entities)
+    if normalized:
+        return codec.dumps(_pick_filtered(api, result, entities))
+    return codec.dumps(_denormalize_filtered(api, result, entities))
+
+
+def _pick_filtered(api, result, entities):
+    """normalizeしたままの{entities, result}にする. _denormalize_filteredと同じく、filterで消されたentityを
+    参照する要素は除き、配列でなければNoneにする. entitiesは残った要素が参照するものだけにする
+    """
+    try:
+        return to_normalized_response(pick_mastodon_entities(api, result, entities), result)
+    except KeyError:
+        if not isinstance(result, list):
+            return None
+
+    picked, kept = {}, []
+    for item in result:
+        try:
+            item_entities = pick_mastodon_entities(api, [item], entities)
+        except KeyError:
+            continue
+        kept.append(item)
+        for key, table in item_entities.items():
+            picked.setdefault(key, {}).update(table)
+    return to_normalized_response(picked, kept)
+
+
+def _denormalize_filtered(api, result, entities):
+    """denormalizeする. filterで消されたentityを含む要素は除き、配列でなければNoneにする
+
+    まずまとめてdenormalizeし、消されたentityがあった時だけ要素毎にやりなおす.
+    すぐencodeするので、同じentityは同じdictを使いまわしてよい
+    """
+    try:
+        return denormalize_mastodon_response(api, result, entities, shared=True)
+    except KeyError:
+        if not isinstance(result, list):
+            return None
+
+    rv = []
+    for item in result:
+        try:
+            rv.extend(denormalize_mastodon_response(api, [item], entities, shared=True))
+        except KeyError:
+            pass
+    return rv
+
+
+async def _finalize_prefetched(response, naumanni_app, api, normalized=False, codec=jsoncodec):
+    """先読みしたresponseを、clientに返す(code, reason, headers, body)にする"""
+    if _get_content_type(response.headers) != 'application/json':
+        return None
+    body = await _filter_body(naumanni_app, api, response.body, normalized, codec)
+    # 返す時にはrate limitのheaderが古くなっているので、cacheしたresponseと同じく落とす
+    headers = _build_response_headers(response.code, response.headers, cached=True, normalized=normalized, codec=codec)
+    return response.code, response.reason, headers, body
+
+
+def _build_response_headers(code, headers, cached=False, normalized=False, codec=jsoncodec):
+    if code == 200:
+        response_headers = _filter_dict(headers, PASS_RESPONSE_HEADERS)
+        if codec is not jsoncodec:
+            response_headers['Content-Type'] = codec.CONTENT_TYPE
+        if normalized:
+            response_headers[RESPONSE_MODE_HEADER] = RESPONSE_MODE_NORMALIZED
+        response_headers['Cache-Control'] = 'max-age=0, private, must-revalidate'
+        if cached:
+            for key in CACHED_RESPONSE_EXCLUDE_HEADERS:
+                response_headers.pop(key, None)
+    else:
+        response_headers = {k: v for k, v in headers.get_all() if k not in HOP_BY_HOP_RESPONSE_HEADERS}
+    return response_headers
+
+
+def _get_content_type(headers):
+    content_type = headers.get('Content-Type', '')
+    return content_type.split(';')[0].strip().lower()
 
 
 def _filter_dict(src, keys):
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""websocketのclientに送るframeのqueue. 遅いclientのためにworkerのmemoryが膨らまないようにする."""
+import collections
+import logging
+import time
+
+from tornado import ioloop
+from tornado.websocket import WebSocketClosedError
+
+
+logger = logging.getLogger(__name__)
+# queueがmax_bytesを超えた時に
+POLICY_DROP_OLDEST = 'drop_oldest'  # 古いframeから捨てる
+POLICY_COALESCE = 'coalesce'  # 古いupdateから捨てる. notificationとdeleteはなるべく残す
+POLICY_DISCONNECT = 'disconnect'  # stall_timeout秒超えたままなら切る
+POLICIES = frozenset([POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT])
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_POLICY = POLICY_DROP_OLDEST
+DEFAULT_STALL_TIMEOUT = 10.0
+# disconnectでも、max_bytesのこの倍を超えたらすぐ切る
+HARD_LIMIT_RATIO = 4
+# coalesceで後まで残すevent
+KEEP_EVENTS = frozenset(['notification', 'delete'])
+
+
+class SendQueue(object):
+    """clientへのframeを1つずつ送る
+
+    write_messageのflushを待ってから次を送るので、tornadoのbufferには1 frameしか溜まらない.
+    残りはここに溜めて、max_bytesを超えたらpolicyに従って捨てるか切る. strのframeはutf-8にした時のbyte数で数える
+
+    :param handler: WebSocketHandler
+    :param int max_bytes: high watermark
+    :param str policy: POLICIES
+    :param float stall_timeout: disconnectの時、max_bytesを超えたままでいられる秒数
+    :param stats: dropped_frames, slow_disconnectsを数えるもの
+    """
+
+    def __init__(self, handler, max_bytes=DEFAULT_MAX_BYTES, policy=DEFAULT_POLICY,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT, stats=None):
+        assert policy in POLICIES, policy
+        self.handler = handler
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.stall_timeout = stall_timeout
+        self.stats = stats
+
+        self.closed = False
+        self.dropped = 0
+        self._frames = collections.deque()  # (frame, binary, event, size)
+        self._queued_bytes = 0
+        self._sending_bytes = 0
+        self._over_since = None
+        self._sending = False
+
+    @property
+    def buffered_bytes(self):
+        """queueと、tornadoが送っている途中のbyte数"""
+        return self._queued_bytes + self._sending_bytes
+
+    def put(self, frame, binary=False, event=None):
+        if self.closed:
+            return
+        # text frameは日本語が多いので、文字数ではなくbyte数で数える. putの時に1回だけ数えて一緒に持っておく
+        size = len(frame) if isinstance(frame, bytes) else len(frame.encode('utf-8'))
+        self._frames.append((frame, binary, event, size))
+        self._queued_bytes += size
+        if self.buffered_bytes > self.max_bytes:
+            self._overflow()
+        if not self._sending and not self.closed:
+            self._sending = True
+            ioloop.IOLoop.current().spawn_callback(self._send)
+
+    def close(self):
+        self.closed = True
+        self._frames.clear()
+        self._queued_bytes = 0
+
+    def _overflow(self):
+        if self.policy == POLICY_DISCONNECT:
+            now = time.time()
+            if self._over_since is None:
+                self._over_since = now
+            if now - self._over_since >= self.stall_timeout or \
+                    self.buffered_bytes > self.max_bytes * HARD_LIMIT_RATIO:
+                self._disconnect()
+            return
+
+        dropped = 0
+        if self.policy == POLICY_COALESCE:
+            # notificationとdeleteの分を残して、入りきらないupdateを古いものから捨てる
+            budget = self.max_bytes - self._sending_bytes - \
+                sum(size for frame, binary, event, size in self._frames if event in KEEP_EVENTS)
+            kept = collections.deque()
+            for item in reversed(self._frames):
+                size = item[3]
+                if item[2] not in KEEP_EVENTS:
+                    if size > budget:
+                        dropped += 1
+                        self._queued_bytes -= size
+                        continue
+                    budget -= size
+                kept.appendleft(item)
+            self._frames = kept
+
+        # まだ入りきらなければ、古いものから捨てる. 最新の1つは残す
+        while self.buffered_bytes > self.max_bytes and len(self._frames) > 1:
+            frame, binary, event, size = self._frames.popleft()
+            self._queued_bytes -= size
+            dropped += 1
+        self._count_dropped(dropped)
+
+    def _count_dropped(self, dropped):
+        if not dropped:
+            return
+        self.dropped += dropped
+        if self.stats is not None:
+            self.stats.dropped_frames += dropped
+        logger.debug('dropped %d frames for slow client', dropped)
+
+    def _disconnect(self):
+        logger.info('disconnect slow client: %d bytes buffered', self.buffered_bytes)
+        if self.stats is not None:
+            self.stats.slow_disconnects += 1
+        self._count_dropped(len(self._frames))
+        self.close()
+        self.handler.close(1008, 'Too Slow')
+
+    async def _send(self):
+        try:
+            while self._frames and not self.closed:
+                frame, binary, event, size = self._frames.popleft()
+                self._queued_bytes -= size
+                self._sending_bytes = size
+                try:
+                    await self.handler.write_message(frame, binary=binary)
+                except WebSocketClosedError:
+                    self.close()
+                finally:
+                    self._sending_bytes = 0
+                if self.buffered_bytes <= self.max_bytes:
+                    self._over_since = None
+        finally:
+            self._sending = False
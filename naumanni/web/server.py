@@ -3,7 +3,6 @@ import asyncio
 import collections
 import logging
 import functools
-import json
 import multiprocessing
 import os
 import signal
@@ -19,6 +18,7 @@ import tornado.process
 from tornado.platform.asyncio import AsyncIOMainLoop
 
 from .base import NaumanniRequestHandlerMixIn
+from .. import jsoncodec
 from .proxy import APIProxyHandler
 from .websocket import WebsocketProxyHandler
 
@@ -100,7 +100,7 @@ class WebServerBase(object):
         """statusをredisに保存する"""
         async with self.naumanni_app.get_async_redis() as redis:
             status['date'] = time.time()
-            await redis.set(REDIS_SERVER_STATUS_KEY, json.dumps(status))
+            await redis.set(REDIS_SERVER_STATUS_KEY, jsoncodec.dumps(status))
 
     async def collect_server_status(self):
         raise NotImplementedError()
@@ -181,13 +181,13 @@ class ForkedWebServer(WebServerBase):
             self.unwait_child_commands()
 
             try:
-                request = json.loads(f.result()[:-len(DELIMITER)])
+                request = jsoncodec.loads(f.result()[:-len(DELIMITER)])
                 logger.info('on_master_pipe_can_read %s %r', child.proc.pid, request)
 
                 if request.get('request') == STATUS_REQUEST:
                     status = await self.collect_server_status()
                     await child.pipe_writer.write(
-                        json.dumps(status).encode('latin1') + DELIMITER
+                        jsoncodec.dumps(status) + DELIMITER
                     )
             finally:
                 self.wait_child_commands()
@@ -205,21 +205,18 @@ class ForkedWebServer(WebServerBase):
         for child in self.children:
             os.kill(child.proc.pid, signal.SIGUSR1)
 
-        keys = ['io_loop.handlers', 'io_loop.selector.fds', 'process.uss', 'process.rss']
         status = {'process': {}}
 
         for idx, child in enumerate(self.children):
             child_status = await child.pipe_reader.read_until(DELIMITER)
-            child_status = json.loads(child_status[:-len(DELIMITER)])
+            child_status = jsoncodec.loads(child_status[:-len(DELIMITER)])
             status['process'][idx] = child_status
 
-            for key in keys:
-                status[key] = status.get(key, 0) + child_status[key]
+            _sum_status(status, child_status)
 
-        master_status = _collect_status()
+        master_status = _collect_status(self.naumanni_app)
         status['process']['master'] = master_status
-        for key in keys:
-            status[key] = status.get(key, 0) + master_status[key]
+        _sum_status(status, master_status)
 
         return status
 
@@ -240,13 +237,14 @@ class StatusAPIHandler(web.RequestHandler, NaumanniRequestHandlerMixIn):
 
             await gen.sleep(0.5)
 
-        self.write(status)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(jsoncodec.dumps(status))
         await self.flush()
 
     async def _get_status(self):
         async with self.naumanni_app.get_async_redis() as redis:
             data = await redis.get(REDIS_SERVER_STATUS_KEY)
-            return json.loads(data) if data else None
+            return jsoncodec.loads(data) if data else None
 
 
 class PingAPIHandler(web.RequestHandler):
@@ -318,15 +316,15 @@ def install_child_signal_handlers(webserver):
         io_loop = ioloop.IOLoop.instance()
 
         async def _send_status(webserver):
-            status = _collect_status()
-            await webserver.pipe_writer.write(json.dumps(status).encode('latin1') + DELIMITER)
+            status = _collect_status(webserver.naumanni_app)
+            await webserver.pipe_writer.write(jsoncodec.dumps(status) + DELIMITER)
 
         io_loop.add_callback_from_signal(_send_status, webserver)
 
     signal.signal(signal.SIGUSR1, functools.partial(status_handler, webserver))
 
 
-def _collect_status():
+def _collect_status(naumanni_app):
     io_loop = ioloop.IOLoop.instance()
     selector = io_loop.asyncio_loop._selector
 
@@ -340,9 +338,30 @@ def _collect_status():
             'process.uss': mem.uss / 1024.0 / 1024.0,
             'process.rss': mem.rss / 1024.0 / 1024.0,
         }
+    status.update(naumanni_app.collect_status())
     return status
 
 
+def _sum_status(total, status):
+    """数値の項目をプロセス全体で合計する
+
+    `.max` の項目は最大値をとる. `.ratio` の項目は、合計した `.sent_bytes` / `.bytes` で計算しなおす
+    """
+    for key, val in status.items():
+        if not isinstance(val, (int, float)) or isinstance(val, bool) or key.endswith('.ratio'):
+            continue
+        if key.endswith('.max'):
+            total[key] = max(total.get(key, val), val)
+        else:
+            total[key] = total.get(key, 0) + val
+
+    for key in status:
+        if key.endswith('.ratio'):
+            prefix = key[:-len('.ratio')]
+            sent_bytes, raw_bytes = total.get(prefix + '.sent_bytes', 0), total.get(prefix + '.bytes', 0)
+            total[key] = sent_bytes / raw_bytes if raw_bytes else 1.0
+
+
 def has_ioloop_tasks(io_loop):
     if hasattr(io_loop, '_callbacks'):
         return io_loop._callbacks or io_loop._timeouts
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""clientからのupload bodyを、受け取りながらupstreamに流す."""
+import os
+import tempfile
+
+from tornado import ioloop, locks, queues
+
+
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_SPOOL_THRESHOLD = 4 * 1024 * 1024
+SPOOL_READ_SIZE = 64 * 1024
+_WAKEUP = object()
+
+
+class UploadAborted(Exception):
+    pass
+
+
+class UploadBuffer(object):
+    """upload bodyのbuffer
+
+    spool_thresholdより小さいbodyは、queue_size個までのchunkをメモリに置く. queueが一杯ならwriteが待つので、
+    clientからの受信がupstreamへの送信に合わせて止まる.
+    それ以上のbodyは一時ファイルに書き、upstreamにはそこから流す. clientは待たされず、メモリも使わない.
+    一時ファイルの読み書きは、IOLoopを止めないようexecutorでする. 書き終わるまで次のchunkは受け取らない.
+
+    :param int content_length:
+    :param int queue_size: メモリに置くchunkの最大数
+    :param int spool_threshold: このbyte数以上なら一時ファイルを使う
+    """
+
+    def __init__(self, content_length, queue_size=DEFAULT_QUEUE_SIZE, spool_threshold=DEFAULT_SPOOL_THRESHOLD):
+        self.content_length = content_length
+        self.received = 0
+        self.closed = False
+        self.aborted = False
+
+        self._io_count = 0
+        if content_length >= spool_threshold:
+            self._file = tempfile.TemporaryFile(buffering=0)
+            self._readable = locks.Condition()
+            self._queue = None
+        else:
+            self._file = None
+            self._readable = None
+            self._queue = queues.Queue(maxsize=queue_size)
+
+    @property
+    def spooled(self):
+        return self._file is not None
+
+    async def write(self, chunk):
+        """clientから受け取ったchunkを入れる"""
+        if self.closed:
+            return
+        if self._file is None:
+            self.received += len(chunk)
+            await self._queue.put(chunk)
+        else:
+            await self._run_io(self._file.write, chunk)
+            if self.closed:
+                return
+            # 書き終わってから、producerに読ませる
+            self.received += len(chunk)
+            self._readable.notify_all()
+
+    async def produce(self, write):
+        """HTTPRequestのbody_producer. clientが途中で切れたらUploadAbortedになる"""
+        sent = 0
+        while sent < self.content_length:
+            if self.aborted:
+                raise UploadAborted()
+
+            if self._file is None:
+                chunk = await self._queue.get()
+                if chunk is _WAKEUP:
+                    continue
+            elif sent >= self.received:
+                await self._readable.wait()
+                continue
+            else:
+                chunk = await self._run_io(os.pread, self._file.fileno(), SPOOL_READ_SIZE, sent)
+                if self.aborted:
+                    raise UploadAborted()
+
+            sent += len(chunk)
+            await write(chunk)
+
+    def abort(self):
+        """clientとの接続が切れた"""
+        self.aborted = True
+        self._wakeup()
+
+    def close(self):
+        """upstreamがもう読まない. 残りのbodyは捨てる"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._file is None:
+            # 一杯のqueueにputしているwriteを起こす
+            while not self._queue.empty():
+                self._queue.get_nowait()
+        elif not self._io_count:
+            self._file.close()
+        self._wakeup()
+
+    async def _run_io(self, func, *args):
+        """一時ファイルのI/Oをexecutorでする. 途中でcloseされたら、終わってからfileを閉じる"""
+        self._io_count += 1
+        try:
+            return await ioloop.IOLoop.current().run_in_executor(None, func, *args)
+        finally:
+            self._io_count -= 1
+            if self.closed and not self._io_count:
+                self._file.close()
+
+    def _wakeup(self):
+        if self._file is None:
+            try:
+                self._queue.put_nowait(_WAKEUP)
+            except queues.QueueFull:
+                # 一杯ならproducerは待っていない
+                pass
+        else:
+            self._readable.notify_all()
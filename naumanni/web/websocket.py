@@ -1,67 +1,129 @@
 # -*- coding: utf-8 -*-
 import logging
-import json
 import re
 import time
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit
 
-from tornado import gen, httpclient
-from tornado.websocket import (
-    WebSocketHandler, websocket_connect, WebSocketClientConnection, WebSocketError, WebSocketClosedError
-)
+from tornado import gen, web
+from tornado.websocket import WebSocketHandler
 
-from .base import NaumanniRequestHandlerMixIn
-from ..mastodon_api import normalize_mastodon_response, denormalize_mastodon_response
+from .base import (
+    BATCH_QUERY, MSGPACK_SUBPROTOCOL, NaumanniRequestHandlerMixIn, RESPONSE_FORMAT_MSGPACK, RESPONSE_MODE_NORMALIZED,
+    pop_query_param
+)
+from .sendqueue import DEFAULT_MAX_BYTES, DEFAULT_POLICY, DEFAULT_STALL_TIMEOUT, KEEP_EVENTS, SendQueue
+from .. import jsoncodec, msgpackcodec, wsdeflate
+from ..mastodon_api import (
+    get_schema, normalize_mastodon_response, normalize_mastodon_responses, denormalize_mastodon_response,
+    denormalize_mastodon_responses, pick_mastodon_entities, to_normalized_response
+)
 
 
 logger = logging.getLogger(__name__)
 https_prefix_rex = re.compile('^wss?://?')
+# clientが選べる(response mode, response format)
+ALL_VARIANTS = frozenset(
+    (mode, response_format)
+    for mode in (None, RESPONSE_MODE_NORMALIZED)
+    for response_format in ((None, RESPONSE_FORMAT_MSGPACK) if msgpackcodec.available else (None,))
+)
 
 
 class WebsocketProxyHandler(WebSocketHandler, NaumanniRequestHandlerMixIn):
     """proxyる
 
-    :param UUID slave_uuid:
+    upstreamのwebsocketはnaumanni_app.stream_hubが持っていて、同じstreamを見ているclientと共有する
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.peer = None  # 相手先MastodonのWS
+        self.stream = None  # 相手先MastodonのWSを持っているSharedStream
+        self.send_queue = None
         self.closed = False
+        self.response_mode = None
+        self.response_format = None
+        self.batch = False
+
+    def prepare(self):
+        # 不調なhostなら、handshakeする前に断る
+        host = _get_peer_host(self.path_kwargs['request_url'])
+        if not self.naumanni_app.circuit_breakers.get(host).is_available():
+            raise web.HTTPError(503)
 
     @gen.coroutine
     def open(self, request_url):
-        # TODO: 最近のアクセス状況をみて、無制限に接続されないように
-        if self.request.query:
-            request_url += '?' + self.request.query
+        self.response_mode, self.response_format, query = self.get_response_options()
+        if self.selected_subprotocol == MSGPACK_SUBPROTOCOL:
+            self.response_format = RESPONSE_FORMAT_MSGPACK
+        batch, query = pop_query_param(query, BATCH_QUERY)
+        self.batch = batch == '1'
+        if query:
+            request_url += '?' + query
         mo = https_prefix_rex.match(request_url)
         if not mo.group(0).endswith('//'):
             request_url = '{}/{}'.format(mo.group(0), request_url[mo.end():])
 
         logger.info('peer ws: %s', request_url)
-        request = httpclient.HTTPRequest(request_url)
+        breaker = self.naumanni_app.circuit_breakers.get(_get_peer_host(request_url))
+        if not breaker.is_available():
+            logger.info('peer connect rejected: %s %s', breaker.host, breaker.state)
+            self.close(1013, 'Try Again Later')
+            return
+
+        hub = self.naumanni_app.stream_hub
+        config = self.naumanni_app.config
+        self.send_queue = SendQueue(
+            self,
+            max_bytes=getattr(config, 'websocket_send_queue_bytes', DEFAULT_MAX_BYTES),
+            policy=getattr(config, 'websocket_slow_client_policy', DEFAULT_POLICY),
+            stall_timeout=getattr(config, 'websocket_slow_client_timeout', DEFAULT_STALL_TIMEOUT),
+            stats=hub,
+        )
         try:
-            self.peer = yield websocket_connect(request, ping_interval=self.ping_interval)
+            stream = yield hub.subscribe(request_url, self, encode_messages, ping_interval=self.ping_interval)
         except Exception as e:
             logger.error('peer connect failed: %r', e)
-            raise
-        self.listen_peer()
+            self.close(1011, 'Upstream Unavailable')
+            return
+        if self.closed:
+            # つないでいる間にclientが切れた
+            hub.unsubscribe(stream, self)
+            return
+        self.stream = stream
 
     # WebsocketHandler overrides
     @gen.coroutine
     def on_message(self, plain_msg):
-        message = json.loads(plain_msg)
+        message = jsoncodec.loads(plain_msg)
         logger.debug('client: %r' % message)
 
+    def get_compression_options(self):
+        """websocket_compressionがTrueなら、permessage-deflateする"""
+        return self.naumanni_app.websocket_deflate.client.options
+
+    def get_websocket_protocol(self):
+        """min_sizeとwindow bitsを効かせて、送ったbyte数を数える"""
+        return wsdeflate.wrap_protocol(
+            self, super().get_websocket_protocol(), self.naumanni_app.websocket_deflate.client)
+
+    def select_subprotocol(self, subprotocols):
+        """MessagePackのsubprotocolを指定されたら、binary frameで返す"""
+        if msgpackcodec.available and MSGPACK_SUBPROTOCOL in subprotocols:
+            return MSGPACK_SUBPROTOCOL
+        return None
+
     def on_close(self):
         """クライアントとの接続が切れた際に呼ばれる."""
         logger.debug('connection closed: %s %s', self.close_code, self.close_reason)
         self.closed = True
+        if self.send_queue is not None:
+            self.send_queue.close()
 
-        # TODO: 即、サーバ側も閉じる. read_messageをキャンセルする
-        if self.peer:
-            self.peer.close()
+        # 他に見ているclientがいなければ、hubがupstreamを閉じる
+        if self.stream is not None:
+            self.naumanni_app.stream_hub.unsubscribe(self.stream, self)
+            self.stream = None
 
     def check_origin(self, origin):
         """nginxの内側にいるので、check_originに細工が必要"""
@@ -74,44 +136,174 @@ class WebsocketProxyHandler(WebSocketHandler, NaumanniRequestHandlerMixIn):
 
         return origin == host
 
-    @gen.coroutine
-    def listen_peer(self):
-        """閉じられるまで、server側wsのメッセージをlistenする"""
-        logger.debug('listen peer')
-        while not self.closed:
-            raw = yield self.peer.read_message()
-            if raw is None:
-                # connetion was closed
-                logger.info('server conncetion closed')
-                self.closed = True
-                self.close()
-                break
-
-            yield self.on_new_message_from_server(json.loads(raw))
-        logger.debug('close peer')
-
     def pinger(self):
         data = str(time.time()).encode('utf8')
         logger.debug('pinger: %r', data)
         self.ping(data)
 
-    async def on_new_message_from_server(self, message):
-        """Mastodonサーバから新しいメッセージが来た"""
-        # logger.debug('server: %r...', repr(message)[:80])
+    # SharedStream subscriber
+    @property
+    def stream_variant(self):
+        return self.response_mode, self.response_format
+
+    @property
+    def stream_batch(self):
+        return self.batch
+
+    @property
+    def buffered_bytes(self):
+        return self.send_queue.buffered_bytes if self.send_queue is not None else 0
+
+    def on_stream_closed(self):
+        """upstreamが閉じた"""
+        logger.debug('close peer')
+        self.stream = None
+        self.closed = True
+        self.close()
+
+    def write_frames(self, frames, binary=False, events=None):
+        """clientにpass. 遅いclientの分はsend_queueに溜まる
+
+        batchなら、messageのlistを1つのframeで送る
+        """
+        events = events or [None] * len(frames)
+        # pluginのfilterで消されたmessageはNone
+        pairs = [(frame, event) for frame, event in zip(frames, events) if frame is not None]
+        if self.batch and pairs:
+            frames, events = zip(*pairs)
+            self.send_queue.put(_combine_frames(frames, binary), binary, _get_batch_event(events))
+            return
+        for frame, event in pairs:
+            self.send_queue.put(frame, binary, event)
+
+
+async def encode_messages(naumanni_app, raws, variants=None):
+    """serverからのmessageをfilterして、(response mode, response format)毎のframeにする
+
+    filterは、variantがいくつあっても1回だけかける
 
+    :param variants: (response mode, response format)のset. Noneなら全部
+    :return: (各messageのevent名, {(response mode, response format): (frames, binary)}).
+        pluginのfilterで消されたmessageのframeはNone
+    """
+    if variants is None:
+        variants = ALL_VARIANTS
+    messages = [jsoncodec.loads(raw) for raw in raws]
+    modes = {mode for mode, response_format in variants}
+
+    # filterするpluginがいるか、normalizeしたままにするmessageだけ、まとめてnormalizeしてfilterを1回かける
+    normalized = RESPONSE_MODE_NORMALIZED in modes
+    filtered = []
+    for index, message in enumerate(messages):
         if message['event'] in ('update', 'notification'):
             api = '/__websocket__/{}'.format(message['event'])
-            payload = json.loads(message['payload'])
-            entities, result = normalize_mastodon_response(api, payload)
-            # TODO: _filter_entitiesをどっかに纏める
-            from .proxy import _filter_entities
-            await _filter_entities(self.naumanni_app, entities)
-            payload = denormalize_mastodon_response(api, result, entities)
-            message['payload'] = json.dumps(payload)
-
-        # clientにpass
+            if normalized or naumanni_app.get_filtered_keys(get_schema(api)):
+                filtered.append((index, api))
+
+    # response mode毎の、filteredのpayload
+    payloads = {}
+    if filtered:
+        # normalizeはdecodeしたpayloadをその場で書き換える. messagesの方は文字列のままなので変わらない
+        inputs = [(api, jsoncodec.loads(messages[index]['payload'])) for index, api in filtered]
+        if normalized:
+            payloads = await _filter_normalized(naumanni_app, inputs, modes)
+        else:
+            entities, results = normalize_mastodon_responses(inputs)
+            await naumanni_app.filter_entities(entities)
+            payloads[None] = _denormalize_filtered(
+                [(api, result) for (api, payload), result in zip(inputs, results)], entities)
+
+    rv = {}
+    for mode, response_format in variants:
+        replaced = {index: payload for (index, api), payload in zip(filtered, payloads.get(mode, ()))}
+        if response_format == RESPONSE_FORMAT_MSGPACK:
+            # payloadもJSONの文字列に入れず、messageと一緒にencodeする. deleteのidなどはstrのまま
+            frames = []
+            for index, message in enumerate(messages):
+                if index in replaced and replaced[index] is None:
+                    frames.append(None)
+                    continue
+                payload = replaced.get(index, message.get('payload'))
+                if isinstance(payload, str) and payload[:1] in ('{', '['):
+                    payload = jsoncodec.loads(payload)
+                frames.append(msgpackcodec.dumps(dict(message, payload=payload)))
+            rv[mode, response_format] = frames, True
+        else:
+            frames = list(raws)
+            for index, payload in replaced.items():
+                if payload is None:
+                    frames[index] = None
+                else:
+                    frames[index] = jsoncodec.dumps_str(dict(messages[index], payload=jsoncodec.dumps_str(payload)))
+            rv[mode, response_format] = frames, False
+    return [message.get('event') for message in messages], rv
+
+
+async def _filter_normalized(naumanni_app, inputs, modes):
+    """(api, payload)毎に{entities, result}を作る. filterはまとめて1回かける
+
+    modesにNoneもあれば、denormalizeしたものも作る
+    :param inputs: 各payloadはnormalizeで書き換えられる
+    :return: {response mode: [payload]}. filterで消されたmessageのpayloadはNone
+    """
+    normalized = [normalize_mastodon_response(api, payload) for api, payload in inputs]
+    merged = {}
+    for entities, result in normalized:
+        for key, table in entities.items():
+            merged.setdefault(key, {}).update(table)
+    await naumanni_app.filter_entities(merged)
+    results = [(api, result) for (api, payload), (entities, result) in zip(inputs, normalized)]
+
+    # 各messageには、そのmessageが参照しているentityだけを入れる. denormalizeする時と同じく、
+    # filterで消されたentityを1つでも参照していればmessageごと消す
+    payloads = []
+    for api, result in results:
+        try:
+            payloads.append(to_normalized_response(pick_mastodon_entities(api, result, merged), result))
+        except KeyError:
+            payloads.append(None)
+    rv = {RESPONSE_MODE_NORMALIZED: payloads}
+
+    if None in modes:
+        rv[None] = _denormalize_filtered(results, merged)
+    return rv
+
+
+def _denormalize_filtered(results, entities):
+    """(api, result)毎にdenormalizeする. filterで消されたentityを含むmessageはNoneにする
+
+    まずまとめてdenormalizeし、消されたentityがあった時だけmessage毎にやりなおす
+    """
+    try:
+        return denormalize_mastodon_responses(results, entities, shared=True)
+    except KeyError:
+        pass
+
+    rv = []
+    for api, result in results:
         try:
-            self.write_message(json.dumps(message))
-        except WebSocketClosedError:
-            # TODO: closeメソッドを作る
-            self.closed = True
+            rv.append(denormalize_mastodon_response(api, result, entities, shared=True))
+        except KeyError:
+            rv.append(None)
+    return rv
+
+
+def _combine_frames(frames, binary):
+    """encodeしたmessageのframeを、encodeしなおさずに1つのarrayのframeにする"""
+    if binary:
+        return msgpackcodec.dumps_array(frames)
+    return jsoncodec.dumps_array_str(frames)
+
+
+def _get_batch_event(events):
+    """send_queueのcoalesceで、残すeventが入っているbatchは残す"""
+    for event in events:
+        if event in KEEP_EVENTS:
+            return event
+    return 'update'
+
+
+def _get_peer_host(request_url):
+    """upstreamのhost. UpstreamClientPoolと同じくnetlocで数える"""
+    mo = https_prefix_rex.match(request_url)
+    return urlsplit('wss://' + request_url[mo.end():]).netloc.lower()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""websocketのpermessage-deflate.
+
+tornadoのpermessage-deflateに、window bitsの指定と、min_size未満のmessageは圧縮しないのを足す.
+clientとの間とupstreamとの間でlegを分けて、送ったbyte数と圧縮にかかったCPU時間を数える.
+
+tornado 6の非公開APIに頼っているので、それがないtornadoでは圧縮をtornadoに任せる(window bits, min_size, 統計なし).
+"""
+import time
+import zlib
+
+from tornado import escape, httpclient, httputil
+from tornado.websocket import WebSocketClientConnection, WebSocketProtocol13
+from tornado.websocket import websocket_connect as _websocket_connect
+
+
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_MEM_LEVEL = 8
+DEFAULT_WINDOW_BITS = zlib.MAX_WBITS
+# zlibのraw deflateでは8が使えないので9から
+MIN_WINDOW_BITS = 9
+# これより小さいmessageは圧縮しない. deleteなど
+DEFAULT_MIN_SIZE = 256
+# DeflateProtocolとwebsocket_connectが使うtornadoの非公開API
+SUPPORTED = (
+    hasattr(WebSocketProtocol13, '_create_compressors') and hasattr(httpclient, '_RequestProxy') and
+    hasattr(httpclient.HTTPRequest, '_DEFAULTS')
+)
+
+
+def get_compression_options(config, enabled_key):
+    """configからcompression_optionsを作る. enabled_keyがFalseならNone
+
+    compression_levelとmem_levelはtornadoがそのまま使う
+    """
+    if not getattr(config, enabled_key, False):
+        return None
+    window_bits = getattr(config, 'websocket_compression_window_bits', DEFAULT_WINDOW_BITS)
+    assert MIN_WINDOW_BITS <= window_bits <= zlib.MAX_WBITS, window_bits
+    return {
+        'compression_level': getattr(config, 'websocket_compression_level', DEFAULT_COMPRESSION_LEVEL),
+        'mem_level': getattr(config, 'websocket_compression_mem_level', DEFAULT_MEM_LEVEL),
+        'window_bits': window_bits,
+        'min_size': getattr(config, 'websocket_compression_min_size', DEFAULT_MIN_SIZE),
+    }
+
+
+class DeflateLeg(object):
+    """clientかupstreamの片方のleg. compression_optionsと統計を持つ
+
+    :param dict options: get_compression_optionsの値. Noneなら圧縮しない
+    """
+
+    def __init__(self, options=None):
+        self.options = options
+        # 送ったmessage. bytesは圧縮前、sent_bytesは圧縮後のpayload
+        self.messages = 0
+        self.bytes = 0
+        self.sent_bytes = 0
+        self.compressed = 0
+        self.skipped = 0
+        self.compress_time = 0.0
+        # 受け取った圧縮messageの、圧縮されたbyte数と展開後のbyte数
+        self.inflated = 0
+        self.received_bytes = 0
+        self.inflated_bytes = 0
+        self.decompress_time = 0.0
+
+    @property
+    def min_size(self):
+        return self.options['min_size'] if self.options is not None else 0
+
+    def stats(self, prefix):
+        return {
+            prefix + '.enabled': self.options is not None,
+            prefix + '.messages': self.messages,
+            prefix + '.bytes': self.bytes,
+            prefix + '.sent_bytes': self.sent_bytes,
+            prefix + '.ratio': self.sent_bytes / self.bytes if self.bytes else 1.0,
+            prefix + '.compressed': self.compressed,
+            prefix + '.skipped': self.skipped,
+            prefix + '.compress_time': self.compress_time,
+            prefix + '.inflated': self.inflated,
+            prefix + '.received_bytes': self.received_bytes,
+            prefix + '.inflated_bytes': self.inflated_bytes,
+            prefix + '.decompress_time': self.decompress_time,
+        }
+
+
+class WebsocketDeflate(object):
+    """clientとupstream、両方のleg"""
+
+    def __init__(self, client_options=None, upstream_options=None):
+        self.client = DeflateLeg(client_options)
+        self.upstream = DeflateLeg(upstream_options)
+
+    def stats(self):
+        rv = self.client.stats('websocket_deflate.client')
+        rv.update(self.upstream.stats('websocket_deflate.upstream'))
+        return rv
+
+
+class DeflateProtocol(WebSocketProtocol13):
+    """window bitsとmin_sizeを効かせて、legに数える
+
+    permessage-deflateでは、RSV1を立てなければ圧縮せずに送って良い(RFC 7692 6.1)
+    """
+
+    def __init__(self, handler, mask_outgoing, params, leg):
+        super().__init__(handler, mask_outgoing, params)
+        self.leg = leg
+
+    def _create_compressors(self, side, agreed_parameters, compression_options=None):
+        options = self.leg.options
+        window_bits = options['window_bits']
+        if window_bits < zlib.MAX_WBITS:
+            # serverなら、このdictがそのまま応答のheaderになるので、相手にも伝わる
+            own = side + '_max_window_bits'
+            agreed_parameters[own] = str(min(int(agreed_parameters.get(own) or zlib.MAX_WBITS), window_bits))
+            if side == 'server' and _offers_client_window_bits(self.handler.request.headers):
+                agreed_parameters['client_max_window_bits'] = str(
+                    min(int(agreed_parameters.get('client_max_window_bits') or zlib.MAX_WBITS), window_bits))
+        # client側だと、tornadoはcompression_optionsを渡さないので渡しなおす
+        super()._create_compressors(side, agreed_parameters, options)
+        self._compressor = _MeasuredCompressor(self._compressor, self.leg)
+        self._decompressor = _MeasuredDecompressor(self._decompressor, self.leg)
+
+    def write_message(self, message, binary=False):
+        message = escape.utf8(message)
+        self.leg.messages += 1
+        self.leg.bytes += len(message)
+        compressor = self._compressor
+        if compressor is not None and len(message) >= self.leg.min_size:
+            # sent_bytesは_MeasuredCompressorが数える
+            return super().write_message(message, binary=binary)
+
+        self.leg.sent_bytes += len(message)
+        if compressor is None:
+            return super().write_message(message, binary=binary)
+        self.leg.skipped += 1
+        self._compressor = None
+        try:
+            return super().write_message(message, binary=binary)
+        finally:
+            self._compressor = compressor
+
+
+def wrap_protocol(handler, protocol, leg):
+    """WebSocketHandler.get_websocket_protocolの値を、DeflateProtocolにする. SUPPORTEDでなければそのまま"""
+    if protocol is None or not SUPPORTED:
+        return protocol
+    return DeflateProtocol(handler, False, protocol.params, leg)
+
+
+def _offers_client_window_bits(headers):
+    """tornadoは値のないparameterを落とすので、受け入れたofferにclient_max_window_bitsがあるかをheaderから見なおす"""
+    for offer in headers.get('Sec-WebSocket-Extensions', '').split(','):
+        params = [param.split('=')[0].strip() for param in offer.split(';')]
+        if params[0] == 'permessage-deflate':
+            return 'client_max_window_bits' in params[1:]
+    return False
+
+
+class _MeasuredCompressor(object):
+    def __init__(self, compressor, leg):
+        self._compressor = compressor
+        self.leg = leg
+
+    def compress(self, data):
+        started = time.process_time()
+        rv = self._compressor.compress(data)
+        self.leg.compress_time += time.process_time() - started
+        self.leg.compressed += 1
+        self.leg.sent_bytes += len(rv)
+        return rv
+
+
+class _MeasuredDecompressor(object):
+    def __init__(self, decompressor, leg):
+        self._decompressor = decompressor
+        self.leg = leg
+
+    def decompress(self, data):
+        started = time.process_time()
+        rv = self._decompressor.decompress(data)
+        self.leg.decompress_time += time.process_time() - started
+        self.leg.inflated += 1
+        self.leg.received_bytes += len(data)
+        self.leg.inflated_bytes += len(rv)
+        return rv
+
+
+class DeflateClientConnection(WebSocketClientConnection):
+    def __init__(self, request, leg, **kwargs):
+        self.leg = leg
+        super().__init__(request, compression_options=leg.options, **kwargs)
+
+    def get_websocket_protocol(self):
+        return DeflateProtocol(self, mask_outgoing=True, params=self.params, leg=self.leg)
+
+
+def websocket_connect(request, leg, ping_interval=None):
+    """tornadoのwebsocket_connectと同じ. legが圧縮するならpermessage-deflateを申し込む
+
+    :param HTTPRequest request:
+    :param DeflateLeg leg:
+    """
+    if leg.options is None or not SUPPORTED:
+        return _websocket_connect(request, compression_options=leg.options, ping_interval=ping_interval)
+
+    # tornadoのwebsocket_connectと同じく、headersをcopyしてdefaultを埋める
+    request.headers = httputil.HTTPHeaders(request.headers)
+    request = httpclient._RequestProxy(request, httpclient.HTTPRequest._DEFAULTS)
+    conn = DeflateClientConnection(request, leg, ping_interval=ping_interval)
+    return conn.connect_future
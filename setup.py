@@ -28,7 +28,7 @@ setup(
         'psutil>=5.2.2',
         'pycurl>=7.43.0',
         'python-dateutil>=2.6.0',
-        'tornado>=4.5.1',
+        'tornado>=6.0,<7',
         'twitter-text-python>=1.1.0',
         'Werkzeug>=0.12.2',
     ],
@@ -56,6 +56,12 @@ setup(
         ],
         'utils': [
             'boto>=2.47.0',
-        ]
+        ],
+        'speedups': [
+            'orjson',
+        ],
+        'msgpack': [
+            'msgpack>=0.6',
+        ],
     }
 )
@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+import time
+
+import pytest
+
+from naumanni.core.circuitbreaker import (
+    STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker, CircuitBreakerRegistry, CircuitOpen
+)
+
+
+def _fail(breaker, count):
+    for _ in range(count):
+        breaker.acquire()
+        breaker.release(False)
+
+
+def test_open_and_recover():
+    breaker = CircuitBreaker('a.example', failure_threshold=3, recovery_timeout=0.1)
+    _fail(breaker, 2)
+    assert breaker.state == STATE_CLOSED
+    _fail(breaker, 1)
+    assert breaker.state == STATE_OPEN
+    assert not breaker.is_available()
+    with pytest.raises(CircuitOpen):
+        breaker.acquire()
+
+    # recovery_timeoutが過ぎたら、1つだけtrialを通す
+    time.sleep(0.1)
+    assert breaker.is_available()
+    breaker.acquire()
+    assert breaker.state == STATE_HALF_OPEN
+    assert not breaker.is_available()
+    with pytest.raises(CircuitOpen):
+        breaker.acquire()
+    breaker.release(True)
+    assert (breaker.state, breaker.failures, breaker.in_flight) == (STATE_CLOSED, 0, 0)
+
+
+def test_half_open_failure():
+    breaker = CircuitBreaker('a.example', failure_threshold=1, recovery_timeout=0.1)
+    _fail(breaker, 1)
+    time.sleep(0.1)
+    # 中断したtrialは数えないで、次のrequestにtrialさせる
+    breaker.acquire()
+    breaker.release(None)
+    assert breaker.state == STATE_HALF_OPEN
+    # trialが失敗したらすぐopenに戻る
+    _fail(breaker, 1)
+    assert breaker.state == STATE_OPEN
+    assert not breaker.is_available()
+
+
+def test_max_in_flight():
+    breaker = CircuitBreaker('a.example', max_in_flight=2)
+    breaker.acquire()
+    breaker.acquire()
+    assert not breaker.is_available()
+    with pytest.raises(CircuitOpen):
+        breaker.acquire()
+    breaker.release(True)
+    breaker.acquire()
+    assert breaker.in_flight == 2
+    assert breaker.state == STATE_CLOSED
+
+
+def test_registry_max_hosts():
+    registry = CircuitBreakerRegistry(failure_threshold=1, max_in_flight=1, max_hosts=3)
+    # openなものと、request中のものは残す
+    _fail(registry.get('open.example'), 1)
+    busy = registry.acquire('busy.example')
+    for i in range(10):
+        registry.get('{}.example'.format(i))
+    assert len(registry._breakers) == 3
+    assert registry.get('open.example').state == STATE_OPEN
+    assert registry.get('busy.example') is busy
+
+    with pytest.raises(CircuitOpen):
+        registry.acquire('busy.example')
+    with pytest.raises(CircuitOpen):
+        registry.acquire('open.example')
+    stats = registry.stats()
+    assert (stats['circuit.open'], stats['circuit.rejected'], stats['circuit.tracked']) == (1, 2, 3)
+    assert stats['circuit.evictions'] == 9
+
+    # 状態を持っていないものが無ければ、request中でない一番古いものを捨てる
+    _fail(registry.get('9.example'), 1)
+    registry.get('open.example')
+    registry.get('new.example')
+    assert list(registry._breakers) == ['busy.example', 'open.example', 'new.example']
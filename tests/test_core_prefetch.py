@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+from naumanni.core.prefetch import Prefetcher
+from naumanni.core.ratelimit import PRIORITY_LOW
+
+
+class _Response(object):
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+
+
+class _Upstream(object):
+    """fetchを、releaseされるまで止めておく"""
+
+    def __init__(self, code=200):
+        self.code = code
+        self.requests = []
+        self.released = Future()
+
+    async def fetch(self, url, headers=None, priority=None, **kwargs):
+        self.requests.append((url, headers, priority))
+        await self.released
+        return _Response(self.code, url.encode('utf-8'))
+
+
+class _RateLimiter(object):
+    def __init__(self):
+        self.ratios = {}
+
+    def get_remaining_ratio(self, host, authorization):
+        return self.ratios.get((host, authorization))
+
+
+class _FakeApp(object):
+    def __init__(self, code=200):
+        self.upstream_pool = _Upstream(code)
+        self.rate_limiter = _RateLimiter()
+
+
+async def _finalize(response, suffix):
+    return 200, 'OK', {}, response.body + suffix
+
+
+def _run(func):
+    return ioloop.IOLoop.current().run_sync(func)
+
+
+def test_schedule_and_get():
+    app = _FakeApp()
+    prefetcher = Prefetcher(app)
+    url = 'https://A.example/api/v1/timelines/home?max_id=10'
+
+    async def _do():
+        assert prefetcher.schedule('Bearer x', url, {'Authorization': 'Bearer x'}, _finalize, b'!')
+        # 同じものは二重にscheduleしない
+        assert not prefetcher.schedule('Bearer x', url, {'Authorization': 'Bearer x'}, _finalize, b'!')
+        await gen.sleep(0)
+        assert app.upstream_pool.requests == [(url, {'Authorization': 'Bearer x'}, PRIORITY_LOW)]
+
+        # 先読み中なら終わるのを待つ
+        getter = gen.convert_yielded(prefetcher.get('Bearer x', url))
+        await gen.sleep(0)
+        assert not getter.done()
+        app.upstream_pool.released.set_result(None)
+        assert await getter == (200, 'OK', {}, url.encode('utf-8') + b'!')
+
+        # 1回使ったら捨てる
+        assert await prefetcher.get('Bearer x', url) is None
+
+    _run(_do)
+    assert (prefetcher.scheduled, prefetcher.skipped, prefetcher.used) == (1, 0, 1)
+    assert prefetcher.stats()['prefetch.in_flight'] == 0
+
+
+def test_token_and_variant_scope():
+    app = _FakeApp()
+    app.upstream_pool.released.set_result(None)
+    prefetcher = Prefetcher(app)
+    url = 'https://a.example/api/v1/timelines/home?max_id=10'
+
+    async def _do():
+        prefetcher.schedule('Bearer x', url, {}, _finalize, b'', variant='normalized')
+        await gen.sleep(0.01)
+        # 他のtokenや、違う形のresponseには返さない
+        assert await prefetcher.get('Bearer y', url, variant='normalized') is None
+        assert await prefetcher.get(None, url, variant='normalized') is None
+        assert await prefetcher.get('Bearer x', url) is None
+        assert await prefetcher.get('Bearer x', url, variant='normalized') is not None
+
+    _run(_do)
+
+
+def test_ttl_and_errors():
+    app = _FakeApp()
+    app.upstream_pool.released.set_result(None)
+    prefetcher = Prefetcher(app, ttl=0.05)
+
+    async def _do():
+        prefetcher.schedule('Bearer x', 'https://a.example/1', {}, _finalize, b'')
+        await gen.sleep(0.1)
+        assert await prefetcher.get('Bearer x', 'https://a.example/1') is None
+
+        # 200以外は覚えない
+        app.upstream_pool.code = 404
+        prefetcher.schedule('Bearer x', 'https://a.example/2', {}, _finalize, b'')
+        await gen.sleep(0.01)
+        assert await prefetcher.get('Bearer x', 'https://a.example/2') is None
+
+    _run(_do)
+    assert prefetcher.used == 0
+
+
+def test_max_in_flight():
+    app = _FakeApp()
+    prefetcher = Prefetcher(app, max_in_flight=2)
+
+    async def _do():
+        results = [prefetcher.schedule('Bearer x', 'https://a.example/{}'.format(i), {}, _finalize, b'')
+                   for i in range(3)]
+        assert results == [True, True, False]
+        app.upstream_pool.released.set_result(None)
+        await gen.sleep(0.01)
+        # 終わったら、また先読みできる
+        assert prefetcher.schedule('Bearer x', 'https://a.example/2', {}, _finalize, b'')
+
+    _run(_do)
+    assert (prefetcher.scheduled, prefetcher.skipped) == (3, 1)
+
+
+def test_budget_ratio():
+    app = _FakeApp()
+    app.upstream_pool.released.set_result(None)
+    prefetcher = Prefetcher(app, budget_ratio=0.5)
+    app.rate_limiter.ratios[('a.example', 'Bearer low')] = 0.4
+    app.rate_limiter.ratios[('a.example', 'Bearer high')] = 0.6
+
+    async def _do():
+        # rate limitの残りが少ないtokenでは先読みしない. まだわからなければする
+        assert not prefetcher.schedule('Bearer low', 'https://A.example/1', {}, _finalize, b'')
+        assert prefetcher.schedule('Bearer high', 'https://A.example/1', {}, _finalize, b'')
+        assert prefetcher.schedule('Bearer unknown', 'https://a.example/1', {}, _finalize, b'')
+        await gen.sleep(0.01)
+
+    _run(_do)
+    assert (prefetcher.scheduled, prefetcher.skipped) == (2, 1)
+    assert len(app.upstream_pool.requests) == 2
+
+
+def test_max_wait():
+    app = _FakeApp()
+    prefetcher = Prefetcher(app, max_wait=0.05)
+    url = 'https://a.example/api/v1/timelines/home?max_id=10'
+
+    async def _do():
+        prefetcher.schedule('Bearer x', url, {}, _finalize, b'')
+        # rate limitで止められている先読みは待ちきらずに、clientのrequestに取りに行かせる
+        assert await prefetcher.get('Bearer x', url) is None
+        assert prefetcher.wait_timeouts == 1
+
+        # 先読みは続けていて、終われば次に使える
+        app.upstream_pool.released.set_result(None)
+        await gen.sleep(0.01)
+        assert await prefetcher.get('Bearer x', url) is not None
+
+    _run(_do)
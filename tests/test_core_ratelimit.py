@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+import datetime
+import time
+
+import pytest
+from tornado import gen, ioloop
+
+from naumanni.core.ratelimit import (
+    PRIORITY_HIGH, PRIORITY_LOW, RateLimitBudget, RateLimitExceeded, RateLimitTracker, get_token_id
+)
+
+
+class _FakeRedis(object):
+    def __init__(self, data):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, pexpire=None):
+        self.data[key] = value
+
+
+class _FakeApp(object):
+    def __init__(self):
+        self.data = {}
+
+    def get_async_redis(self):
+        return _FakeRedis(self.data)
+
+
+def _headers(limit, remaining, reset):
+    return {
+        'X-Ratelimit-Limit': str(limit),
+        'X-Ratelimit-Remaining': str(remaining),
+        'X-Ratelimit-Reset': datetime.datetime.fromtimestamp(reset, datetime.timezone.utc).isoformat(),
+    }
+
+
+def _run(func):
+    return ioloop.IOLoop.current().run_sync(func)
+
+
+def test_budget_from_headers():
+    reset = int(time.time()) + 300
+    budget = RateLimitBudget.from_headers(_headers(300, 120, reset))
+    assert (budget.limit, budget.remaining, budget.reset) == (300, 120, reset)
+    assert RateLimitBudget.from_headers({}) is None
+    assert RateLimitBudget.from_headers(dict(_headers(300, 120, reset), **{'X-Ratelimit-Remaining': 'x'})) is None
+    assert RateLimitBudget.from_headers(dict(_headers(300, 120, reset), **{'X-Ratelimit-Reset': 'soon'})) is None
+    assert RateLimitBudget.from_json(budget.to_json()).remaining == 120
+
+
+def test_acquire():
+    app = _FakeApp()
+    tracker = RateLimitTracker(app, reserve_ratio=0.2, max_queue_wait=1.0)
+
+    async def _do():
+        # 残りがreserve_ratioより多ければ待たない. 次のresponseまで1つずつ減らして見積もる
+        tracker.update('a.example', 'Bearer x', _headers(100, 50, time.time() + 60))
+        await tracker.acquire('a.example', 'Bearer x', PRIORITY_LOW)
+        assert tracker.get_remaining_ratio('a.example', 'Bearer x') == 0.49
+
+        # reserveに入ったら、clientのrequestは通して、PRIORITY_LOWはresetまで待たせるか捨てる
+        tracker.update('a.example', 'Bearer x', _headers(100, 20, time.time() + 60))
+        await tracker.acquire('a.example', 'Bearer x', PRIORITY_HIGH)
+        with pytest.raises(RateLimitExceeded):
+            await tracker.acquire('a.example', 'Bearer x', PRIORITY_LOW)
+
+        tracker.update('a.example', 'Bearer y', _headers(100, 10, time.time() + 0.2))
+        started = time.time()
+        await tracker.acquire('a.example', 'Bearer y', PRIORITY_LOW)
+        assert time.time() - started >= 0.1
+
+        # tokenが違えば別
+        await tracker.acquire('a.example', 'Bearer z', PRIORITY_LOW)
+
+    _run(_do)
+    assert (tracker.queued, tracker.shed) == (1, 1)
+
+
+def test_acquire_shared_budget():
+    # 他のworkerが保存した残りを見る
+    app = _FakeApp()
+    writer = RateLimitTracker(app)
+    reader = RateLimitTracker(app, max_queue_wait=1.0)
+
+    async def _do():
+        writer.update('a.example', 'Bearer x', _headers(100, 5, time.time() + 60))
+        await gen.sleep(0.01)
+        with pytest.raises(RateLimitExceeded):
+            await reader.acquire('a.example', 'Bearer x', PRIORITY_LOW)
+
+    _run(_do)
+    assert list(app.data) == ['naumanni:ratelimit:a.example:{}'.format(get_token_id('Bearer x'))]
+
+
+def test_update_throttles_redis_writes():
+    app = _FakeApp()
+    tracker = RateLimitTracker(app, reserve_ratio=0.2)
+    reset = time.time() + 60
+
+    async def _do():
+        for remaining in range(100, 30, -1):
+            tracker.update('a.example', 'Bearer x', _headers(100, remaining, reset))
+        assert tracker.saves == 1
+        # reserveに入った時と、windowが変わった時はすぐ保存する
+        tracker.update('a.example', 'Bearer x', _headers(100, 20, reset))
+        assert tracker.saves == 2
+        tracker.update('a.example', 'Bearer x', _headers(100, 19, reset))
+        assert tracker.saves == 2
+        tracker.update('a.example', 'Bearer x', _headers(100, 99, reset + 300))
+        assert tracker.saves == 3
+
+    _run(_do)
+    assert tracker.stats()['ratelimit.saves'] == 3
@@ -0,0 +1,155 @@
+# -*- coding:utf-8 -*-
+import asyncio
+
+import pytest
+from tornado import gen, ioloop
+
+from naumanni.core.singleflight import SingleFlight
+
+
+RESULT = (200, 'OK', {'Content-Type': 'application/json'}, b'[]')
+
+
+class _FakeRedis(object):
+    """lockとresultだけを扱うredis. dataを共有すれば、別workerのSingleFlightとして使える"""
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+
+    def __init__(self, data):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def set(self, key, value, pexpire=None, exist=None):
+        if exist == self.SET_IF_NOT_EXIST and key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def exists(self, key):
+        return key in self.data
+
+    async def eval(self, script, keys, args):
+        if self.data.get(keys[0]) == args[0]:
+            del self.data[keys[0]]
+
+
+class _BrokenRedis(object):
+    async def __aenter__(self):
+        raise ConnectionRefusedError('redis is down')
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class _FakeApp(object):
+    def __init__(self, redis_factory=None):
+        self.redis_factory = redis_factory
+
+    def get_async_redis(self):
+        return self.redis_factory()
+
+
+class _Upstream(object):
+    def __init__(self, result=RESULT, error=None, delay=0.05):
+        self.result = result
+        self.error = error
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self, url):
+        self.calls += 1
+        await gen.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _run(func):
+    return ioloop.IOLoop.current().run_sync(func)
+
+
+def test_coalesce():
+    single_flight = SingleFlight(_FakeApp())
+    upstream = _Upstream()
+
+    async def _do():
+        return await gen.multi([single_flight.do('key', upstream, 'url') for _ in range(3)])
+
+    assert _run(_do) == [RESULT] * 3
+    assert upstream.calls == 1
+    assert single_flight.stats() == {
+        'singleflight.in_flight': 0, 'singleflight.leaders': 1, 'singleflight.followers': 2,
+        'singleflight.remote_followers': 0,
+    }
+
+    # 終わったら次の呼び出しはまた取りに行く
+    assert _run(lambda: single_flight.do('key', upstream, 'url')) == RESULT
+    assert upstream.calls == 2
+
+
+def test_leader_failure():
+    single_flight = SingleFlight(_FakeApp())
+    upstream = _Upstream(error=ValueError('boom'))
+
+    async def _do():
+        leader = gen.convert_yielded(single_flight.do('key', upstream, 'url'))
+        await gen.sleep(0)
+        follower = await single_flight.do('key', upstream, 'url')
+        with pytest.raises(ValueError):
+            await leader
+        return follower
+
+    # followerはNoneを受け取って、自分で取りに行く
+    assert _run(_do) is None
+    assert upstream.calls == 1
+
+
+def test_leader_cancelled():
+    single_flight = SingleFlight(_FakeApp())
+    upstream = _Upstream()
+
+    async def _do():
+        leader = asyncio.ensure_future(single_flight.do('key', upstream, 'url'))
+        await gen.sleep(0)
+        follower = gen.convert_yielded(single_flight.do('key', upstream, 'url'))
+        leader.cancel()
+        return await follower
+
+    # leaderのhandlerがいなくなっても、followerの分は取ってくる
+    assert _run(_do) == RESULT
+    assert upstream.calls == 1
+
+
+def test_redis_remote_follower():
+    data = {}
+    workers = [SingleFlight(_FakeApp(lambda: _FakeRedis(data)), use_redis=True) for _ in range(2)]
+    upstreams = [_Upstream(), _Upstream()]
+
+    async def _do():
+        return await gen.multi([
+            worker.do('key', upstream, 'url') for worker, upstream in zip(workers, upstreams)])
+
+    assert _run(_do) == [RESULT, RESULT]
+    # 2つ目のworkerは、redisに置かれた結果を使う
+    assert [upstream.calls for upstream in upstreams] == [1, 0]
+    assert workers[1].remote_followers == 1
+    assert not any(key.startswith('naumanni:singleflight:lock:') for key in data)
+
+
+def test_redis_down():
+    single_flight = SingleFlight(_FakeApp(_BrokenRedis), use_redis=True)
+    upstream = _Upstream()
+
+    async def _do():
+        return await gen.multi([single_flight.do('key', upstream, 'url') for _ in range(2)])
+
+    # redisが落ちていても、workerの中でまとめて返す
+    assert _run(_do) == [RESULT, RESULT]
+    assert upstream.calls == 1
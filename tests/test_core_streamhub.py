@@ -0,0 +1,563 @@
+# -*- coding:utf-8 -*-
+import time
+
+from tornado import gen, ioloop, queues
+
+from naumanni import jsoncodec
+from naumanni.core.circuitbreaker import CircuitBreakerRegistry
+from naumanni.core.streamhub import SharedStream, StreamHub, get_stream_key
+
+
+PUBLIC_URL = 'wss://a.example/api/v1/streaming/?stream=public'
+JSON = (None, None)
+MSGPACK = (None, 'msgpack')
+NORMALIZED = ('normalized', None)
+
+
+class _Peer(object):
+    """upstreamのwebsocket. feedしたmessageをread_messageで返す"""
+
+    def __init__(self, url, token):
+        self.url = url
+        self.token = token
+        self.closed = False
+        self._messages = queues.Queue()
+
+    def feed(self, raw):
+        self._messages.put_nowait(raw)
+
+    async def read_message(self):
+        return await self._messages.get()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._messages.put_nowait(None)
+
+
+class _Upstream(object):
+    """SharedStream._websocket_connectの代わりに_Peerを返す"""
+
+    def __init__(self, monkeypatch):
+        self.peers = []
+        upstream = self
+
+        async def _websocket_connect(stream, url, token, ping_interval):
+            peer = _Peer(url, token)
+            upstream.peers.append(peer)
+            return peer
+        monkeypatch.setattr(SharedStream, '_websocket_connect', _websocket_connect)
+
+
+class _Channel(object):
+    """aioredisのChannelと同じく、wait_messageしてからgetする"""
+    _CLOSED = object()
+
+    def __init__(self, name):
+        self.name = name
+        self._messages = queues.Queue()
+        self._next = None
+
+    async def wait_message(self):
+        item = await self._messages.get()
+        if item is self._CLOSED:
+            return False
+        self._next = item
+        return True
+
+    async def get(self):
+        item, self._next = self._next, None
+        return item
+
+    def close(self):
+        self._messages.put_nowait(self._CLOSED)
+
+
+class _Redis(object):
+    """streamhubが使うだけのredis. 同じ_Redisを渡せば、別workerのStreamHubとして使える"""
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+
+    def __init__(self):
+        self.data = {}  # key: (value, expires)
+        self.channels = {}
+        self.closed = False
+
+    def _get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            del self.data[key]
+            return None
+        return value
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def set(self, key, value, pexpire=None, exist=None):
+        if exist == self.SET_IF_NOT_EXIST and self._get(key) is not None:
+            return False
+        self.data[key] = (value, time.time() + pexpire / 1000)
+        return True
+
+    async def eval(self, script, keys, args):
+        if self._get(keys[0]) != args[0]:
+            return 0
+        if 'pexpire' in script:
+            self.data[keys[0]] = (args[0], time.time() + args[1] / 1000)
+        else:
+            del self.data[keys[0]]
+        return 1
+
+    async def zadd(self, key, *pairs):
+        zset = self.data.setdefault(key, ({}, None))[0]
+        for index in range(0, len(pairs), 2):
+            zset[pairs[index + 1]] = pairs[index]
+
+    async def zrem(self, key, *members):
+        for member in members:
+            self.data.get(key, ({}, None))[0].pop(member, None)
+
+    async def pexpire(self, key, milliseconds):
+        pass
+
+    async def zremrangebyscore(self, key, min=float('-inf'), max=float('inf')):
+        zset = self.data.get(key, ({}, None))[0]
+        for member in [member for member, score in zset.items() if min <= score <= max]:
+            del zset[member]
+
+    async def zrangebyscore(self, key, min=float('-inf'), max=float('inf')):
+        return [member for member, score in self.data.get(key, ({}, None))[0].items() if min <= score <= max]
+
+    async def publish(self, name, data):
+        for channel in self.channels.get(name, []):
+            channel._messages.put_nowait(data)
+
+    def pubsub(self):
+        return _PubSub(self)
+
+    def get_variants(self, stream_name):
+        zset = self.data.get('naumanni:stream:variants:{}'.format(stream_name), ({}, None))[0]
+        return sorted(tuple(jsoncodec.loads(member)) for member in zset)
+
+
+class _PubSub(object):
+    """workerに1本のpub/subの接続"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.closed = False
+        self._channels = {}
+
+    async def subscribe(self, name):
+        channel = self._channels[name] = _Channel(name)
+        self.redis.channels.setdefault(name, []).append(channel)
+        return [channel]
+
+    async def unsubscribe(self, name):
+        channel = self._channels.pop(name)
+        self.redis.channels[name].remove(channel)
+        channel.close()
+
+
+class _FakeApp(object):
+    config = object()
+
+    def __init__(self, redis=None):
+        self.redis = redis
+        self.circuit_breakers = CircuitBreakerRegistry()
+
+    def get_async_redis(self):
+        return self.redis
+
+    async def create_async_redis(self):
+        return self.redis.pubsub()
+
+
+class _Subscriber(object):
+    def __init__(self, variant=JSON, batch=False):
+        self.stream_variant = variant
+        self.stream_batch = batch
+        self.closed = False
+        self.buffered_bytes = 0
+        self.received = []
+        # write_frames毎のframe. batchなら1回にまとめて書かれる
+        self.writes = []
+
+    def write_frames(self, frames, binary=False, events=None):
+        self.received.extend(frames)
+        self.writes.append(list(frames))
+
+    def on_stream_closed(self):
+        self.closed = True
+
+
+class _Encoder(object):
+    """variant毎に、rawに印を付けたframeを作る. 作ったvariantを覚えておく"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, app, raws, variants):
+        self.calls.append(None if variants is None else frozenset(variants))
+        if variants is None:
+            variants = {JSON, MSGPACK, NORMALIZED}
+        events = ['update'] * len(raws)
+        return events, {variant: (['{}:{}'.format(variant[0] or variant[1], raw) for raw in raws], False)
+                        for variant in variants}
+
+
+def _run(func):
+    return ioloop.IOLoop.current().run_sync(func, timeout=10)
+
+
+async def _close(*hubs):
+    """次のtestに、streamのtaskが残らないようにする"""
+    for hub in hubs:
+        for stream in list(hub._streams.values()) + list(hub._private_streams):
+            stream.close()
+    await gen.sleep(0.05)
+
+
+async def _wait_for(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'timed out'
+        await gen.sleep(0.01)
+
+
+def test_get_stream_key():
+    assert get_stream_key(PUBLIC_URL) == ('a.example', '/api/v1/streaming/', 'public', '')
+    assert get_stream_key('wss://A.example/api/v1/streaming/?stream=hashtag&tag=Naumanni') == \
+        ('a.example', '/api/v1/streaming/', 'hashtag', 'naumanni')
+    # tokenを付けたclientにはMastodonがblockやmuteでfilterするので、共有しない
+    assert get_stream_key(PUBLIC_URL + '&access_token=x') is None
+    assert get_stream_key('wss://a.example/api/v1/streaming/?stream=user') is None
+
+
+def test_share_disabled(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp())
+    encode = _Encoder()
+
+    async def _do():
+        await hub.subscribe(PUBLIC_URL, _Subscriber(), encode)
+        await hub.subscribe(PUBLIC_URL, _Subscriber(), encode)
+        assert hub.stats()['stream_hub.shared_upstreams'] == 0
+        await _close(hub)
+
+    _run(_do)
+    assert len(upstream.peers) == 2
+
+
+def test_refcount_and_idle_close(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True, idle_timeout=0.1, batch_window=0)
+    encode = _Encoder()
+    subscribers = [_Subscriber(), _Subscriber(MSGPACK)]
+    authenticated = _Subscriber()
+
+    async def _do():
+        streams = [await hub.subscribe(PUBLIC_URL, subscriber, encode) for subscriber in subscribers]
+        assert streams[0] is streams[1]
+        stream = streams[0]
+        # tokenを付けたclientは、自分のtokenで別につなぐ
+        private = await hub.subscribe(PUBLIC_URL + '&access_token=secret', authenticated, encode)
+        assert private is not stream
+        assert [(peer.url, peer.token) for peer in upstream.peers] == [
+            (PUBLIC_URL, None), (PUBLIC_URL + '&access_token=secret', None)]
+
+        upstream.peers[0].feed('1')
+        await _wait_for(lambda: subscribers[1].received)
+        assert subscribers[0].received == ['None:1']
+        assert subscribers[1].received == ['msgpack:1']
+        assert authenticated.received == []
+        assert encode.calls == [{JSON, MSGPACK}]
+
+        # 最後のsubscriberが抜けても、idle_timeoutの間は残す
+        hub.unsubscribe(stream, subscribers[0])
+        hub.unsubscribe(stream, subscribers[1])
+        assert not stream.closed
+        assert await hub.subscribe(PUBLIC_URL, subscribers[0], encode) is stream
+        await gen.sleep(0.15)
+        assert not stream.closed
+
+        hub.unsubscribe(stream, subscribers[0])
+        await gen.sleep(0.15)
+        assert stream.closed
+        assert upstream.peers[0].closed
+        assert not subscribers[0].closed
+
+        # 共有しないstreamは、subscriberが抜けたらすぐ閉じる
+        hub.unsubscribe(private, authenticated)
+        assert upstream.peers[1].closed
+
+    _run(_do)
+    stats = hub.stats()
+    assert (stats['stream_hub.connects'], stats['stream_hub.reused'], stats['stream_hub.streams']) == (2, 2, 0)
+
+
+def test_service_token(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True, service_tokens={'A.example': 'service'})
+
+    async def _do():
+        await hub.subscribe(PUBLIC_URL, _Subscriber(), _Encoder())
+        await hub.subscribe('wss://a.example/api/v1/streaming/?stream=user&access_token=x', _Subscriber(), _Encoder())
+        await _close(hub)
+
+    _run(_do)
+    # service tokenは共有するstreamにだけ使う
+    assert [peer.token for peer in upstream.peers] == ['service', None]
+
+
+def test_upstream_closed(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True)
+    subscriber = _Subscriber()
+
+    async def _do():
+        stream = await hub.subscribe(PUBLIC_URL, subscriber, _Encoder())
+        upstream.peers[0].feed('1')
+        upstream.peers[0].close()
+        await _wait_for(lambda: stream.closed)
+
+    _run(_do)
+    # 溜まっていたmessageを流してから閉じる
+    assert subscriber.received == ['None:1']
+    assert subscriber.closed
+    assert hub.stats()['stream_hub.streams'] == 0
+
+
+def test_encode_used_variants(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True, batch_window=0)
+    encode = _Encoder()
+    plain, normalized = _Subscriber(), _Subscriber(NORMALIZED)
+
+    async def _do():
+        stream = await hub.subscribe(PUBLIC_URL, plain, encode)
+        await hub.subscribe(PUBLIC_URL, normalized, encode)
+        upstream.peers[0].feed('1')
+        await _wait_for(lambda: normalized.received)
+
+        # 最後のsubscriberが抜けたvariantは作らない
+        hub.unsubscribe(stream, normalized)
+        upstream.peers[0].feed('2')
+        await _wait_for(lambda: len(plain.received) == 2)
+        await _close(hub)
+
+    _run(_do)
+    assert encode.calls == [{JSON, NORMALIZED}, {JSON}]
+    assert normalized.received == ['normalized:1']
+
+
+def test_batch_window(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True, batch_window=0.2)
+    encode = _Encoder()
+    subscribers = [_Subscriber(batch=True), _Subscriber(MSGPACK, batch=True)]
+
+    async def _do():
+        stream = await hub.subscribe(PUBLIC_URL, subscribers[0], encode)
+        await hub.subscribe(PUBLIC_URL, subscribers[1], encode)
+        assert stream.batching
+        for raw in ('1', '2', '3'):
+            upstream.peers[0].feed(raw)
+            await gen.sleep(0.02)
+        # windowの間は流さない
+        await gen.sleep(0.05)
+        assert subscribers[0].writes == []
+
+        await _wait_for(lambda: subscribers[1].writes)
+        await _close(hub)
+
+    _run(_do)
+    # 全員batchなら、集めてから1回でencodeして、順番通り1回で書く
+    assert encode.calls == [{JSON, MSGPACK}]
+    assert subscribers[0].writes == [['None:1', 'None:2', 'None:3']]
+    assert subscribers[1].writes == [['msgpack:1', 'msgpack:2', 'msgpack:3']]
+
+
+def test_batch_max_events(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True, batch_window=0.2, batch_max_events=2)
+    subscriber = _Subscriber(batch=True)
+
+    async def _do():
+        await hub.subscribe(PUBLIC_URL, subscriber, _Encoder())
+        for raw in ('1', '2', '3'):
+            upstream.peers[0].feed(raw)
+        # batch_max_events個集まったら、windowを待たずに流す
+        await _wait_for(lambda: subscriber.writes, timeout=0.1)
+        assert subscriber.writes == [['None:1', 'None:2']]
+        await _wait_for(lambda: len(subscriber.writes) == 2)
+        await _close(hub)
+
+    _run(_do)
+    assert subscriber.writes == [['None:1', 'None:2'], ['None:3']]
+
+
+def test_batch_mixed_subscribers(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True, batch_window=0.2)
+    encode = _Encoder()
+    plain, batch, leaving = _Subscriber(), _Subscriber(batch=True), _Subscriber(NORMALIZED, batch=True)
+
+    async def _do():
+        stream = await hub.subscribe(PUBLIC_URL, plain, encode)
+        await hub.subscribe(PUBLIC_URL, batch, encode)
+        await hub.subscribe(PUBLIC_URL, leaving, encode)
+        assert not stream.batching
+
+        # batchでないsubscriberは待たせない
+        upstream.peers[0].feed('1')
+        await _wait_for(lambda: plain.received, timeout=0.1)
+        upstream.peers[0].feed('2')
+        await _wait_for(lambda: len(plain.received) == 2, timeout=0.1)
+        assert batch.writes == []
+
+        # windowの途中で抜けたsubscriberには流さない
+        hub.unsubscribe(stream, leaving)
+        await _wait_for(lambda: batch.writes)
+        await _close(hub)
+
+    _run(_do)
+    assert plain.writes == [['None:1'], ['None:2']]
+    assert batch.writes == [['None:1', 'None:2']]
+    assert leaving.writes == []
+
+
+def test_batch_flushed_on_close(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    hub = StreamHub(_FakeApp(), share=True, batch_window=10)
+    subscriber = _Subscriber(batch=True)
+
+    async def _do():
+        stream = await hub.subscribe(PUBLIC_URL, subscriber, _Encoder())
+        upstream.peers[0].feed('1')
+        upstream.peers[0].feed('2')
+        upstream.peers[0].close()
+        await _wait_for(lambda: stream.closed)
+
+    _run(_do)
+    # upstreamが閉じたら、windowを待たずに集めた分を流してから閉じる
+    assert subscriber.writes == [['None:1', 'None:2']]
+    assert subscriber.closed
+
+
+def _make_cluster(redis, worker_id, **kwargs):
+    hub = StreamHub(_FakeApp(redis), share=True, cluster=True, lock_timeout=0.3, batch_window=0, **kwargs)
+    hub.worker_id = worker_id
+    return hub
+
+
+def test_cluster_publish_and_relay(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    redis = _Redis()
+    hubs = [_make_cluster(redis, 'w1', idle_timeout=0), _make_cluster(redis, 'w2', idle_timeout=0)]
+    subscribers = [_Subscriber(), _Subscriber(NORMALIZED)]
+    encode = _Encoder()
+
+    async def _do():
+        first = await hubs[0].subscribe(PUBLIC_URL, subscribers[0], encode)
+        second = await hubs[1].subscribe(PUBLIC_URL, subscribers[1], encode)
+        # lockを取ったworkerだけがupstreamにつなぐ
+        assert first.owner and not second.owner
+        assert len(upstream.peers) == 1
+        await _wait_for(lambda: first.cluster_variants == {JSON, NORMALIZED})
+
+        upstream.peers[0].feed('1')
+        await _wait_for(lambda: subscribers[1].received)
+        assert subscribers[0].received == ['None:1']
+        assert subscribers[1].received == ['normalized:1']
+
+        # ownerが抜けたらlockを外して、upstreamを閉じる
+        hubs[0].unsubscribe(first, subscribers[0])
+        await _wait_for(lambda: upstream.peers[0].closed)
+        assert not any(key.startswith('naumanni:stream:owner:') for key in redis.data)
+        await _close(*hubs)
+
+    _run(_do)
+    assert (hubs[0].published, hubs[1].relayed) == (1, 1)
+    assert hubs[0].stats()['stream_hub.owned'] == 0
+
+
+def test_cluster_failover(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    redis = _Redis()
+    hubs = [_make_cluster(redis, 'w1'), _make_cluster(redis, 'w2')]
+    subscriber = _Subscriber()
+    encode = _Encoder()
+
+    async def _do():
+        first = await hubs[0].subscribe(PUBLIC_URL, _Subscriber(), encode)
+        second = await hubs[1].subscribe(PUBLIC_URL, subscriber, encode)
+        assert first.owner
+
+        # ownerのworkerが死ぬと、lockを延ばさなくなる
+        first.closed = True
+        upstream.peers[0].close()
+        await _wait_for(lambda: second.owner)
+        assert len(upstream.peers) == 2
+
+        upstream.peers[1].feed('1')
+        await _wait_for(lambda: subscriber.received)
+        assert subscriber.received == ['None:1']
+        await hubs[0]._unsubscribe_channel(first._channel)
+        await _close(*hubs)
+
+    _run(_do)
+    assert hubs[1].takeovers == 1
+
+
+def test_cluster_redis_down(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    redis = _Redis()
+    hub = _make_cluster(redis, 'w1')
+    subscriber = _Subscriber()
+
+    async def _do():
+        stream = await hub.subscribe(PUBLIC_URL, subscriber, _Encoder())
+        # channelが切れたら、clientにつなぎなおしてもらう
+        stream._channel.close()
+        await _wait_for(lambda: stream.closed)
+
+    _run(_do)
+    assert subscriber.closed
+    assert upstream.peers[0].closed
+
+
+def test_cluster_variants(monkeypatch):
+    upstream = _Upstream(monkeypatch)
+    redis = _Redis()
+    hubs = [_make_cluster(redis, 'w1'), _make_cluster(redis, 'w2')]
+    plain, packed = _Subscriber(), _Subscriber(MSGPACK)
+    encode = _Encoder()
+
+    async def _do():
+        first = await hubs[0].subscribe(PUBLIC_URL, plain, encode)
+        assert redis.get_variants(first.name) == [('w1', None, None)]
+        upstream.peers[0].feed('1')
+        await _wait_for(lambda: plain.received)
+
+        # 他のworkerに新しいvariantのsubscriberが来たら、ownerはそのvariantも作る
+        second = await hubs[1].subscribe(PUBLIC_URL, packed, encode)
+        assert redis.get_variants(first.name) == [('w1', None, None), ('w2', None, 'msgpack')]
+        await _wait_for(lambda: first.cluster_variants == {JSON, MSGPACK})
+        upstream.peers[0].feed('2')
+        await _wait_for(lambda: packed.received)
+        assert packed.received == ['msgpack:2']
+
+        # 最後のsubscriberが抜けたら、次にownerが読みなおした時から作らない
+        hubs[1].unsubscribe(second, packed)
+        await _wait_for(lambda: first.cluster_variants == {JSON})
+        assert redis.get_variants(first.name) == [('w1', None, None)]
+        upstream.peers[0].feed('3')
+        await _wait_for(lambda: len(plain.received) == 3)
+        await _close(*hubs)
+
+    _run(_do)
+    assert encode.calls == [{JSON}, {JSON, MSGPACK}, {JSON}]
+    assert packed.received == ['msgpack:2']
@@ -0,0 +1,101 @@
+# -*- coding:utf-8 -*-
+from tornado import gen, httpclient, httpserver, ioloop, testing, web
+
+from naumanni.core.circuitbreaker import CircuitBreakerRegistry
+from naumanni.core.upstream import UpstreamClientPool
+
+
+class _SlowHandler(web.RequestHandler):
+    async def get(self):
+        await gen.sleep(0.3)
+        self.write('slow')
+
+
+class _FastHandler(web.RequestHandler):
+    def get(self):
+        self.write('fast')
+
+
+def _start_server(handler):
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(web.Application([('/', handler)]))
+    server.add_sockets([sock])
+    return server, 'http://127.0.0.1:{}/'.format(port)
+
+
+def test_slow_host_does_not_starve_others():
+    slow_server, slow_url = _start_server(_SlowHandler)
+    fast_server, fast_url = _start_server(_FastHandler)
+    done = []
+
+    async def _fetch(pool, url):
+        response = await pool.fetch(url)
+        done.append(response.body)
+
+    async def _run():
+        pool = UpstreamClientPool(max_clients=2, max_clients_per_host=1)
+        try:
+            slow = [gen.convert_yielded(_fetch(pool, slow_url)) for _ in range(3)]
+            await gen.sleep(0.05)
+            # 遅いhostの2つ目以降はhostの枠で待つので、全体の枠は空いている
+            await gen.with_timeout(ioloop.IOLoop.current().time() + 0.2, _fetch(pool, fast_url))
+            assert done == [b'fast']
+            await gen.multi(slow)
+            assert pool.stats()['upstream.in_flight'] == 0
+        finally:
+            pool.close()
+
+    try:
+        ioloop.IOLoop.current().run_sync(_run)
+    finally:
+        slow_server.stop()
+        fast_server.stop()
+
+
+def test_max_hosts():
+    servers = [_start_server(_FastHandler) for _ in range(3)]
+
+    async def _run():
+        pool = UpstreamClientPool(max_hosts=2)
+        try:
+            for server, url in servers:
+                assert (await pool.fetch(url)).body == b'fast'
+            stats = pool.stats()
+            assert stats['upstream.hosts'] == 2
+            assert stats['upstream.evictions'] == 1
+            assert stats['upstream.misses'] == 3
+            # 一番使われていないhostから閉じる
+            assert servers[0][1][7:-1] not in pool._hosts
+        finally:
+            pool.close()
+
+    try:
+        ioloop.IOLoop.current().run_sync(_run)
+    finally:
+        for server, url in servers:
+            server.stop()
+
+
+def test_connection_error_counts_as_failure():
+    sock, port = testing.bind_unused_port()
+    sock.close()
+    url = 'http://127.0.0.1:{}/'.format(port)
+
+    async def _produce(write):
+        await write(b'x')
+
+    async def _run():
+        breakers = CircuitBreakerRegistry(failure_threshold=2)
+        pool = UpstreamClientPool(circuit_breakers=breakers)
+        try:
+            # uploadはSimpleAsyncHTTPClientなので、接続エラーがsocketの例外で返ってくる
+            for _ in range(2):
+                response = await pool.fetch(
+                    httpclient.HTTPRequest(url, method='POST', body_producer=_produce), raise_error=False)
+                assert response.code == 599
+            assert breakers.get('127.0.0.1:{}'.format(port)).state == 'open'
+            assert pool.stats()['upstream.in_flight'] == 0
+        finally:
+            pool.close()
+
+    ioloop.IOLoop.current().run_sync(_run)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import json
+
+from naumanni import jsoncodec
+
+
+def test_jsoncodec():
+    obj = {'id': '1', 'content': 'にゃーん', 'tags': [], 'reblog': None, 'count': 3}
+    data = jsoncodec.dumps(obj)
+    assert isinstance(data, bytes)
+    assert json.loads(data.decode('utf-8')) == obj
+
+    assert jsoncodec.loads(data) == obj
+    assert jsoncodec.loads(data.decode('utf-8')) == obj
+    assert jsoncodec.dumps_str(obj) == data.decode('utf-8')
+
+
+def test_jsoncodec_nested():
+    # websocketのpayloadはJSONの中のJSON文字列
+    message = {'event': 'update', 'payload': jsoncodec.dumps_str({'id': 1})}
+    decoded = jsoncodec.loads(jsoncodec.dumps(message))
+    assert jsoncodec.loads(decoded['payload']) == {'id': 1}
+
+
+def test_jsoncodec_canonical():
+    a = {'id': '1', 'account': {'id': '2', 'acct': 'shn'}, 'content': 'にゃーん'}
+    b = {'content': 'にゃーん', 'account': {'acct': 'shn', 'id': '2'}, 'id': '1'}
+    assert jsoncodec.dumps(a) != jsoncodec.dumps(b)
+    assert jsoncodec.dumps_canonical(a) == jsoncodec.dumps_canonical(b)
+    assert jsoncodec.loads(jsoncodec.dumps_canonical(a)) == a
+
+
+def test_jsoncodec_int_keys():
+    # server statusはprocess番号をkeyに使う
+    assert jsoncodec.loads(jsoncodec.dumps({'process': {0: {'a': 1}}})) == {'process': {'0': {'a': 1}}}
+
+
+def test_jsoncodec_array():
+    items = [{'event': 'update'}, {'event': 'delete', 'payload': '1'}]
+    assert jsoncodec.loads(jsoncodec.dumps_array_str([jsoncodec.dumps_str(item) for item in items])) == items
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import time
+
+from naumanni.lru import LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # 'b'が一番古いので追い出される
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.hits == 3
+    assert cache.misses == 0
+
+    assert cache.get('b', 'default') == 'default'
+    assert cache.misses == 1
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(10, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert len(cache) == 1
+
+
+def test_lru_cache_items():
+    cache = LRUCache(10)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=-1)
+    assert cache.items() == [('a', 1)]
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
-from naumanni.mastodon_models import Status
+import pickle
+
+from naumanni.mastodon_models import Status, content_cache
 
 
 def test_status_plain_content():
@@ -41,3 +43,61 @@ invisible">SrWU9iL4</span></a></p>''',
         'もうこれも走ってないという事実 https://friends.nico/media/R9N89nWWqcPSrWU9iL4'
     assert status.urls == ['https://friends.nico/media/R9N89nWWqcPSrWU9iL4']
     assert status.urls_without_media == []
+
+
+def test_status_from_dict():
+    data = {'id': 1, 'content': '<p>hello</p>', 'media_attachments': [], 'unknown_key': 'x'}
+    status = Status.from_dict(data)
+
+    # dictはコピーされない. cached_propertyを使うまで__dict__も作らない
+    assert status.to_dict() is data
+    assert not hasattr(status, '__dict__') or not status.__dict__
+    assert status.id == 1
+    assert status.reblog is None
+    assert status.unknown_key == 'x'
+    assert data['reblog'] is None
+
+    # 代入やextended attributesはdictに入り、cached_propertyは入らない
+    assert status.plainContent == 'hello'
+    status.add_extended_attributes('plugin', {'a': 1})
+    status.unknown_key = 'y'
+    assert status.get_extended_attributes('plugin') == {'a': 1}
+    assert data == {
+        'id': 1, 'content': '<p>hello</p>', 'media_attachments': [], 'reblog': None, 'extended': {'plugin': {'a': 1}},
+        'unknown_key': 'y',
+    }
+
+    try:
+        status.spoiler_text
+    except AttributeError:
+        pass
+    else:
+        assert 0, 'AttributeError not raised'
+
+    assert pickle.loads(pickle.dumps(status)).to_dict() == status.to_dict()
+
+
+def test_status_content_cache():
+    content_cache.clear()
+    data = {
+        'id': 1, 'uri': 'tag:example.com,2017:1', 'media_attachments': [],
+        'content': '<p>see <a href="https://example.com/">https://example.com/</a></p>',
+    }
+    misses = content_cache.stats()['status_content.cache.misses']
+
+    # 同じstatusを別のmodelで見ても、1回しかparseしない
+    assert Status(**data).urls == ['https://example.com/']
+    status = Status(**data)
+    assert status.plainContent == 'see https://example.com/'
+    assert status.urls_without_media == ['https://example.com/']
+    stats = content_cache.stats()
+    assert stats['status_content.cache.size'] == 1
+    assert stats['status_content.cache.misses'] == misses + 1
+
+    # cacheのlistは共有されない
+    status.urls.append('https://example.net/')
+    assert Status(**data).urls == ['https://example.com/']
+
+    # contentが変われば別のkey
+    assert Status(**dict(data, content='<p>edited</p>')).urls == []
+    assert content_cache.stats()['status_content.cache.size'] == 2
@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
-from naumanni.normalizr import Entity, denormalize, normalize
+import copy
+
+import pytest
+
+from naumanni.normalizr import (
+    Entity, compile_schema, denormalize, denormalize_batch, denormalize_generic, get_entity_keys, normalize,
+    normalize_batch, normalize_generic, pick_entities
+)
 from naumanni.mastodon_models import Status, Account, Notification
 
 
@@ -42,7 +49,8 @@ def test_normalize_list_nested():
                     'id': 2,
                     'acct': 'nayu'
                 },
-                'content': 'reblogged'
+                'content': 'reblogged',
+                'reblog': None,
             }
         },
         {
@@ -66,8 +74,8 @@ def test_normalize_list_nested():
     ]
     schema = [status]
 
-    # test normalize
-    entities, result = normalize(source, schema)
+    # test normalize. normalizeに渡したdictは書き換えられる
+    entities, result = normalize(copy.deepcopy(source), schema)
     assert 'accounts' in entities
     assert 'statuses' in entities
     assert len(entities['accounts']) == 2
@@ -81,3 +89,193 @@ def test_normalize_list_nested():
     denormalized = denormalize(result, schema, entities)
     print(denormalized)
     assert denormalized == source
+
+
+def test_get_entity_keys():
+    assert get_entity_keys(account) == {'accounts'}
+    assert get_entity_keys([status]) == {'accounts', 'statuses'}
+    assert get_entity_keys(notification) == {'accounts', 'notifications', 'statuses'}
+
+
+def test_compile_schema():
+    source = [
+        {'id': 100, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'aaa', 'reblog': {
+            'id': 200, 'account': {'id': 2, 'acct': 'nayu'}, 'content': 'reblogged', 'reblog': None}},
+        {'id': 101, 'account': {'id': 2, 'acct': 'nayu'}, 'content': 'bbb', 'reblog': None},
+    ]
+    # list schemaは毎回作られても同じplanになる
+    plan = compile_schema([status])
+    assert plan is compile_schema([status])
+
+    entities, result = plan.normalize(copy.deepcopy(source))
+    generic_entities, generic_result = normalize_generic(copy.deepcopy(source), [status])
+    assert result == generic_result == [100, 101]
+    assert {key: set(table) for key, table in entities.items()} == \
+        {key: set(table) for key, table in generic_entities.items()}
+
+    assert plan.denormalize(result, entities) == denormalize_generic(result, [status], entities) == source
+
+
+def test_compile_schema_recursive():
+    """自分自身を含むschema"""
+    reply = Entity('replies', Account)
+    reply.schema['parent'] = reply
+    source = {'id': 3, 'parent': {'id': 2, 'parent': {'id': 1, 'parent': None}}}
+
+    entities, result = normalize(copy.deepcopy(source), reply)
+    assert result == 3
+    assert entities['replies'][2].parent == 1
+    assert denormalize(result, reply, entities) == source
+
+
+def test_denormalize_shared():
+    source = [
+        {'id': 100, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'aaa', 'reblog': None},
+        {'id': 101, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'bbb', 'reblog': None},
+    ]
+    entities, result = normalize(copy.deepcopy(source), [status])
+
+    # default: 同じaccountでも別のdict
+    denormalized = denormalize(result, [status], entities)
+    assert denormalized == source
+    assert denormalized[0]['account'] is not denormalized[1]['account']
+
+    # shared: 同じaccountは同じdict
+    denormalized = denormalize(result, [status], entities, shared=True)
+    assert denormalized == source
+    assert denormalized[0]['account'] is denormalized[1]['account']
+
+
+def test_normalize_in_place():
+    """normalizeはdictをコピーせずにmodelにする"""
+    source = {'id': 100, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'aaa', 'reblog': None}
+    account_data = source['account']
+    entities, result = normalize(source, status)
+
+    assert entities['statuses'][100].to_dict() is source
+    assert entities['accounts'][1].to_dict() is account_data
+    assert source['account'] == 1
+    assert entities['statuses'][100].content == 'aaa'
+
+    # denormalizeしてもentityはそのまま
+    denormalized = denormalize(result, status, entities)
+    assert denormalized['account'] == {'id': 1, 'acct': 'shn'}
+    assert source['account'] == 1
+
+
+def test_normalize_batch():
+    sources = [
+        {'id': 100, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'aaa', 'reblog': None},
+        [
+            {'id': 101, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'bbb', 'reblog': None},
+            {'id': 102, 'account': {'id': 2, 'acct': 'gomi'}, 'content': 'ccc', 'reblog': None},
+        ],
+        {'id': 200, 'account': {'id': 2, 'acct': 'gomi'}, 'status': None},
+    ]
+    schemas = [status, [status], notification]
+    entities, results = normalize_batch(zip(copy.deepcopy(sources), schemas))
+
+    # entityは1つのtableにまとまる
+    assert results == [100, [101, 102], 200]
+    assert sorted(entities['statuses']) == [100, 101, 102]
+    assert sorted(entities['accounts']) == [1, 2]
+    assert list(entities['notifications']) == [200]
+
+    assert denormalize_batch(zip(results, schemas), entities) == sources
+    denormalized = denormalize_batch(zip(results, schemas), entities, shared=True)
+    assert denormalized == sources
+    assert denormalized[0]['account'] is denormalized[1][0]['account']
+
+
+def test_denormalize_memo_per_node():
+    """同じkeyでもdefinitionの違うnodeは、別々にdenormalizeする"""
+    # reblogのnodeはaccountをsub entityにしない
+    source = [
+        {'id': 2, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'b', 'reblog': {'id': 1, 'account': 1}},
+        {'id': 1, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'a', 'reblog': None},
+    ]
+    entities, result = normalize(copy.deepcopy(source), [status])
+    denormalized = denormalize(result, [status], entities, shared=True)
+    assert denormalized[0]['reblog']['account'] == 1
+    assert denormalized[1]['account'] == {'id': 1, 'acct': 'shn'}
+
+    # 自分自身を含むschemaでも同じ
+    thread = Entity('statuses', Status, {'account': account, 'reblog': Entity('statuses', Status)})
+    thread.schema['replies'] = [thread]
+    source = [dict(item, replies=[]) for item in source]
+    entities, result = normalize(copy.deepcopy(source), [thread])
+    denormalized = denormalize(result, [thread], entities, shared=True)
+    assert denormalized[0]['reblog']['account'] == 1
+    assert denormalized[1]['account'] == {'id': 1, 'acct': 'shn'}
+
+
+def make_thread(size, children=1):
+    """idが1からsizeまでのreply tree. children=1ならsize段の一本道"""
+    nodes = []
+    for idx in range(size):
+        node = {'id': idx + 1, 'account': {'id': idx % 3, 'acct': 'user{}'.format(idx % 3)}, 'reblog': None,
+                'replies': []}
+        if idx:
+            nodes[(idx - 1) // children]['replies'].append(node)
+        nodes.append(node)
+    return nodes[0]
+
+
+def test_normalize_deep_thread():
+    """自分自身を含むschemaは、再帰の上限より深くても辿れる"""
+    reply = Entity('statuses', Status, {'account': account})
+    reply.schema['replies'] = [reply]
+
+    for source in (make_thread(20, children=3), make_thread(20)):
+        entities, result = normalize(copy.deepcopy(source), reply)
+        generic_entities, generic_result = normalize_generic(copy.deepcopy(source), reply)
+        assert result == generic_result == 1
+        assert {key: list(table) for key, table in entities.items()} == \
+            {key: list(table) for key, table in generic_entities.items()}
+        assert entities['statuses'][1].replies == generic_entities['statuses'][1].replies
+        assert denormalize(result, reply, entities) == denormalize_generic(result, reply, entities) == source
+
+    source = make_thread(5000)  # deepcopyも==も再帰するので使わない
+    entities, result = normalize([source], [reply])
+    assert len(entities['statuses']) == 5000
+    assert entities['statuses'][4999].replies == [5000]
+
+    denormalized = denormalize(result, [reply], entities)
+    assert denormalized[0]['replies'][0]['id'] == 2
+    accounts = [denormalized[0]['account']]
+    node = denormalized[0]
+    while node['replies']:
+        node = node['replies'][0]
+        accounts.append(node['account'])
+    assert node['id'] == 5000
+    assert accounts[1] is not accounts[4]
+
+    denormalized = denormalize(result, [reply], entities, shared=True)
+    node = denormalized[0]['replies'][0]
+    assert node['account'] is node['replies'][0]['replies'][0]['replies'][0]['account']
+
+
+def test_pick_entities():
+    source = [
+        {'id': 1, 'account': {'id': 1, 'acct': 'shn'}, 'reblog': None},
+        {'id': 3, 'account': {'id': 1, 'acct': 'shn'}, 'reblog': {'id': 2, 'account': 2}},
+    ]
+    entities, result = normalize(source, [status])
+    entities['accounts'][9] = Account(id=9)
+
+    # 参照しているentityだけを抜き出す
+    picked = pick_entities(result, [status], entities)
+    assert {key: sorted(table) for key, table in picked.items()} == {'statuses': [1, 2, 3], 'accounts': [1]}
+    assert pick_entities([1], [status], entities) == {
+        'statuses': {1: entities['statuses'][1]}, 'accounts': {1: entities['accounts'][1]}}
+
+    # filterで消されたentityを参照していればKeyError
+    del entities['statuses'][2]
+    with pytest.raises(KeyError):
+        pick_entities(result, [status], entities)
+
+    # 自分自身を含むschemaも、再帰せずに辿れる
+    reply = Entity('statuses', Status, {'account': account})
+    reply.schema['replies'] = [reply]
+    entities, result = normalize([make_thread(5000)], [reply])
+    assert len(pick_entities(result, [reply], entities)['statuses']) == 5000
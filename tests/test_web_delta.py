@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+import pytest
+
+from naumanni import jsoncodec, msgpackcodec
+from naumanni.web.delta import MAX_KNOWN_ENTITIES, get_entity_version, make_delta, parse_known_entities
+
+
+def test_parse_known_entities():
+    assert parse_known_entities('statuses=1@aaaa,2@bbbb; accounts=3@cccc') == {
+        'statuses': {'1': 'aaaa', '2': 'bbbb'},
+        'accounts': {'3': 'cccc'},
+    }
+    assert parse_known_entities('') == {}
+    assert parse_known_entities('statuses=1,2@bbbb;broken') == {'statuses': {'2': 'bbbb'}}
+
+    value = 'statuses=' + ','.join('{}@v'.format(i) for i in range(MAX_KNOWN_ENTITIES + 10))
+    assert len(parse_known_entities(value)['statuses']) == MAX_KNOWN_ENTITIES
+
+
+def test_make_delta():
+    account = {'id': 1, 'acct': 'shn'}
+    old_status = {'id': 9, 'account': 1, 'content': 'old', 'reblog': None}
+    normalized = {
+        'entities': {
+            'accounts': {'1': account},
+            'statuses': {
+                '9': {'id': 9, 'account': 1, 'content': 'edited', 'reblog': None},
+                '10': {'id': 10, 'account': 1, 'content': 'new', 'reblog': None},
+            },
+        },
+        'result': [10, 9],
+    }
+    known = {'accounts': {'1': get_entity_version(account)}, 'statuses': {'9': get_entity_version(old_status)}}
+
+    delta = make_delta(normalized, known)
+    # 変わっていないaccountは省かれ、変わったstatusと新しいstatusは送られる
+    assert delta['entities'] == {'accounts': {}, 'statuses': normalized['entities']['statuses']}
+    assert delta['unchanged'] == {'accounts': ['1']}
+    assert delta['result'] == [10, 9]
+    assert delta['versions']['statuses'] == {
+        '9': get_entity_version(normalized['entities']['statuses']['9']),
+        '10': get_entity_version(normalized['entities']['statuses']['10']),
+    }
+    assert delta['versions']['statuses']['9'] != known['statuses']['9']
+
+    # 何も知らなければ全部送る
+    delta = make_delta(normalized, {})
+    assert delta['entities'] == normalized['entities']
+    assert delta['unchanged'] == {}
+
+
+@pytest.mark.skipif(not msgpackcodec.available, reason='msgpack is not installed')
+def test_entity_version_canonical():
+    status = {'id': '9', 'account': '1', 'content': 'にゃーん', 'reblog': None, 'tags': [{'name': 'a'}]}
+    # keyの順番や、clientに返すcodecによらず同じversionになる
+    reordered = {key: status[key] for key in reversed(list(status))}
+    assert get_entity_version(reordered) == get_entity_version(status)
+
+    normalized = {'entities': {'statuses': {'9': status}}, 'result': ['9']}
+    versions = [
+        make_delta(codec.loads(codec.dumps(normalized)), {})['versions']
+        for codec in (jsoncodec, msgpackcodec)
+    ]
+    assert versions[0] == versions[1]
+
+    known = {'statuses': {'9': versions[0]['statuses']['9']}}
+    packed = msgpackcodec.dumps(dict(normalized, entities={'statuses': {'9': reordered}}))
+    delta = make_delta(msgpackcodec.loads(packed), known)
+    assert delta['unchanged'] == {'statuses': ['9']}
@@ -1,6 +1,17 @@
 # -*- coding:utf-8 -*-
+import gc
+import io
+
+import pytest
+from tornado import gen, httpclient, httpserver, httputil, ioloop, tcpclient, testing, web
+from tornado.curl_httpclient import CurlAsyncHTTPClient
+
+from naumanni import jsoncodec, msgpackcodec
+from naumanni.core.singleflight import SingleFlight
+from naumanni.core.upload import UploadBudget
+from naumanni.web.base import NaumanniRequestHandlerMixIn
 from naumanni.web.proxy import (
-    https_prefix_rex, mastodon_api_rex,
+    APIProxyHandler, STREAM_HIGH_WATER_MARK, _filter_body, _finalize_prefetched, https_prefix_rex, mastodon_api_rex,
 )
 
 
@@ -21,5 +32,505 @@ def test_rex():
     mo = mastodon_api_rex.match('https://friends.nico/api/v1/accounts/verify_credentials?hogehoge')
     assert mo.groups() == ('friends.nico', '/accounts/verify_credentials')
 
+
 def test_nothing():
     pass
+
+
+class _FakeApp(object):
+    def get_filtered_keys(self, schema):
+        return set()
+
+    async def filter_entities(self, entities):
+        pass
+
+
+def test_filter_body_normalized():
+    timeline = [
+        {'id': 2, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'b', 'reblog': {
+            'id': 1, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'a', 'reblog': None}},
+    ]
+    body = jsoncodec.dumps(timeline)
+    io_loop = ioloop.IOLoop.current()
+
+    # filterするpluginがいなければそのまま
+    assert io_loop.run_sync(lambda: _filter_body(_FakeApp(), '/timelines/home', body)) is body
+
+    normalized = io_loop.run_sync(lambda: _filter_body(_FakeApp(), '/timelines/home', body, normalized=True))
+    assert jsoncodec.loads(normalized) == {
+        'entities': {
+            'accounts': {'1': {'id': 1, 'acct': 'shn'}},
+            'statuses': {
+                '1': {'id': 1, 'account': 1, 'content': 'a', 'reblog': None},
+                '2': {'id': 2, 'account': 1, 'content': 'b', 'reblog': 1},
+            },
+        },
+        'result': [2],
+    }
+
+
+class _AccountFilterApp(object):
+    """accountのid 2をfilterで消すplugin"""
+    def get_filtered_keys(self, schema):
+        return {'accounts'}
+
+    async def filter_entities(self, entities):
+        entities['accounts'].pop(2, None)
+
+
+def test_filter_body_drops_filtered_entities():
+    timeline = [
+        {'id': 1, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'a', 'reblog': None},
+        {'id': 3, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'c', 'reblog': {
+            'id': 2, 'account': {'id': 2, 'acct': 'blocked'}, 'content': 'b', 'reblog': None}},
+    ]
+    io_loop = ioloop.IOLoop.current()
+
+    # reblogのaccountが消されたら、そのstatusだけを落とす
+    body = io_loop.run_sync(lambda: _filter_body(_AccountFilterApp(), '/timelines/home', jsoncodec.dumps(timeline)))
+    assert jsoncodec.loads(body) == [timeline[0]]
+
+    # 配列でないresponseはnullになる
+    body = io_loop.run_sync(lambda: _filter_body(
+        _AccountFilterApp(), '/accounts/verify_credentials', jsoncodec.dumps({'id': 2, 'acct': 'blocked'})))
+    assert jsoncodec.loads(body) is None
+
+
+class _AccountAndStatusFilterApp(_AccountFilterApp):
+    """accountのid 2と、statusのid 5をfilterで消すplugin"""
+    def get_filtered_keys(self, schema):
+        return {'accounts', 'statuses'}
+
+    async def filter_entities(self, entities):
+        await super().filter_entities(entities)
+        entities['statuses'].pop(5, None)
+
+
+def test_filter_body_normalized_drops_filtered_entities():
+    shn, blocked = {'id': 1, 'acct': 'shn'}, {'id': 2, 'acct': 'blocked'}
+    timeline = [
+        {'id': 1, 'account': shn, 'content': 'a', 'reblog': None},
+        {'id': 3, 'account': blocked, 'content': 'hidden', 'reblog': None},
+        {'id': 4, 'account': shn, 'content': 'c', 'reblog': {
+            'id': 2, 'account': blocked, 'content': 'b', 'reblog': None}},
+        {'id': 5, 'account': shn, 'content': 'd', 'reblog': None},
+    ]
+    io_loop = ioloop.IOLoop.current()
+
+    # denormalizeする時と同じく、消されたentityを参照する要素を落とし、残りが参照するentityだけを返す
+    body = io_loop.run_sync(lambda: _filter_body(
+        _AccountAndStatusFilterApp(), '/timelines/home', jsoncodec.dumps(timeline), normalized=True))
+    assert jsoncodec.loads(body) == {
+        'entities': {
+            'accounts': {'1': shn},
+            'statuses': {'1': dict(timeline[0], account=1)},
+        },
+        'result': [1],
+    }
+
+    # 配列でないresponseはnullになる
+    body = io_loop.run_sync(lambda: _filter_body(
+        _AccountFilterApp(), '/accounts/verify_credentials', jsoncodec.dumps(blocked), normalized=True))
+    assert jsoncodec.loads(body) is None
+
+
+def test_finalize_prefetched_drops_rate_limit_headers():
+    response = httpclient.HTTPResponse(
+        httpclient.HTTPRequest('https://a.example/api/v1/timelines/home'), 200,
+        headers=httputil.HTTPHeaders({
+            'Content-Type': 'application/json', 'Link': '<https://a.example/next>; rel="next"',
+            'X-Ratelimit-Limit': '300', 'X-Ratelimit-Remaining': '299', 'X-Ratelimit-Reset': '2017-01-01T00:00:00Z',
+        }),
+        buffer=io.BytesIO(b'[]'))
+    code, reason, headers, body = ioloop.IOLoop.current().run_sync(
+        lambda: _finalize_prefetched(response, _FakeApp(), '/timelines/home'))
+    # 先読みしてから返すまでに、rate limitのheaderは古くなっている
+    assert code == 200
+    assert headers['Link'] == '<https://a.example/next>; rel="next"'
+    assert not any(key.startswith('X-Ratelimit-') for key in headers)
+
+
+def test_response_mode():
+    class Handler(NaumanniRequestHandlerMixIn):
+        def __init__(self, uri, headers=None):
+            self.request = httputil.HTTPServerRequest(uri=uri, headers=httputil.HTTPHeaders(headers or {}))
+
+    assert Handler('/ws/x?stream=user').get_response_options() == (None, None, 'stream=user')
+    assert Handler('/ws/x?stream=user&naumanni_response=normalized&tag=a%20b').get_response_options() == \
+        ('normalized', None, 'stream=user&tag=a%20b')
+    assert Handler('/proxy/x', {'X-Naumanni-Response': 'normalized'}).get_response_options() == \
+        ('normalized', None, '')
+    assert Handler('/proxy/x?naumanni_response=unknown').get_response_options() == (None, None, '')
+
+
+@pytest.mark.skipif(not msgpackcodec.available, reason='msgpack is not installed')
+def test_response_format():
+    class Handler(NaumanniRequestHandlerMixIn):
+        def __init__(self, uri, headers=None):
+            self.request = httputil.HTTPServerRequest(uri=uri, headers=httputil.HTTPHeaders(headers or {}))
+
+    # qの高い方を選ぶ. q=0は受け取れない
+    for accept, response_format in [
+        ('application/msgpack', 'msgpack'),
+        ('application/json, application/msgpack;q=0.9', None),
+        ('application/json;q=0.5, application/x-msgpack', 'msgpack'),
+        ('application/msgpack;q=0', None),
+        ('application/msgpack;q=0, */*', None),
+        ('application/msgpack, */*;q=0.1', 'msgpack'),
+        ('*/*', None),
+    ]:
+        assert Handler('/proxy/x', {'Accept': accept}).get_response_options() == (None, response_format, ''), accept
+    assert Handler('/ws/x?naumanni_format=msgpack&stream=user').get_response_options() == \
+        (None, 'msgpack', 'stream=user')
+    assert Handler('/proxy/x?naumanni_format=xml').get_response_options() == (None, None, '')
+
+
+@pytest.mark.skipif(not msgpackcodec.available, reason='msgpack is not installed')
+def test_filter_body_msgpack():
+    timeline = [{'id': 1, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'a', 'reblog': None}]
+    body = jsoncodec.dumps(timeline)
+    io_loop = ioloop.IOLoop.current()
+
+    # filterしなくても、MessagePackにはする
+    packed = io_loop.run_sync(lambda: _filter_body(_FakeApp(), '/timelines/home', body, codec=msgpackcodec))
+    assert msgpackcodec.loads(packed) == timeline
+    packed = io_loop.run_sync(lambda: _filter_body(_FakeApp(), '/unknown', body, codec=msgpackcodec))
+    assert msgpackcodec.loads(packed) == timeline
+
+    # normalizeしたものは、JSONと同じくidがstrになる
+    packed = io_loop.run_sync(
+        lambda: _filter_body(_FakeApp(), '/timelines/home', body, normalized=True, codec=msgpackcodec))
+    assert msgpackcodec.loads(packed)['entities']['statuses'] == {'1': dict(timeline[0], account=1)}
+
+
+class _TimelineHandler(web.RequestHandler):
+    """STREAM_HIGH_WATER_MARKより大きいtimelineを返すupstream"""
+    timeline = [
+        {'id': i, 'account': {'id': i % 3, 'acct': 'shn'}, 'content': 'x' * 2000, 'reblog': None}
+        for i in range(200)
+    ]
+
+    async def get(self):
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        body = jsoncodec.dumps(self.timeline)
+        assert len(body) > STREAM_HIGH_WATER_MARK
+        for offset in range(0, len(body), 16 * 1024):
+            self.write(body[offset:offset + 16 * 1024])
+            await self.flush()
+
+
+class _PublicTimelineHandler(web.RequestHandler):
+    """受け取ったAuthorizationをcontentに入れて返すupstream"""
+    def get(self):
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.write(jsoncodec.dumps([{
+            'id': 1, 'account': {'id': 1, 'acct': 'shn'}, 'reblog': None,
+            'content': self.request.headers.get('Authorization', ''),
+        }]))
+
+
+class _ResponseCache(object):
+    def __init__(self):
+        self.entries = {}
+
+    async def get(self, scope, url, variant=None):
+        return self.entries.get((scope, url, variant))
+
+    async def set(self, scope, url, headers, body, ttl, variant=None):
+        self.entries[scope, url, variant] = (headers, body)
+
+
+class _ProxyApp(_FakeApp):
+    """APIProxyHandlerを、curlで直接upstreamにつながせる"""
+    prefetcher = None
+
+    def __init__(self):
+        self.upstream_pool = self
+        self.single_flight = self
+        self.response_cache = _ResponseCache()
+        self.client = CurlAsyncHTTPClient(force_instance=True)
+
+    def get_filtered_keys(self, schema):
+        return {'statuses'}
+
+    async def fetch(self, request, raise_error=True, aborted=None):
+        request.request_timeout = 5
+        try:
+            return await self.client.fetch(request, raise_error=raise_error)
+        except httpclient.HTTPError as exc:
+            # UpstreamClientPoolと同じく、接続エラーも599のresponseで返す
+            if raise_error:
+                raise
+            return exc.response or httpclient.HTTPResponse(request, exc.code, error=exc)
+
+    async def do(self, key, func, *args):
+        return await func(*args)
+
+
+def test_proxy_buffered_large_response():
+    naumanni_app = _ProxyApp()
+    app = web.Application([
+        ('/api/v1/timelines/home', _TimelineHandler),
+        ('/proxy/(?P<request_url>.+)', APIProxyHandler),
+    ], naumanni_app=naumanni_app)
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+
+    async def _fetch():
+        url = 'http://127.0.0.1:{0}/proxy/http://127.0.0.1:{0}/api/v1/timelines/home'.format(port)
+        return await httpclient.AsyncHTTPClient().fetch(url, headers={'Authorization': 'Bearer x'}, raise_error=False)
+
+    try:
+        response = ioloop.IOLoop.current().run_sync(_fetch)
+    finally:
+        server.stop()
+        naumanni_app.client.close()
+    # filterするので全部bufferしてから返す. 途中でpauseしても止まらない
+    assert response.code == 200
+    assert jsoncodec.loads(response.body) == _TimelineHandler.timeline
+
+
+def test_proxy_response_cache_per_token():
+    naumanni_app = _ProxyApp()
+    app = web.Application([
+        ('/api/v1/timelines/public', _PublicTimelineHandler),
+        ('/proxy/(?P<request_url>.+)', APIProxyHandler),
+    ], naumanni_app=naumanni_app)
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+
+    async def _fetch(authorization):
+        url = 'http://127.0.0.1:{0}/proxy/http://127.0.0.1:{0}/api/v1/timelines/public'.format(port)
+        response = await httpclient.AsyncHTTPClient().fetch(url, headers={'Authorization': authorization})
+        return jsoncodec.loads(response.body)[0]['content']
+
+    async def _run():
+        return [await _fetch(authorization) for authorization in ('Bearer a', 'Bearer b', 'Bearer a')]
+
+    try:
+        contents = ioloop.IOLoop.current().run_sync(_run)
+    finally:
+        server.stop()
+        naumanni_app.client.close()
+    # blockやmuteはtoken毎なので、tokenを渡してtoken毎にcacheする
+    assert contents == ['Bearer a', 'Bearer b', 'Bearer a']
+    assert len(naumanni_app.response_cache.entries) == 2
+    assert all(scope for scope, url, variant in naumanni_app.response_cache.entries)
+
+
+class _BinaryHandler(web.RequestHandler):
+    """STREAM_HIGH_WATER_MARKよりずっと大きいbinaryを返すupstream"""
+    body = bytes(range(256)) * (8 * 1024 * 1024 // 256)
+
+    async def get(self):
+        self.set_header('Content-Type', 'application/octet-stream')
+        for offset in range(0, len(self.body), 64 * 1024):
+            self.write(self.body[offset:offset + 64 * 1024])
+            await self.flush()
+
+
+class _NotFoundHandler(web.RequestHandler):
+    """404のJSONを返すupstream"""
+    def get(self):
+        self.set_status(404)
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.set_header('X-Upstream', 'yes')
+        self.set_header('Keep-Alive', 'timeout=5')
+        self.write(jsoncodec.dumps({'error': 'Record not found'}))
+
+
+class _ResumeCountingProxyHandler(APIProxyHandler):
+    resumed = 0
+
+    def _resume_upstream(self):
+        paused = self._curl_paused
+        super()._resume_upstream()
+        if paused and not self._curl_paused:
+            _ResumeCountingProxyHandler.resumed += 1
+
+
+def _start_proxy(naumanni_app, handlers, proxy_handler=APIProxyHandler):
+    app = web.Application(handlers + [('/proxy/(?P<request_url>.+)', proxy_handler)], naumanni_app=naumanni_app)
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    return server, port
+
+
+def test_proxy_streams_large_binary():
+    naumanni_app = _ProxyApp()
+    server, port = _start_proxy(
+        naumanni_app, [('/media/large', _BinaryHandler)], proxy_handler=_ResumeCountingProxyHandler)
+    _ResumeCountingProxyHandler.resumed = 0
+
+    async def _fetch():
+        stream = await tcpclient.TCPClient().connect('127.0.0.1', port)
+        # HTTP/1.0ならchunkedにならずに、bodyをそのまま送って閉じる
+        await stream.write(
+            'GET /proxy/http://127.0.0.1:{}/media/large HTTP/1.0\r\nAuthorization: Bearer x\r\n\r\n'
+            .format(port).encode('ascii'))
+        # 読まずにおいて、clientへの書き出しを詰まらせる
+        await gen.sleep(0.5)
+        return await stream.read_until_close()
+
+    try:
+        data = ioloop.IOLoop.current().run_sync(_fetch)
+    finally:
+        server.stop()
+        naumanni_app.client.close()
+    head, body = data.split(b'\r\n\r\n', 1)
+    start_line, headers = head.decode('latin1').split('\r\n', 1)
+    headers = httputil.HTTPHeaders.parse(headers)
+    # filterしないresponseは、bufferせずに流す. 詰まったらupstreamをpauseして、読まれたら再開する
+    assert start_line.split(' ', 2)[1] == '200'
+    assert headers['Content-Type'] == 'application/octet-stream'
+    assert body == _BinaryHandler.body
+    assert _ResumeCountingProxyHandler.resumed > 0
+
+
+def test_proxy_streams_error_response():
+    naumanni_app = _ProxyApp()
+    server, port = _start_proxy(naumanni_app, [('/api/v1/statuses/1', _NotFoundHandler)])
+
+    async def _fetch():
+        url = 'http://127.0.0.1:{0}/proxy/http://127.0.0.1:{0}/api/v1/statuses/1'.format(port)
+        return await httpclient.AsyncHTTPClient().fetch(url, headers={'Authorization': 'Bearer x'}, raise_error=False)
+
+    try:
+        response = ioloop.IOLoop.current().run_sync(_fetch)
+    finally:
+        server.stop()
+        naumanni_app.client.close()
+    # 200以外はfilterせずに、hop-by-hopのheaderだけ落として流す
+    assert response.code == 404
+    assert jsoncodec.loads(response.body) == {'error': 'Record not found'}
+    assert response.headers['X-Upstream'] == 'yes'
+    assert response.headers['Content-Type'] == 'application/json; charset=utf-8'
+    assert 'Keep-Alive' not in response.headers
+
+
+class _SlowTimelineHandler(web.RequestHandler):
+    """少し待ってからtimelineを返し、呼ばれた回数を数えるupstream"""
+    calls = 0
+
+    async def get(self):
+        _SlowTimelineHandler.calls += 1
+        await gen.sleep(0.3)
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.write(jsoncodec.dumps([{'id': 1, 'account': {'id': 1, 'acct': 'shn'}, 'content': 'a', 'reblog': None}]))
+
+
+class _SingleFlightProxyApp(_ProxyApp):
+    def __init__(self, filtered_keys):
+        super().__init__()
+        self.filtered_keys = filtered_keys
+        self.single_flight = SingleFlight(self)
+
+    def get_filtered_keys(self, schema):
+        return self.filtered_keys
+
+
+def _fetch_concurrently(filtered_keys, count=3):
+    naumanni_app = _SingleFlightProxyApp(filtered_keys)
+    server, port = _start_proxy(naumanni_app, [('/api/v1/timelines/home', _SlowTimelineHandler)])
+    _SlowTimelineHandler.calls = 0
+
+    async def _fetch():
+        url = 'http://127.0.0.1:{0}/proxy/http://127.0.0.1:{0}/api/v1/timelines/home'.format(port)
+        started = ioloop.IOLoop.current().time()
+        response = await httpclient.AsyncHTTPClient(force_instance=True).fetch(
+            url, headers={'Authorization': 'Bearer x'})
+        return response.code, ioloop.IOLoop.current().time() - started
+
+    async def _run():
+        return await gen.multi([_fetch() for _ in range(count)])
+
+    try:
+        results = ioloop.IOLoop.current().run_sync(_run)
+    finally:
+        server.stop()
+        naumanni_app.client.close()
+    return results, _SlowTimelineHandler.calls
+
+
+def test_proxy_coalesces_buffered_gets():
+    # filterするresponseはbufferするので、1回のupstream requestを共有する
+    results, calls = _fetch_concurrently({'statuses'})
+    assert calls == 1
+    assert all(code == 200 and elapsed < 0.6 for code, elapsed in results)
+
+
+def test_proxy_does_not_coalesce_streamed_gets():
+    # filterしないresponseはclientに流すので、まとめずにそれぞれ取りに行く. followerを待たせない
+    results, calls = _fetch_concurrently(set())
+    assert calls == 3
+    assert all(code == 200 and elapsed < 0.6 for code, elapsed in results)
+
+
+class _UploadProxyApp(_ProxyApp):
+    config = None
+
+    def __init__(self):
+        super().__init__()
+        self.upload_budget = UploadBudget()
+
+
+def test_proxy_upload_aborted_before_body():
+    naumanni_app = _UploadProxyApp()
+    server, port = _start_proxy(naumanni_app, [])
+    io_loop = ioloop.IOLoop.current()
+    errors = []
+
+    async def _run():
+        io_loop.asyncio_loop.set_exception_handler(lambda loop, context: errors.append(context))
+        stream = await tcpclient.TCPClient().connect('127.0.0.1', port)
+        # Authorizationがないので、uploadはbodyを受け取りきる前に401で終わる
+        await stream.write(
+            'POST /proxy/http://127.0.0.1:{0}/api/v1/media HTTP/1.1\r\nHost: 127.0.0.1:{0}\r\n'
+            'Content-Length: 1000\r\n\r\n'
+            .format(port).encode('ascii') + b'x' * 100)
+        await gen.sleep(0.1)
+        stream.close()
+        await gen.sleep(0.1)
+
+    try:
+        io_loop.run_sync(_run)
+    finally:
+        server.stop()
+        naumanni_app.client.close()
+        # 受け取られなかった例外は、taskが捨てられる時にlogされる
+        gc.collect()
+        io_loop.asyncio_loop.set_exception_handler(None)
+    # post()が呼ばれなくても、uploadの例外は受け取られていて、budgetも返っている
+    assert errors == []
+    assert naumanni_app.upload_budget.in_flight == 0
+
+
+class _TruncatedHandler(web.RequestHandler):
+    """Content-Lengthより短いbodyを送って切るupstream"""
+    async def get(self):
+        self.request.connection.stream.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: 100000\r\n\r\n' +
+            b'x' * 1000)
+        await gen.sleep(0.05)
+        self.request.connection.stream.close()
+
+
+def test_proxy_streams_truncated_response():
+    naumanni_app = _ProxyApp()
+    server, port = _start_proxy(naumanni_app, [('/media/truncated', _TruncatedHandler)])
+
+    async def _fetch():
+        url = 'http://127.0.0.1:{0}/proxy/http://127.0.0.1:{0}/media/truncated'.format(port)
+        await httpclient.AsyncHTTPClient(force_instance=True).fetch(
+            url, headers={'Authorization': 'Bearer x'}, raise_error=False)
+
+    try:
+        # headerを送った後にupstreamが切れたら、clientとの接続も切って途中で終わったことを伝える
+        with pytest.raises(httpclient.HTTPClientError):
+            ioloop.IOLoop.current().run_sync(_fetch)
+    finally:
+        server.stop()
+        naumanni_app.client.close()
@@ -0,0 +1,124 @@
+# -*- coding:utf-8 -*-
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+from naumanni.web.sendqueue import SendQueue
+
+
+class _SlowClient(object):
+    """write_messageのflushを、releaseするまで止めておくclient"""
+
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+        self._flushes = []
+
+    def write_message(self, frame, binary=False):
+        self.sent.append(frame)
+        future = Future()
+        self._flushes.append(future)
+        return future
+
+    def release(self):
+        flushes, self._flushes = self._flushes, []
+        for future in flushes:
+            future.set_result(None)
+
+    def close(self, code=None, reason=None):
+        self.closed = code
+
+
+def _run(func):
+    async def _wrapper():
+        rv = func()
+        # spawn_callbackした送信を進める
+        await gen.sleep(0)
+        return rv
+    return ioloop.IOLoop.current().run_sync(_wrapper)
+
+
+def _finish(client, queue):
+    """送信中のframeを終わらせる"""
+    queue.close()
+    _run(client.release)
+
+
+def test_send_queue_drop_oldest():
+    client = _SlowClient()
+    queue = SendQueue(client, max_bytes=30)
+
+    def _put():
+        for i in range(10):
+            queue.put('frame{:05d}'.format(i))
+    _run(_put)
+
+    # max_bytesまでしか溜めない
+    assert client.sent == ['frame00007']
+    assert queue.buffered_bytes == 30
+    assert queue.dropped == 7
+
+    async def _drain():
+        while queue._frames or queue._sending_bytes:
+            client.release()
+            await gen.sleep(0)
+    ioloop.IOLoop.current().run_sync(_drain)
+    assert client.sent == ['frame00007', 'frame00008', 'frame00009']
+    assert queue.buffered_bytes == 0
+
+
+def test_send_queue_coalesce():
+    client = _SlowClient()
+    queue = SendQueue(client, max_bytes=30, policy='coalesce')
+
+    def _put():
+        queue.put('update0000')
+        queue.put('notify0001', event='notification')
+        for i in range(2, 8):
+            queue.put('update{:04d}'.format(i), event='update')
+        queue.put('delete0008', event='delete')
+    _run(_put)
+
+    # notificationとdeleteは残して、古いupdateから捨てる
+    assert client.sent == ['notify0001']
+    assert [frame for frame, binary, event, size in queue._frames] == ['update0007', 'delete0008']
+    assert queue.dropped == 6
+    _finish(client, queue)
+
+
+def test_send_queue_disconnect():
+    client = _SlowClient()
+    queue = SendQueue(client, max_bytes=30, policy='disconnect', stall_timeout=60)
+
+    def _put(count):
+        for i in range(count):
+            queue.put('frame{:05d}'.format(i))
+
+    # しばらくは溜める
+    _run(lambda: _put(5))
+    assert client.closed is None
+    assert queue.dropped == 0
+
+    # max_bytesのHARD_LIMIT_RATIO倍を超えたら切る
+    _run(lambda: _put(20))
+    assert client.closed == 1008
+    assert queue.closed
+    assert queue.buffered_bytes <= 10
+    _finish(client, queue)
+
+
+def test_send_queue_utf8_bytes():
+    client = _SlowClient()
+    queue = SendQueue(client, max_bytes=30)
+
+    def _put():
+        # かなは1文字3byteなので、'にゃー0'は4文字で10byte
+        for i in range(5):
+            queue.put('にゃー{}'.format(i))
+        queue.put(b'\x00' * 10, binary=True)
+    _run(_put)
+
+    assert queue.buffered_bytes == 10 + 10 + 10
+    assert client.sent == ['にゃー3']
+    assert [frame for frame, binary, event, size in queue._frames] == ['にゃー4', b'\x00' * 10]
+    assert queue.dropped == 3
+    _finish(client, queue)
@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+from naumanni.web.server import _sum_status
+
+
+def test_sum_status():
+    total = {'process': {}}
+    _sum_status(total, {
+        'upstream.hits': 3,
+        'stream_hub.buffered_bytes': 100,
+        'stream_hub.buffered_bytes.max': 80,
+        'websocket_deflate.client.enabled': True,
+        'websocket_deflate.client.bytes': 1000,
+        'websocket_deflate.client.sent_bytes': 200,
+        'websocket_deflate.client.ratio': 0.2,
+        'circuit.hosts': {'example.com': {'state': 'closed'}},
+    })
+    _sum_status(total, {
+        'upstream.hits': 4,
+        'stream_hub.buffered_bytes': 50,
+        'stream_hub.buffered_bytes.max': 50,
+        'websocket_deflate.client.enabled': True,
+        'websocket_deflate.client.bytes': 3000,
+        'websocket_deflate.client.sent_bytes': 1800,
+        'websocket_deflate.client.ratio': 0.6,
+    })
+
+    assert total == {
+        'process': {},
+        'upstream.hits': 7,
+        'stream_hub.buffered_bytes': 150,
+        # maxは合計しない
+        'stream_hub.buffered_bytes.max': 80,
+        'websocket_deflate.client.bytes': 4000,
+        'websocket_deflate.client.sent_bytes': 2000,
+        # ratioは合計したbyte数から
+        'websocket_deflate.client.ratio': 0.5,
+    }
+
+
+def test_sum_status_no_bytes():
+    total = {}
+    _sum_status(total, {'websocket_deflate.upstream.bytes': 0, 'websocket_deflate.upstream.sent_bytes': 0,
+                        'websocket_deflate.upstream.ratio': 1.0})
+    _sum_status(total, {'websocket_deflate.upstream.bytes': 0, 'websocket_deflate.upstream.sent_bytes': 0,
+                        'websocket_deflate.upstream.ratio': 1.0})
+    assert total['websocket_deflate.upstream.ratio'] == 1.0
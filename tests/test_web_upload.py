@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+from tornado import gen, ioloop
+
+from naumanni.web.upload import UploadBuffer
+
+
+def _transfer(buf, chunks):
+    received = []
+
+    async def _write(chunk):
+        received.append(chunk)
+
+    async def _receive():
+        for chunk in chunks:
+            await buf.write(chunk)
+
+    async def _run():
+        await gen.multi([buf.produce(_write), _receive()])
+
+    ioloop.IOLoop.current().run_sync(_run)
+    return b''.join(received)
+
+
+def test_upload_buffer():
+    """小さいbodyはqueueを通して流れる"""
+    chunks = [bytes([i]) * 100 for i in range(50)]
+    buf = UploadBuffer(5000, queue_size=4, spool_threshold=10000)
+    assert not buf.spooled
+    assert _transfer(buf, chunks) == b''.join(chunks)
+    buf.close()
+
+
+def test_upload_buffer_spooled():
+    """大きいbodyは一時ファイルを通して流れる"""
+    chunks = [bytes([i]) * 1000 for i in range(50)]
+    buf = UploadBuffer(50000, spool_threshold=10000)
+    assert buf.spooled
+    assert _transfer(buf, chunks) == b''.join(chunks)
+    buf.close()
+
+
+def test_upload_buffer_close_while_writing():
+    """書いている途中にcloseされたら、書き終わってから一時ファイルを閉じる"""
+    buf = UploadBuffer(50000, spool_threshold=10000)
+
+    async def _run():
+        writing = gen.convert_yielded(buf.write(b'x' * 1000))
+        await gen.sleep(0)
+        buf.close()
+        assert not buf._file.closed
+        await writing
+
+    ioloop.IOLoop.current().run_sync(_run)
+    assert buf._file.closed
+    assert buf.received == 0
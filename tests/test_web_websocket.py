@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+import pytest
+from tornado import ioloop
+
+from naumanni import jsoncodec, msgpackcodec
+from naumanni.web.websocket import _combine_frames, encode_messages
+
+
+class _FakeApp(object):
+    def __init__(self):
+        self.filtered = []
+
+    def get_filtered_keys(self, schema):
+        return {'statuses'}
+
+    async def filter_entities(self, entities):
+        self.filtered.append(sorted(entities['statuses']))
+
+
+def _make_raws():
+    status = {'id': 1, 'account': {'id': 2, 'acct': 'shn'}, 'content': 'a', 'reblog': None}
+    return [
+        jsoncodec.dumps_str({'event': 'update', 'payload': jsoncodec.dumps_str(status)}),
+        jsoncodec.dumps_str({'event': 'delete', 'payload': '1'}),
+    ]
+
+
+def test_encode_messages():
+    app = _FakeApp()
+    raws = _make_raws()
+    variants = {(None, None), ('normalized', None)}
+    events, frames = ioloop.IOLoop.current().run_sync(lambda: encode_messages(app, raws, variants))
+
+    # variantがいくつあっても、filterは1回
+    assert app.filtered == [[1]]
+    assert events == ['update', 'delete']
+    assert set(frames) == variants
+
+    plain, binary = frames[None, None]
+    assert not binary
+    assert jsoncodec.loads(jsoncodec.loads(plain[0])['payload'])['account'] == {'id': 2, 'acct': 'shn'}
+    assert plain[1] == raws[1]
+
+    normalized, binary = frames['normalized', None]
+    assert jsoncodec.loads(jsoncodec.loads(normalized[0])['payload'])['result'] == 1
+
+
+class _MutingApp(_FakeApp):
+    """status 1を消すplugin"""
+
+    async def filter_entities(self, entities):
+        await super().filter_entities(entities)
+        entities['statuses'].pop(1, None)
+
+
+def test_encode_messages_filtered():
+    app = _MutingApp()
+    account = {'id': 2, 'acct': 'shn'}
+    muted = {'id': 1, 'account': account, 'content': 'a', 'reblog': None}
+    statuses = [muted, {'id': 3, 'account': account, 'content': 'b', 'reblog': muted},
+                {'id': 4, 'account': account, 'content': 'c', 'reblog': None}]
+    raws = [jsoncodec.dumps_str({'event': 'update', 'payload': jsoncodec.dumps_str(status)}) for status in statuses]
+    raws.append(jsoncodec.dumps_str({'event': 'delete', 'payload': '1'}))
+    variants = {(None, None), ('normalized', None)}
+    events, frames = ioloop.IOLoop.current().run_sync(lambda: encode_messages(app, raws, variants))
+
+    # 消されたmessageだけNoneになり、他のmessageはそのまま届く
+    plain, binary = frames[None, None]
+    assert plain[0] is None
+    assert plain[1] is None
+    assert jsoncodec.loads(jsoncodec.loads(plain[2])['payload'])['id'] == 4
+    assert plain[3] == raws[3]
+
+    # normalizedでも、消されたentityを参照しているmessageは同じくNoneになる
+    normalized, binary = frames['normalized', None]
+    assert normalized[0] is None
+    assert normalized[1] is None
+    assert jsoncodec.loads(jsoncodec.loads(normalized[2])['payload']) == {
+        'entities': {'statuses': {'4': dict(statuses[2], account=2)}, 'accounts': {'2': account}},
+        'result': 4,
+    }
+    assert normalized[3] == raws[3]
+
+    # normalizedのclientがいない時も同じ
+    events, frames = ioloop.IOLoop.current().run_sync(lambda: encode_messages(app, raws, {(None, None)}))
+    assert frames[None, None][0] == plain
+
+    # 投稿したaccountが消されても、どちらのvariantでもNoneになる
+    events, frames = ioloop.IOLoop.current().run_sync(
+        lambda: encode_messages(_AccountMutingApp(), raws[2:], variants))
+    assert frames[None, None][0][0] is None
+    assert frames['normalized', None][0][0] is None
+
+
+class _AccountMutingApp(_FakeApp):
+    """account 2を消すplugin"""
+
+    def get_filtered_keys(self, schema):
+        return {'accounts'}
+
+    async def filter_entities(self, entities):
+        entities['accounts'].pop(2, None)
+
+
+def test_combine_frames():
+    raws = _make_raws()
+    assert jsoncodec.loads(_combine_frames(raws, False)) == [jsoncodec.loads(raw) for raw in raws]
+
+
+@pytest.mark.skipif(not msgpackcodec.available, reason='msgpack is not installed')
+def test_combine_frames_msgpack():
+    messages = [{'event': 'update', 'payload': {'id': 1}}, {'event': 'delete', 'payload': '1'}]
+    frames = [msgpackcodec.dumps(message) for message in messages]
+    assert msgpackcodec.loads(_combine_frames(frames, True)) == messages
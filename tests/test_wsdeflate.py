@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+from tornado import httpclient, httpserver, ioloop, testing, web
+from tornado.websocket import WebSocketHandler
+
+from naumanni import wsdeflate
+
+
+class _Config(object):
+    websocket_compression = True
+    websocket_compression_window_bits = 10
+    websocket_compression_min_size = 64
+
+
+class _EchoHandler(WebSocketHandler):
+    def initialize(self, leg):
+        self.leg = leg
+
+    def get_compression_options(self):
+        return self.leg.options
+
+    def get_websocket_protocol(self):
+        return wsdeflate.wrap_protocol(self, super().get_websocket_protocol(), self.leg)
+
+    def on_message(self, message):
+        self.write_message(message)
+
+
+def test_get_compression_options():
+    assert wsdeflate.get_compression_options(_Config(), 'websocket_upstream_compression') is None
+    options = wsdeflate.get_compression_options(_Config(), 'websocket_compression')
+    assert options == {
+        'compression_level': wsdeflate.DEFAULT_COMPRESSION_LEVEL, 'mem_level': wsdeflate.DEFAULT_MEM_LEVEL,
+        'window_bits': 10, 'min_size': 64,
+    }
+
+
+def test_deflate_protocol():
+    options = wsdeflate.get_compression_options(_Config(), 'websocket_compression')
+    server_leg = wsdeflate.DeflateLeg(options)
+    client_leg = wsdeflate.DeflateLeg(options)
+    app = web.Application([('/', _EchoHandler, {'leg': server_leg})])
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+
+    large = '{"content": "<p>' + 'toot ' * 200 + '</p>"}'
+
+    async def _talk():
+        request = httpclient.HTTPRequest('ws://127.0.0.1:{}/'.format(port))
+        conn = await wsdeflate.websocket_connect(request, client_leg)
+        # window bitsはserverから伝わる
+        assert conn.headers['Sec-WebSocket-Extensions'] == \
+            'permessage-deflate; client_max_window_bits=10; server_max_window_bits=10'
+        rv = []
+        for message in ('small', large):
+            conn.write_message(message)
+            rv.append(await conn.read_message())
+        conn.close()
+        return rv
+
+    try:
+        assert ioloop.IOLoop.current().run_sync(_talk) == ['small', large]
+    finally:
+        server.stop()
+
+    # min_size未満は圧縮しない
+    for leg in (server_leg, client_leg):
+        assert leg.messages == 2
+        assert leg.skipped == 1
+        assert leg.compressed == 1
+        assert leg.bytes == len('small') + len(large)
+        assert leg.sent_bytes < len(large)
+        assert leg.inflated == 1
+        assert leg.inflated_bytes == len(large)
+    assert server_leg.stats('ws')['ws.ratio'] < 0.5
+
+
+def test_deflate_unsupported_tornado(monkeypatch):
+    # 非公開APIがないtornadoでは、圧縮はtornadoに任せて数えない
+    monkeypatch.setattr(wsdeflate, 'SUPPORTED', False)
+    options = wsdeflate.get_compression_options(_Config(), 'websocket_compression')
+    server_leg = wsdeflate.DeflateLeg(options)
+    client_leg = wsdeflate.DeflateLeg(options)
+    app = web.Application([('/', _EchoHandler, {'leg': server_leg})])
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+
+    async def _talk():
+        request = httpclient.HTTPRequest('ws://127.0.0.1:{}/'.format(port))
+        conn = await wsdeflate.websocket_connect(request, client_leg)
+        assert conn.headers['Sec-WebSocket-Extensions'].startswith('permessage-deflate')
+        conn.write_message('small')
+        rv = await conn.read_message()
+        conn.close()
+        return rv
+
+    try:
+        assert ioloop.IOLoop.current().run_sync(_talk) == 'small'
+    finally:
+        server.stop()
+    assert server_leg.messages == client_leg.messages == 0